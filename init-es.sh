@@ -1,5 +1,7 @@
 #!/bin/sh
-# Скрипт для идемпотентного создания индекса в Elasticsearch
+# Скрипт для идемпотентного создания индекса в Elasticsearch.
+# Индекс создаётся как версия 'movies_v1', а 'movies' — алиас на неё,
+# чтобы переиндексация могла атомарно переключать алиас на новые версии.
 
 # Ждем, пока Elasticsearch не станет доступен
 until curl -s --fail http://elasticsearch:9200/_cluster/health?wait_for_status=yellow&timeout=2s > /dev/null; do
@@ -7,14 +9,16 @@ until curl -s --fail http://elasticsearch:9200/_cluster/health?wait_for_status=y
   sleep 2
 done
 
-# Проверяем, существует ли индекс
+# Проверяем, существует ли индекс или алиас
 curl -s --head --fail http://elasticsearch:9200/movies >/dev/null
 CURL_EXIT_CODE=$?
 
 case $CURL_EXIT_CODE in
   22)
-    echo "Index 'movies' not found. Creating..."
-    curl -X PUT "http://elasticsearch:9200/movies" -H "Content-Type: application/json" --data-binary "@/app/es_schema.json" --fail-with-body
+    echo "Index 'movies' not found. Creating 'movies_v1' with alias 'movies'..."
+    curl -X PUT "http://elasticsearch:9200/movies_v1" -H "Content-Type: application/json" --data-binary "@/app/es_schema.json" --fail-with-body || exit 1
+    curl -X POST "http://elasticsearch:9200/_aliases" -H "Content-Type: application/json" \
+      -d '{"actions": [{"add": {"index": "movies_v1", "alias": "movies"}}]}' --fail-with-body
     ;;
   0)
     echo "Index 'movies' already exists. Skipping."
@@ -0,0 +1,356 @@
+"""
+Асинхронный режим ETL: источники работают конкурентно, а стадии перекрываются.
+
+Для каждого источника запущены две задачи. Экстрактор читает keyset-страницы и
+складывает их в ограниченную asyncio.Queue. Обработчик отмечает затронутые фильмы
+в общем множестве грязных фильмов, как синхронный цикл, и собирает их:
+merge -> transform -> очередь Redis. Отдельная задача-загрузчик параллельно разбирает
+очередь Redis в Elasticsearch. Поэтому следующая выборка из PostgreSQL идёт
+одновременно с bulk-загрузкой предыдущей.
+
+Семантика состояний та же, что в синхронном режиме. У film_work фильмы страницы и сдвиг
+курсора пишутся одной транзакцией MULTI/EXEC, у персон и жанров так же пишутся фильмы
+пачки разворачивания и отметка разворачивания, а курсор сдвигается после того, как
+фильмы страницы собраны и попали в очередь. Сборку обработчики выполняют по очереди:
+фильм, который за это время отметили несколько источников, собирается один раз.
+Переименования персон и жанров, как и в синхронном режиме, применяются частичными обновлениями.
+Страницы одного источника обрабатываются строго по порядку.
+"""
+import asyncio
+import logging
+import os
+import time
+from contextlib import ExitStack
+
+from elasticsearch import AsyncElasticsearch
+from psycopg import AsyncConnection, OperationalError
+from psycopg.rows import tuple_row
+from redis import asyncio as aioredis
+
+from dirty_set import AsyncDirtyFilmSet
+from doc_queue import AsyncRedisStreamQueue, latest_documents
+from enricher import PostgresEnricher
+from fingerprints import FingerprintStore
+from loader import AsyncElasticsearchLoader, observe_result
+from merger import PostgresMerger, configure_cursor
+from metrics import QUEUE_DEPTH, observe_lag, track_stage
+from partial_updates import PartialUpdater
+from producer import PostgresProducer
+from scheduler import AdaptiveScheduler
+from state import State, RedisStorage, JsonFileStorage, FanoutCheckpoint
+from transformer import PostgresTransformer
+from utils import async_backoff, connect_es, pg_conn_context, redis_conn_context
+
+
+class AsyncPostgresProducer(PostgresProducer):
+    """
+    Продюсер с собственной позицией курсора в памяти: экстрактор может читать
+    следующую страницу, не дожидаясь, пока обработчик сохранит предыдущую.
+    """
+
+    def __init__(self, pg_conn, state, table, batch_size=100):
+        super().__init__(pg_conn, state, table, batch_size)
+        self.position = self._cursor()
+
+    @async_backoff(exceptions=(OperationalError,), service_name="PostgreSQL")
+    async def extract(self):
+        query, params = self.extract_query(*self.position)
+        async with self.pg_conn.cursor() as cur:
+            await cur.execute(query, params)
+            rows = await cur.fetchall()
+        if rows:
+            self.position = (str(rows[-1][1]), str(rows[-1][0]))
+        return rows
+
+    @async_backoff(exceptions=(OperationalError,), service_name="PostgreSQL")
+    async def count_remaining(self):
+        """Количество записей источника после позиции экстрактора."""
+        async with self.pg_conn.cursor() as cur:
+            await cur.execute(*self.count_query(*self.position))
+            return (await cur.fetchone())[0]
+
+
+class AsyncPostgresEnricher(PostgresEnricher):
+    @async_backoff(exceptions=(OperationalError,), service_name="PostgreSQL")
+    async def fetch_fanout_page(self, source_ids, source_type, after_id=None):
+        query, params = self.fanout_query(source_ids, source_type, after_id)
+        async with self.pg_conn.cursor() as cur:
+            await cur.execute(query, params)
+            return [row[0] for row in await cur.fetchall()]
+
+    async def iter_film_ids(self, source_ids, source_type, after_id=None):
+        if not source_ids or source_type not in self.RELATION_MAPPING:
+            return
+        while True:
+            film_work_ids = await self.fetch_fanout_page(source_ids, source_type, after_id)
+            if not film_work_ids:
+                return
+            yield film_work_ids
+            if len(film_work_ids) < self.chunk_size:
+                return
+            after_id = film_work_ids[-1]
+
+    async def enrich(self, source_ids, source_type):
+        """Все id фильмов, связанных с source_ids, одним списком."""
+        return [fw_id async for chunk in self.iter_film_ids(source_ids, source_type) for fw_id in chunk]
+
+
+class AsyncPostgresMerger(PostgresMerger):
+    @async_backoff(exceptions=(OperationalError,), service_name="PostgreSQL")
+    async def fetch(self, film_work_ids, mode='aggregated'):
+        if not film_work_ids:
+            return []
+
+        query, params = self.merge_query(film_work_ids, mode)
+        merged_data = []
+        async with self.pg_conn.cursor(row_factory=tuple_row) as cur:
+            configure_cursor(cur)
+            await cur.execute(query, params)
+            while True:
+                rows = await cur.fetchmany(self.chunk_size)
+                if not rows:
+                    break
+                merged_data.extend(rows)
+        return merged_data
+
+
+class AsyncPipeline:
+    def __init__(self, settings):
+        self.settings = settings
+        self.scheduler = AdaptiveScheduler(
+            [config.source_type for config in settings.producer_configs],
+            batch_size=settings.batch_size,
+            sleep_time=settings.sleep_time,
+            max_sleep_time=settings.max_sleep_time,
+            backoff_factor=settings.sleep_backoff_factor,
+            report_every=settings.catchup_report_every,
+        )
+        # Сборку грязных фильмов обработчики источников выполняют по очереди
+        self._flush_lock = asyncio.Lock()
+
+    @async_backoff(start_sleep_time=1, factor=2, border_sleep_time=8, exceptions=(OperationalError,), service_name="PostgreSQL")
+    async def _connect_pg(self):
+        return await AsyncConnection.connect(
+            **self.settings.pg.to_dict(), autocommit=True, prepare_threshold=self.settings.pg_prepare_threshold
+        )
+
+    def _storage(self, redis_connection, state_key):
+        if self.settings.state_storage == 'file':
+            return JsonFileStorage(os.path.join(self.settings.state_dir, f"{state_key}.json"))
+        return RedisStorage(redis_connection, state_key)
+
+    def _fingerprints(self, redis_connection):
+        if not self.settings.fingerprint_cache:
+            return None
+        return FingerprintStore(redis_connection, self.settings.fingerprint_key)
+
+    def _partial_updater(self, stack: ExitStack, redis_connection, fingerprints: FingerprintStore = None):
+        """
+        Частичные обновления при переименованиях или None, если они выключены. PartialUpdater
+        синхронный: он вызывается в потоках на своих соединениях с PostgreSQL и Elasticsearch
+        и ведёт те же снимки, что и синхронный режим.
+        """
+        settings = self.settings
+        if not settings.partial_updates:
+            return None
+        pg_conn = stack.enter_context(pg_conn_context(**settings.pg.to_dict(), autocommit=True))
+        es_conn = stack.enter_context(connect_es(hosts=[f"http://{settings.es.host}:{settings.es.port}"]))
+        return PartialUpdater(pg_conn, es_conn, settings.es.index, redis_connection,
+                              PostgresEnricher(pg_conn, settings.batch_size), fingerprints, settings.snapshot_key_prefix)
+
+    async def run(self):
+        settings = self.settings
+        es_conn = AsyncElasticsearch(hosts=[f"http://{settings.es.host}:{settings.es.port}"])
+        queue_connection = aioredis.Redis(**settings.redis.to_dict() | {'decode_responses': False})
+        connections = []
+        try:
+            with redis_conn_context(**settings.redis.to_dict()) as state_connection, ExitStack() as stack:
+                doc_queue = AsyncRedisStreamQueue(
+                    queue_connection,
+                    stream=settings.queue_stream,
+                    group=settings.queue_group,
+                    claim_idle_ms=settings.queue_claim_idle_ms,
+                    codec=settings.queue_codec,
+                    entry_size=settings.batch_size,
+                    passthrough=settings.queue_passthrough,
+                    dead_letter_stream=settings.queue_dead_letter_stream,
+                )
+                # Множество в том же Redis, что и очередь: его команды идут в транзакции записи документов
+                dirty_set = AsyncDirtyFilmSet(queue_connection, settings.dirty_set_key)
+                loader = AsyncElasticsearchLoader(
+                    es_conn,
+                    settings.es.index,
+                    chunk_size=settings.es.bulk_chunk_size,
+                    max_chunk_bytes=settings.es.bulk_max_chunk_bytes,
+                    max_retries=settings.es.bulk_max_retries,
+                    initial_backoff=settings.es.bulk_initial_backoff,
+                    max_backoff=settings.es.bulk_max_backoff,
+                    fingerprints=self._fingerprints(state_connection),
+                )
+                partial = self._partial_updater(stack, state_connection, loader.fingerprints)
+
+                tasks = [asyncio.create_task(self._load(loader, doc_queue), name='loader')]
+                sources = []
+                for config in settings.producer_configs:
+                    # Асинхронное соединение выполняет один запрос за раз, поэтому
+                    # у экстрактора и обработчика каждого источника свои соединения.
+                    extract_conn, process_conn = await self._connect_pg(), await self._connect_pg()
+                    connections.extend([extract_conn, process_conn])
+
+                    state = State(self._storage(state_connection, config.state_key))
+                    producer = AsyncPostgresProducer(extract_conn, state, config.table, settings.batch_size)
+                    enricher = AsyncPostgresEnricher(process_conn, settings.batch_size)
+                    stages = (enricher, AsyncPostgresMerger(process_conn, settings.batch_size), PostgresTransformer(enricher))
+                    sources.append((config, producer, stages))
+
+                # Фильмы, оставшиеся в множестве после падения, собираются до первой страницы
+                _, merger, transformer = sources[0][2]
+                await self._flush(dirty_set, merger, transformer, doc_queue)
+                for config, producer, stages in sources:
+                    pages = asyncio.Queue(maxsize=settings.async_stage_queue_size)
+                    tasks.append(asyncio.create_task(self._extract(config, producer, pages), name=f"extract-{config.source_type}"))
+                    tasks.append(asyncio.create_task(self._process(config, producer, pages, doc_queue, dirty_set, *stages, partial),
+                                                     name=f"process-{config.source_type}"))
+
+                logging.info("Асинхронный конвейер ETL запущен.")
+                await asyncio.gather(*tasks)
+        finally:
+            for conn in connections:
+                await conn.close()
+            await queue_connection.aclose()
+            await es_conn.close()
+
+    async def _extract(self, config, producer: AsyncPostgresProducer, pages: asyncio.Queue):
+        """Читает keyset-страницы источника, пока он отдаёт полные пачки, затем ждёт по расписанию."""
+        source_type = config.source_type
+        while True:
+            with track_stage('extract') as batch:
+                rows = await producer.extract()
+                batch.rows_out = len(rows)
+            self.scheduler.record(source_type, len(rows))
+            if self.scheduler.should_report(source_type):
+                remaining = await producer.count_remaining()
+                self.scheduler.log_progress(source_type, producer.estimate_lag(), remaining)
+            if rows:
+                logging.info(f"Producer извлек {len(rows)} записей из '{source_type}'.")
+                # put блокируется, если обработчик не успевает: это ограничивает память
+                await pages.put(rows)
+            pause = self.scheduler.sources[source_type].next_run - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+
+    async def _process(self, config, producer: AsyncPostgresProducer, pages: asyncio.Queue, doc_queue: AsyncRedisStreamQueue,
+                       dirty_set: AsyncDirtyFilmSet, enricher: AsyncPostgresEnricher, merger: AsyncPostgresMerger,
+                       transformer: PostgresTransformer, partial: PartialUpdater = None):
+        """
+        Отмечает фильмы страниц источника в множестве грязных фильмов, собирает их и сдвигает курсор.
+        Если задан partial, переименования персон и жанров применяются частичными обновлениями,
+        как в синхронном режиме (см. main.process_sources), а снимки сохраняются перед сдвигом курсора.
+        """
+        source_type = config.source_type
+        state = producer.state
+
+        while True:
+            rows = await pages.get()
+            source_ids = [row[0] for row in rows]
+            cursor = producer.cursor_values(rows) | FanoutCheckpoint.cleared()
+            if config.enrich:
+                changes = None
+                if partial is not None and partial.supports(source_type):
+                    changes = await asyncio.to_thread(partial.classify, source_type, source_ids)
+                    source_ids = changes.rebuild_ids
+                checkpoint = FanoutCheckpoint(state, source_ids)
+                resume_after = checkpoint.resume_after()
+                if resume_after:
+                    logging.info(f"Продолжение разворачивания '{source_type}' после фильма {resume_after}.")
+                chunks = enricher.iter_film_ids(source_ids, source_type, after_id=resume_after)
+                while True:
+                    with track_stage('enrich', rows_in=len(source_ids)) as batch:
+                        chunk = await anext(chunks, None)
+                        batch.rows_out = len(chunk or [])
+                    if chunk is None:
+                        break
+                    await self._mark_dirty(doc_queue, dirty_set, chunk, source_type, state, checkpoint.values(chunk[-1]))
+                await self._flush(dirty_set, merger, transformer, doc_queue)
+                if changes is not None:
+                    await self._apply_renames(partial, source_type, changes.renames, enricher, dirty_set, merger, transformer, doc_queue)
+                    await asyncio.to_thread(partial.commit, source_type, changes.snapshots)
+                await asyncio.to_thread(state.set_states, cursor)
+            else:
+                await self._mark_dirty(doc_queue, dirty_set, source_ids, source_type, state, cursor)
+                await self._flush(dirty_set, merger, transformer, doc_queue)
+
+            observe_lag(source_type, producer)
+            logging.info(f"Состояние для '{source_type}' обновлено: modified={cursor['last_updated_at']}, id={cursor['last_id']}")
+            pages.task_done()
+
+    @staticmethod
+    async def _mark_dirty(doc_queue: AsyncRedisStreamQueue, dirty_set: AsyncDirtyFilmSet, film_work_ids, source_type: str,
+                          state: State, values: dict):
+        """Отмечает фильмы грязными и записывает values в состояние одной транзакцией MULTI/EXEC."""
+        async with doc_queue.redis.pipeline(transaction=True) as pipe:
+            dirty_set.stage_add(pipe, film_work_ids, source_type)
+            applied = state.stage(pipe, values)
+            await pipe.execute()
+        # Функция после транзакции синхронно пишет в хранилище состояния, если то не Redis
+        await asyncio.to_thread(applied)
+
+    async def _flush(self, dirty_set: AsyncDirtyFilmSet, merger, transformer, doc_queue: AsyncRedisStreamQueue):
+        """
+        Собирает каждый грязный фильм один раз, пока множество не опустеет.
+        Пачка удаляется из множества в одной транзакции с записью её документов в очередь.
+        """
+        async with self._flush_lock:
+            async for film_work_ids in dirty_set.batches(self.settings.batch_size):
+                await self._push_films(film_work_ids, merger, transformer, doc_queue,
+                                       lambda pipe, ids=film_work_ids: dirty_set.stage_remove(pipe, ids))
+            dirty_set.end_cycle()
+
+    async def _apply_renames(self, partial: PartialUpdater, source_type: str, renames: dict, enricher: AsyncPostgresEnricher,
+                             dirty_set: AsyncDirtyFilmSet, merger, transformer, doc_queue: AsyncRedisStreamQueue):
+        """
+        Применяет переименования скриптом, только если очередь документов пуста, иначе пересобирает
+        их фильмы (см. PartialUpdater.apply_renames). Проверка и обновление идут под блокировкой
+        сборки: пока они выполняются, другие обработчики не кладут в очередь документы.
+        Фильмы, которые не удалось обновить частично, тоже пересобираются.
+        """
+        if not renames:
+            return
+        async with self._flush_lock:
+            if await doc_queue.length():
+                logging.info(f"Очередь '{doc_queue.stream}' не пуста: переименования '{source_type}' "
+                             f"({len(renames)}) применяются пересборкой фильмов.")
+                async for film_work_ids in enricher.iter_film_ids(list(renames), source_type):
+                    await dirty_set.add(film_work_ids, source_type)
+            else:
+                with track_stage('partial_update', rows_in=len(renames)) as batch:
+                    failed = await asyncio.to_thread(partial.apply_renames, source_type, renames)
+                    batch.rows_out = len(renames)
+                await dirty_set.add(failed, source_type)
+        await self._flush(dirty_set, merger, transformer, doc_queue)
+
+    async def _push_films(self, film_work_ids, merger, transformer, doc_queue, stage=None):
+        with track_stage('merge', rows_in=len(film_work_ids)) as batch:
+            raw_data = await merger.fetch(film_work_ids, self.settings.merge_mode)
+            batch.rows_out = len(raw_data)
+        with track_stage('transform', rows_in=len(raw_data)) as batch:
+            documents = transformer.transform(raw_data, self.settings.merge_mode)
+            batch.rows_out = len(documents)
+        with track_stage('queue_push', rows_in=len(documents)) as batch:
+            batch.bytes = await doc_queue.push(documents, stage)
+            batch.rows_out = len(documents)
+
+    async def _load(self, loader: AsyncElasticsearchLoader, doc_queue: AsyncRedisStreamQueue):
+        """Непрерывно разбирает очередь Redis в Elasticsearch параллельно с остальными стадиями."""
+        block_ms = self.settings.sleep_time * 1000
+        while True:
+            messages = await doc_queue.read(self.settings.batch_size, block_ms=block_ms)
+            if not messages:
+                continue
+            records, versions = latest_documents(messages)
+            with track_stage('bulk_load', rows_in=len(records)) as batch:
+                result = await loader.load_to_es(records, versions)
+                batch.rows_out, batch.bytes = result.success, result.bytes
+            observe_result(result)
+            await doc_queue.ack([message.id for message in messages], result.failed)
+            QUEUE_DEPTH.labels(doc_queue.stream).set(await doc_queue.length())
@@ -0,0 +1 @@
+"""Бенчмарки ETL. Запускаются из каталога postgres_to_es: python -m benchmarks.<имя>."""
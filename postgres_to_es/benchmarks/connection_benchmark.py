@@ -0,0 +1,78 @@
+"""
+Задержка одного цикла ETL: переподключение на каждый цикл с клиентской подстановкой
+списков IN (%s,%s,...) против пула соединений с серверной привязкой = ANY(%s::uuid[])
+и подготовленными запросами.
+
+Цикл здесь — выборка страницы film_work продюсером и слияние данных этих фильмов.
+
+Запуск: python -m benchmarks.connection_benchmark --cycles 200
+"""
+import argparse
+import statistics
+import time
+
+from psycopg import ClientCursor
+
+from config import settings
+from merger import PostgresMerger
+from producer import PostgresProducer
+from utils import connect_pg, pg_pool_context
+
+
+class MemoryState:
+    """Неизменяемое состояние: каждый цикл читает одну и ту же страницу."""
+
+    def get_state(self, key, default=None):
+        return default
+
+
+def legacy_cycle(table, batch_size):
+    """Прежний путь: новое соединение, ClientCursor, плейсхолдеры по числу id."""
+    conn = connect_pg(**settings.pg.to_dict(), cursor_factory=ClientCursor)
+    try:
+        producer = PostgresProducer(conn, MemoryState(), table, batch_size)
+        rows = producer.extract()
+        film_ids = [str(row[0]) for row in rows]
+        placeholders = ','.join(['%s'] * len(film_ids))
+        with conn.cursor() as cur:
+            cur.execute(f"{PostgresMerger.AGGREGATED_SELECT} WHERE fw.id IN ({placeholders});", film_ids)
+            cur.fetchall()
+    finally:
+        conn.close()
+
+
+def pooled_cycle(pool, table, batch_size):
+    with pool.connection() as conn:
+        producer = PostgresProducer(conn, MemoryState(), table, batch_size)
+        rows = producer.extract()
+        PostgresMerger(conn, batch_size).fetch_aggregated_data([row[0] for row in rows])
+
+
+def measure(cycle, cycles):
+    timings = []
+    for _ in range(cycles):
+        started = time.perf_counter()
+        cycle()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), statistics.quantiles(timings, n=20)[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cycles', type=int, default=200)
+    parser.add_argument('--batch', type=int, default=settings.batch_size)
+    args = parser.parse_args()
+
+    table = 'content.film_work'
+    legacy = measure(lambda: legacy_cycle(table, args.batch), args.cycles)
+    with pg_pool_context(min_size=1, max_size=1, prepare_threshold=settings.pg_prepare_threshold, **settings.pg.to_dict()) as pool:
+        pooled = measure(lambda: pooled_cycle(pool, table, args.batch), args.cycles)
+
+    print(f"{'mode':<10}{'median, ms':>12}{'p95, ms':>10}")
+    print(f"{'legacy':<10}{legacy[0]:>12.2f}{legacy[1]:>10.2f}")
+    print(f"{'pooled':<10}{pooled[0]:>12.2f}{pooled[1]:>10.2f}")
+    print(f"\nЭкономия на цикл: {legacy[0] - pooled[0]:.2f} мс (медиана).")
+
+
+if __name__ == '__main__':
+    main()
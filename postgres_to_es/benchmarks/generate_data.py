@@ -0,0 +1,158 @@
+"""
+Генератор синтетического каталога в схеме content.* для нагрузочных замеров.
+
+Данные генерируются на стороне PostgreSQL (generate_series, gen_random_uuid), поэтому
+10 млн фильмов не проходят через Python. Распределения скошены, как в реальном каталоге:
+- размер состава фильма — экспоненциальный со средним --mean-cast, не больше --max-cast;
+- популярность персон — степенная: персона с номером n выбирается с вероятностью,
+  убывающей по n (показатель --person-skew), так что у немногих персон тысячи фильмов;
+- популярность жанров — так же (показатель --genre-skew), у фильма от 1 до 3 жанров.
+updated_at разбросаны по последнему году, чтобы продюсеры шли по многим страницам.
+
+Фильмы вставляются порциями по --chunk с фиксацией после каждой.
+
+Запуск: python -m benchmarks.generate_data --films 100000 --truncate
+"""
+import argparse
+import time
+
+from psycopg import sql
+
+from config import settings
+from utils import pg_conn_context
+
+TRUNCATE = """
+    TRUNCATE content.person_film_work, content.genre_film_work,
+             content.film_work, content.person, content.genre;
+"""
+
+# Отдельные запросы: соединение привязывает параметры на сервере, а подготовленный запрос
+# не может содержать несколько команд. CREATE TABLE AS параметров не принимает, поэтому
+# количества подставляются литералами.
+SETUP = [
+    """
+    CREATE TEMP TABLE gen_person AS
+        SELECT n, gen_random_uuid() AS id FROM generate_series(1, {persons}) n;
+    """,
+    "CREATE UNIQUE INDEX ON gen_person (n);",
+    """
+    CREATE TEMP TABLE gen_genre AS
+        SELECT n, gen_random_uuid() AS id FROM generate_series(1, {genres}) n;
+    """,
+    "CREATE UNIQUE INDEX ON gen_genre (n);",
+    """
+    INSERT INTO content.person (id, full_name, created_at, updated_at)
+    SELECT id, 'Person ' || n, ts, ts
+    FROM (SELECT id, n, now() - random() * interval '365 days' AS ts FROM gen_person) p;
+    """,
+    """
+    INSERT INTO content.genre (id, name, description, created_at, updated_at)
+    SELECT id, 'Genre ' || n, 'Synthetic genre ' || n, ts, ts
+    FROM (SELECT id, n, now() - random() * interval '365 days' AS ts FROM gen_genre) g;
+    """,
+]
+
+# Одна порция фильмов со связями. CTE с volatile-функциями материализуются один раз,
+# поэтому связи ссылаются на те же id, что попали в film_work. Типы параметров указаны явно:
+# небольшие числа привязываются как smallint, и generate_series становится неоднозначной.
+FILMS_CHUNK = """
+    WITH src AS (
+        SELECT n,
+               gen_random_uuid() AS id,
+               now() - random() * interval '365 days' AS ts,
+               least(%(max_cast)s::int, 1 + floor(-ln(1 - random()) * %(mean_cast)s::float8))::int AS cast_size,
+               1 + floor(random() * 3)::int AS genre_count
+        FROM generate_series(%(first)s::int, %(last)s::int) n
+    ), films AS (
+        INSERT INTO content.film_work (id, title, description, creation_date, rating, type, created_at, updated_at)
+        SELECT id,
+               'Movie ' || n,
+               'Synthetic description ' || md5(n::text),
+               date '1950-01-01' + (random() * 27000)::int,
+               round((1 + random() * 9)::numeric, 1),
+               CASE WHEN random() < 0.8 THEN 'movie' ELSE 'tv_show' END,
+               ts, ts
+        FROM src
+        RETURNING id
+    ), cast_slots AS (
+        SELECT DISTINCT ON (src.id, person_n) src.id AS film_work_id, person_n, src.ts, r
+        FROM src,
+             LATERAL generate_series(1, src.cast_size) slot,
+             LATERAL (SELECT 1 + floor(%(persons)s::int * power(random(), %(person_skew)s::float8))::int AS person_n,
+                             random() AS r, slot) pick
+    ), persons AS (
+        INSERT INTO content.person_film_work (id, person_id, film_work_id, role, created_at)
+        SELECT gen_random_uuid(), p.id, c.film_work_id,
+               CASE WHEN c.r < 0.8 THEN 'actor' WHEN c.r < 0.92 THEN 'writer' ELSE 'director' END,
+               c.ts
+        FROM cast_slots c
+        JOIN gen_person p ON p.n = c.person_n
+        RETURNING 1
+    ), genre_slots AS (
+        SELECT DISTINCT src.id AS film_work_id, genre_n, src.ts
+        FROM src,
+             LATERAL generate_series(1, src.genre_count) slot,
+             LATERAL (SELECT 1 + floor(%(genres)s::int * power(random(), %(genre_skew)s::float8))::int AS genre_n, slot) pick
+    ), genres AS (
+        INSERT INTO content.genre_film_work (id, genre_id, film_work_id, created_at)
+        SELECT gen_random_uuid(), g.id, s.film_work_id, s.ts
+        FROM genre_slots s
+        JOIN gen_genre g ON g.n = s.genre_n
+        RETURNING 1
+    )
+    SELECT (SELECT count(*) FROM films), (SELECT count(*) FROM persons), (SELECT count(*) FROM genres);
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--films', type=int, default=10000, help='Количество фильмов (10 тыс. — 10 млн)')
+    parser.add_argument('--persons', type=int, default=None, help='Количество персон (по умолчанию films / 2)')
+    parser.add_argument('--genres', type=int, default=50)
+    parser.add_argument('--mean-cast', type=float, default=8, help='Средний размер состава фильма')
+    parser.add_argument('--max-cast', type=int, default=200)
+    parser.add_argument('--person-skew', type=float, default=3, help='Показатель степенной популярности персон')
+    parser.add_argument('--genre-skew', type=float, default=2, help='Показатель степенной популярности жанров')
+    parser.add_argument('--chunk', type=int, default=50000, help='Фильмов в одной транзакции')
+    parser.add_argument('--truncate', action='store_true', help='Очистить каталог перед генерацией')
+    args = parser.parse_args()
+
+    params = {
+        'persons': args.persons or max(1000, args.films // 2),
+        'genres': args.genres,
+        'mean_cast': args.mean_cast,
+        'max_cast': args.max_cast,
+        'person_skew': args.person_skew,
+        'genre_skew': args.genre_skew,
+    }
+
+    started = time.perf_counter()
+    with pg_conn_context(**settings.pg.to_dict()) as pg_conn:
+        with pg_conn.transaction(), pg_conn.cursor() as cur:
+            if args.truncate:
+                cur.execute(TRUNCATE)
+            literals = {'persons': sql.Literal(params['persons']), 'genres': sql.Literal(params['genres'])}
+            for statement in SETUP:
+                cur.execute(sql.SQL(statement).format(**literals))
+        print(f"Создано персон: {params['persons']}, жанров: {params['genres']}.")
+
+        totals = [0, 0, 0]
+        for first in range(1, args.films + 1, args.chunk):
+            last = min(first + args.chunk - 1, args.films)
+            with pg_conn.transaction(), pg_conn.cursor() as cur:
+                cur.execute(FILMS_CHUNK, params | {'first': first, 'last': last})
+                counts = cur.fetchone()
+            totals = [total + count for total, count in zip(totals, counts)]
+            elapsed = time.perf_counter() - started
+            print(f"Фильмов {totals[0]}/{args.films}, связей с персонами {totals[1]}, с жанрами {totals[2]} "
+                  f"({totals[0] / elapsed:.0f} фильмов/сек.)")
+
+        pg_conn.autocommit = True
+        pg_conn.execute("ANALYZE content.film_work, content.person, content.genre, "
+                        "content.person_film_work, content.genre_film_work;")
+
+    print(f"\nГотово за {time.perf_counter() - started:.1f} сек.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Сравнение режимов слияния PostgresMerger: 'flat' (JOIN со строкой на каждую пару
+персона/жанр) и 'aggregated' (одна строка на фильм).
+
+Запуск: python -m benchmarks.merge_benchmark --films 1000 --repeat 5
+"""
+import argparse
+import statistics
+import time
+
+from config import settings
+from enricher import PostgresEnricher
+from merger import PostgresMerger
+from transformer import PostgresTransformer
+from utils import pg_conn_context
+
+
+def pick_film_ids(pg_conn, limit):
+    """Берёт фильмы с самым большим составом — на них разница режимов заметнее всего."""
+    query = """
+        SELECT fw.id
+        FROM content.film_work fw
+        LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
+        GROUP BY fw.id
+        ORDER BY count(pfw.id) DESC, fw.id
+        LIMIT %s;
+    """
+    with pg_conn.cursor() as cur:
+        cur.execute(query, (limit,))
+        return [row[0] for row in cur.fetchall()]
+
+
+def run_mode(merger, transformer, film_ids, mode, repeat):
+    timings = []
+    rows_count = docs_count = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        rows = merger.fetch(film_ids, mode)
+        docs = transformer.transform(rows, mode)
+        timings.append(time.perf_counter() - started)
+        rows_count, docs_count = len(rows), len(docs)
+    return {
+        'mode': mode,
+        'rows': rows_count,
+        'docs': docs_count,
+        'median_s': statistics.median(timings),
+        'min_s': min(timings),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--films', type=int, default=1000, help='Количество фильмов в одной выборке')
+    parser.add_argument('--repeat', type=int, default=5, help='Количество повторов для каждого режима')
+    args = parser.parse_args()
+
+    with pg_conn_context(**settings.pg.to_dict()) as pg_conn:
+        merger = PostgresMerger(pg_conn, settings.batch_size)
+        transformer = PostgresTransformer(PostgresEnricher(pg_conn, settings.batch_size))
+        film_ids = pick_film_ids(pg_conn, args.films)
+
+        results = [run_mode(merger, transformer, film_ids, mode, args.repeat) for mode in ('flat', 'aggregated')]
+
+    print(f"{'mode':<12}{'rows':>10}{'docs':>8}{'median, s':>12}{'min, s':>10}")
+    for r in results:
+        print(f"{r['mode']:<12}{r['rows']:>10}{r['docs']:>8}{r['median_s']:>12.4f}{r['min_s']:>10.4f}")
+
+    flat, aggregated = results
+    if aggregated['median_s']:
+        print(f"\nСтрок передано меньше в {flat['rows'] / max(aggregated['rows'], 1):.1f} раз, "
+              f"ускорение {flat['median_s'] / aggregated['median_s']:.2f}x.")
+
+
+if __name__ == '__main__':
+    main()
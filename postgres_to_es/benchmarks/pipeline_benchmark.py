@@ -0,0 +1,345 @@
+"""
+Нагрузочные замеры стадий ETL и конвейера целиком на локальном PostgreSQL.
+
+Стадии:
+- extract   — PostgresProducer.extract, keyset-страницы film_work;
+- enrich    — PostgresEnricher.enrich, разворачивание страниц персон в фильмы;
+- merge     — PostgresMerger.fetch для страниц фильмов (режим --merge-mode);
+- transform — PostgresTransformer.transform на заранее выбранных строках;
+- load      — ElasticsearchLoader.load_to_es на заранее собранных документах;
+- pipeline  — process_sources по всем источникам с загрузкой, с нуля до конца каталога
+              (или --max-cycles циклов).
+
+Elasticsearch по умолчанию заменён узлом транспорта в памяти процесса: клиент, сериализация
+и helpers.bulk работают как обычно, а ответ на _bulk строится без сети (--es-url — настоящий
+кластер). Redis для конвейера — из настроек или fakeredis (--redis fake).
+
+Каждая стадия выполняется в отдельном процессе, поэтому пиковый RSS относится к ней одной.
+Результаты (пропускная способность, перцентили задержки пачки, пиковый RSS) печатаются
+таблицей и пишутся в JSON (--output) для отслеживания регрессий.
+
+Каталог нужного размера готовит benchmarks.generate_data.
+
+Запуск: python -m benchmarks.pipeline_benchmark --batches 50 --output results.json
+"""
+import argparse
+import json
+import platform
+import resource
+import statistics
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from multiprocessing import get_context
+from typing import Any, Dict
+
+from elastic_transport import ApiResponseMeta, BaseNode, HttpHeaders
+from elastic_transport._node._base import NodeApiResponse
+from elasticsearch import Elasticsearch
+
+from config import settings
+from dirty_set import DirtyFilmSet
+from doc_queue import RedisStreamQueue
+from enricher import PostgresEnricher
+from loader import ElasticsearchLoader
+from main import load_data_to_es, process_sources
+from merger import PostgresMerger
+from producer import PostgresProducer
+from state import BaseStorage, State
+from transformer import PostgresTransformer
+from utils import pg_conn_context, redis_conn_context
+
+STAGES = ['extract', 'enrich', 'merge', 'transform', 'load', 'pipeline']
+
+
+class MemoryStorage(BaseStorage):
+    """Состояние в памяти: каждый замер начинает с начала источников."""
+
+    def __init__(self):
+        self.state = {}
+
+    def save_state(self, state: Dict[str, Any]) -> None:
+        self.state = dict(state)
+
+    def retrieve_state(self) -> Dict[str, Any]:
+        return dict(self.state)
+
+
+class InMemoryNode(BaseNode):
+    """
+    Узел транспорта Elasticsearch без сети: принимает _bulk и отвечает успехом
+    на каждое действие. Документы не хранятся, считаются только их количество и объём.
+    """
+    documents = 0
+    bytes = 0
+
+    def perform_request(self, method, target, body=None, headers=None, request_timeout=None):
+        started = time.perf_counter()
+        response = {}
+        if target.split('?')[0].endswith('/_bulk'):
+            items = []
+            lines = body.splitlines()
+            i = 0
+            while i < len(lines):
+                (op_type, meta), = json.loads(lines[i]).items()
+                has_source = op_type != 'delete'
+                if has_source:
+                    InMemoryNode.bytes += len(lines[i + 1])
+                items.append({op_type: {'_index': meta.get('_index'), '_id': meta.get('_id'), 'status': 200}})
+                i += 2 if has_source else 1
+            InMemoryNode.documents += len(items)
+            response = {'took': 0, 'errors': False, 'items': items}
+        meta = ApiResponseMeta(
+            status=200,
+            http_version='1.1',
+            headers=HttpHeaders({'content-type': 'application/json', 'x-elastic-product': 'Elasticsearch'}),
+            duration=time.perf_counter() - started,
+            node=self.config,
+        )
+        return NodeApiResponse(meta, json.dumps(response).encode())
+
+
+def connect_es(es_url):
+    if es_url:
+        return Elasticsearch(hosts=[es_url])
+    return Elasticsearch(hosts=['http://standin:9200'], node_class=InMemoryNode)
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss в Linux — в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def summarize(stage, timings, items):
+    total = sum(timings)
+    timings_ms = sorted(t * 1000 for t in timings)
+    quantiles = statistics.quantiles(timings_ms, n=100, method='inclusive') if len(timings_ms) > 1 else timings_ms * 99
+    return {
+        'stage': stage,
+        'batches': len(timings),
+        'items': items,
+        'seconds': round(total, 4),
+        'items_per_sec': round(items / total, 1) if total else None,
+        'p50_ms': round(quantiles[49], 3),
+        'p95_ms': round(quantiles[94], 3),
+        'p99_ms': round(quantiles[98], 3),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - started, result
+
+
+def film_pages(pg_conn, batch_size, batches):
+    """Первые страницы id фильмов в порядке продюсера."""
+    producer = PostgresProducer(pg_conn, State(MemoryStorage()), 'content.film_work', batch_size)
+    pages = []
+    for _ in range(batches):
+        rows = producer.extract()
+        if not rows:
+            break
+        pages.append([row[0] for row in rows])
+        producer.state.set_states(producer.cursor_values(rows))
+    return pages
+
+
+def bench_extract(pg_conn, args):
+    producer = PostgresProducer(pg_conn, State(MemoryStorage()), 'content.film_work', args['batch_size'])
+    timings, items = [], 0
+    for _ in range(args['batches']):
+        elapsed, rows = timed(producer.extract)
+        if not rows:
+            break
+        timings.append(elapsed)
+        items += len(rows)
+        producer.state.set_states(producer.cursor_values(rows))
+    return timings, items
+
+
+def bench_enrich(pg_conn, args):
+    producer = PostgresProducer(pg_conn, State(MemoryStorage()), 'content.person', args['batch_size'])
+    enricher = PostgresEnricher(pg_conn, args['batch_size'])
+    timings, items = [], 0
+    for _ in range(args['batches']):
+        rows = producer.extract()
+        if not rows:
+            break
+        elapsed, film_ids = timed(enricher.enrich, [row[0] for row in rows], 'person')
+        timings.append(elapsed)
+        items += len(film_ids)
+        producer.state.set_states(producer.cursor_values(rows))
+    return timings, items
+
+
+def bench_merge(pg_conn, args):
+    merger = PostgresMerger(pg_conn, args['batch_size'])
+    timings, items = [], 0
+    for film_ids in film_pages(pg_conn, args['batch_size'], args['batches']):
+        elapsed, rows = timed(merger.fetch, film_ids, args['merge_mode'])
+        timings.append(elapsed)
+        items += len(rows)
+    return timings, items
+
+
+def bench_transform(pg_conn, args):
+    merger = PostgresMerger(pg_conn, args['batch_size'])
+    transformer = PostgresTransformer(PostgresEnricher(pg_conn, args['batch_size']))
+    pages = [merger.fetch(film_ids, args['merge_mode']) for film_ids in film_pages(pg_conn, args['batch_size'], args['batches'])]
+    timings, items = [], 0
+    for rows in pages:
+        elapsed, docs = timed(transformer.transform, rows, args['merge_mode'])
+        timings.append(elapsed)
+        items += len(docs)
+    return timings, items
+
+
+def bench_load(pg_conn, args):
+    merger = PostgresMerger(pg_conn, args['batch_size'])
+    transformer = PostgresTransformer(PostgresEnricher(pg_conn, args['batch_size']))
+    pages = [
+        transformer.transform(merger.fetch(film_ids, args['merge_mode']), args['merge_mode'])
+        for film_ids in film_pages(pg_conn, args['batch_size'], args['batches'])
+    ]
+    loader = ElasticsearchLoader(connect_es(args['es_url']), args['index'], chunk_size=settings.es.bulk_chunk_size)
+    timings, items = [], 0
+    for docs in pages:
+        elapsed, result = timed(loader.load_to_es, docs)
+        timings.append(elapsed)
+        items += result.success
+    return timings, items
+
+
+class CountingLoader(ElasticsearchLoader):
+    """Загрузчик, считающий успешно загруженные документы для итогов конвейера."""
+    loaded = 0
+
+    def load_to_es(self, records, versions=None):
+        result = super().load_to_es(records, versions)
+        self.loaded += result.success
+        return result
+
+
+def bench_pipeline(pg_conn, args):
+    if args['redis'] == 'fake':
+        import fakeredis
+        server = fakeredis.FakeServer()
+        redis_connection = fakeredis.FakeRedis(server=server, decode_responses=True)
+        queue_connection = fakeredis.FakeRedis(server=server)
+        return run_pipeline(pg_conn, args, redis_connection, queue_connection)
+
+    with redis_conn_context(**settings.redis.to_dict()) as redis_connection, \
+         redis_conn_context(**settings.redis.to_dict() | {'decode_responses': False}) as queue_connection:
+        return run_pipeline(pg_conn, args, redis_connection, queue_connection)
+
+
+def run_pipeline(pg_conn, args, redis_connection, queue_connection):
+    loader = CountingLoader(connect_es(args['es_url']), args['index'], chunk_size=settings.es.bulk_chunk_size)
+    # Отдельные поток и множество, чтобы не задеть очередь рабочего окружения
+    doc_queue = RedisStreamQueue(queue_connection, f"{settings.queue_stream}:benchmark", settings.queue_group,
+                                 codec=settings.queue_codec, entry_size=args['batch_size'])
+    dirty_set = DirtyFilmSet(redis_connection, f"{settings.dirty_set_key}:benchmark")
+    producers = {
+        config.source_type: PostgresProducer(pg_conn, State(MemoryStorage()), config.table, args['batch_size'])
+        for config in settings.producer_configs
+    }
+    enricher = PostgresEnricher(pg_conn, args['batch_size'])
+    merger = PostgresMerger(pg_conn, args['batch_size'])
+    transformer = PostgresTransformer(enricher)
+    configs = [config.model_dump() for config in settings.producer_configs]
+
+    timings, cycles = [], 0
+    while args['max_cycles'] is None or cycles < args['max_cycles']:
+        started = time.perf_counter()
+        rows_counts = process_sources(configs, producers, enricher, merger, transformer, doc_queue, dirty_set,
+                                      on_chunk=lambda: load_data_to_es(loader, doc_queue))
+        load_data_to_es(loader, doc_queue)
+        timings.append(time.perf_counter() - started)
+        cycles += 1
+        if all(count < args['batch_size'] for count in rows_counts.values()):
+            break
+    queue_connection.delete(doc_queue.stream)
+    return timings, loader.loaded
+
+
+BENCHMARKS = {
+    'extract': bench_extract,
+    'enrich': bench_enrich,
+    'merge': bench_merge,
+    'transform': bench_transform,
+    'load': bench_load,
+    'pipeline': bench_pipeline,
+}
+
+
+def run_stage(stage, args):
+    """Выполняется в отдельном процессе: пиковый RSS — только этой стадии."""
+    with pg_conn_context(**settings.pg.to_dict(), autocommit=True) as pg_conn:
+        timings, items = BENCHMARKS[stage](pg_conn, args)
+    if not timings:
+        return {'stage': stage, 'batches': 0, 'items': 0}
+    return summarize(stage, timings, items)
+
+
+def collect_meta(args):
+    with pg_conn_context(**settings.pg.to_dict(), autocommit=True) as pg_conn, pg_conn.cursor() as cur:
+        cur.execute("SELECT (SELECT count(*) FROM content.film_work), (SELECT count(*) FROM content.person), "
+                    "(SELECT count(*) FROM content.person_film_work);")
+        films, persons, links = cur.fetchone()
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'films': films,
+        'persons': persons,
+        'person_links': links,
+        'batch_size': args['batch_size'],
+        'merge_mode': args['merge_mode'],
+        'elasticsearch': args['es_url'] or 'in-process',
+        'redis': args['redis'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--batches', type=int, default=50, help='Пачек на стадию (кроме pipeline)')
+    parser.add_argument('--batch-size', type=int, default=settings.batch_size)
+    parser.add_argument('--merge-mode', choices=['aggregated', 'flat'], default=settings.merge_mode)
+    parser.add_argument('--max-cycles', type=int, default=None, help='Ограничение циклов конвейера')
+    parser.add_argument('--es-url', default=None, help='Настоящий Elasticsearch вместо узла в памяти')
+    parser.add_argument('--index', default=f"{settings.es.index}_benchmark")
+    parser.add_argument('--redis', choices=['real', 'fake'], default='real',
+                        help="'fake' — fakeredis в памяти процесса (нужен пакет fakeredis)")
+    parser.add_argument('--output', default='benchmark_results.json')
+    args = vars(parser.parse_args())
+
+    meta = collect_meta(args)
+    results = []
+    for stage in args['stages']:
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+            results.append(executor.submit(run_stage, stage, args).result())
+
+    print(f"Фильмов: {meta['films']}, персон: {meta['persons']}, пачка: {args['batch_size']}\n")
+    print(f"{'stage':<11}{'batches':>8}{'items':>10}{'items/s':>11}{'p50, ms':>10}{'p95, ms':>10}{'p99, ms':>10}{'RSS, MB':>9}")
+    for r in results:
+        if not r['batches']:
+            print(f"{r['stage']:<11}{'нет данных':>8}")
+            continue
+        print(f"{r['stage']:<11}{r['batches']:>8}{r['items']:>10}{r['items_per_sec'] or 0:>11.0f}"
+              f"{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}{r['peak_rss_mb']:>9.1f}")
+
+    with open(args['output'], 'w', encoding='utf-8') as f:
+        json.dump({'meta': meta, 'results': results}, f, ensure_ascii=False, indent=2)
+    print(f"\nРезультаты записаны в {args['output']}.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Сравнение кодеков очереди документов: байт на документ и время кодирования/декодирования.
+
+Запуск: python -m benchmarks.serializer_benchmark --docs 10000 --batch 100
+"""
+import argparse
+import random
+import time
+import uuid
+
+from serializers import get_codec
+
+CODECS = ['json', 'json+zstd', 'json+lz4', 'msgpack', 'msgpack+zstd', 'msgpack+lz4']
+
+
+def make_document(rng: random.Random) -> dict:
+    """Документ той же формы, что выдаёт PostgresTransformer."""
+    def people(n):
+        return [{'id': str(uuid.UUID(int=rng.getrandbits(128))), 'name': f"Person {rng.randint(1, 10 ** 6)}"} for _ in range(n)]
+
+    actors, writers, directors = people(rng.randint(1, 40)), people(rng.randint(0, 5)), people(rng.randint(0, 2))
+    return {
+        'id': str(uuid.UUID(int=rng.getrandbits(128))),
+        'title': f"Movie {rng.randint(1, 10 ** 6)}",
+        'description': ' '.join(rng.choice(['star', 'war', 'space', 'hero', 'dark', 'light']) for _ in range(40)),
+        'imdb_rating': round(rng.uniform(1, 10), 1),
+        'genres': rng.sample(['Action', 'Drama', 'Comedy', 'Sci-Fi', 'Horror', 'Documentary'], rng.randint(1, 3)),
+        'actors': actors,
+        'writers': writers,
+        'directors': directors,
+        'actors_names': [p['name'] for p in actors],
+        'writers_names': [p['name'] for p in writers],
+        'directors_names': [p['name'] for p in directors],
+    }
+
+
+def bench_codec(name, batches, docs_count):
+    try:
+        codec = get_codec(name)
+    except ImportError as e:
+        return {'codec': name, 'error': str(e)}
+
+    started = time.perf_counter()
+    encoded = [codec.encode(batch) for batch in batches]
+    encode_s = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for payload in encoded:
+        codec.decode(payload)
+    decode_s = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for payload in encoded:
+        if codec.raw_documents(payload) is None:
+            passthrough_s = None
+            break
+    else:
+        passthrough_s = time.perf_counter() - started
+
+    return {
+        'codec': name,
+        'bytes_per_doc': sum(len(p) for p in encoded) / docs_count,
+        'encode_us': encode_s / docs_count * 1e6,
+        'decode_us': decode_s / docs_count * 1e6,
+        'passthrough_us': passthrough_s / docs_count * 1e6 if passthrough_s is not None else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--docs', type=int, default=10000, help='Количество документов')
+    parser.add_argument('--batch', type=int, default=100, help='Документов в одном сообщении очереди')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    docs = [make_document(rng) for _ in range(args.docs)]
+    batches = [docs[i:i + args.batch] for i in range(0, len(docs), args.batch)]
+
+    print(f"{'codec':<14}{'bytes/doc':>11}{'encode, us':>12}{'decode, us':>12}{'raw, us':>10}")
+    for name in CODECS:
+        r = bench_codec(name, batches, len(docs))
+        if 'error' in r:
+            print(f"{name:<14}  пропущен: {r['error']}")
+            continue
+        raw = f"{r['passthrough_us']:>10.2f}" if r['passthrough_us'] is not None else f"{'-':>10}"
+        print(f"{name:<14}{r['bytes_per_doc']:>11.0f}{r['encode_us']:>12.2f}{r['decode_us']:>12.2f}{raw}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Масштабирование шардированного режима: полная выгрузка каталога процессами
+`main.py worker` при разном их числе.
+
+Для каждого числа процессов состояния шардов, аренды и очередь документов сбрасываются,
+запускаются процессы, и замеряется время до момента, когда все курсоры шардов дошли
+до конца источников, а очередь опустела. Отпечатки документов на время замера выключены,
+иначе второй прогон пропускал бы неизменившиеся документы.
+
+Сбрасывает состояния шардов в Redis из настроек — не запускать на рабочем окружении.
+
+Запуск: python -m benchmarks.shard_scaling_benchmark --workers 1 2 4 --shards 8
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from config import settings
+from producer import PostgresProducer
+from sharding import Shard
+from state import State, RedisStorage
+from utils import pg_conn_context, redis_conn_context
+
+APP_DIR = Path(__file__).resolve().parent.parent
+
+
+def reset(redis_connection, shard_count):
+    """Удаляет всё, что процессы накопили для шардов: следующий прогон начнёт с нуля."""
+    keys = [settings.queue_stream, f"{settings.shard_key_prefix}:workers"]
+    keys += [f"{settings.shard_key_prefix}:lease:{index}" for index in range(shard_count)]
+    for index in range(shard_count):
+        shard = Shard(index, shard_count)
+        keys += [shard.key(config.state_key) for config in settings.producer_configs]
+        keys += [shard.key(settings.dirty_set_key)]
+        keys += [f"{shard.key(settings.snapshot_key_prefix)}:{source}" for source in ('person', 'genre')]
+    redis_connection.delete(*keys)
+
+
+def remaining(pg_conn, redis_connection, shard_count):
+    """Сколько строк источников ещё не пройдено курсорами шардов."""
+    total = 0
+    for index in range(shard_count):
+        shard = Shard(index, shard_count)
+        for config in settings.producer_configs:
+            state = State(RedisStorage(redis_connection, shard.key(config.state_key)))
+            producer = PostgresProducer(pg_conn, state, config.table, shard=None if config.enrich else shard)
+            total += producer.count_remaining()
+    return total
+
+
+def film_count(pg_conn):
+    with pg_conn.cursor() as cur:
+        cur.execute("SELECT count(*) FROM content.film_work;")
+        return cur.fetchone()[0]
+
+
+def run(workers, shard_count, timeout, pg_conn, redis_connection):
+    reset(redis_connection, shard_count)
+    env = os.environ | {
+        'SHARD_COUNT': str(shard_count),
+        'SHARD_WORKERS': 'true',
+        'FINGERPRINT_CACHE': 'false',
+        'SLEEP_TIME': '1',
+        # Процессы на одной машине не могут делить порт метрик
+        'METRICS_PORT': '0',
+    }
+    started = time.perf_counter()
+    processes = [
+        subprocess.Popen([sys.executable, 'main.py', 'worker'], cwd=APP_DIR, env=env,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        for _ in range(workers)
+    ]
+    try:
+        while time.perf_counter() - started < timeout:
+            if remaining(pg_conn, redis_connection, shard_count) == 0 and redis_connection.xlen(settings.queue_stream) == 0:
+                return time.perf_counter() - started
+            time.sleep(0.5)
+        raise TimeoutError(f"{workers} процессов не закончили выгрузку за {timeout} сек.")
+    finally:
+        # SIGINT даёт процессам отдать аренды шардов
+        for process in processes:
+            process.send_signal(signal.SIGINT)
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--shards', type=int, default=settings.shard_count)
+    parser.add_argument('--timeout', type=float, default=600)
+    args = parser.parse_args()
+
+    with redis_conn_context(**settings.redis.to_dict()) as redis_connection, \
+         pg_conn_context(**settings.pg.to_dict(), autocommit=True) as pg_conn:
+        films = film_count(pg_conn)
+        results = [(workers, run(workers, args.shards, args.timeout, pg_conn, redis_connection)) for workers in args.workers]
+
+    baseline = results[0][1]
+    print(f"Фильмов: {films}, шардов: {args.shards}\n")
+    print(f"{'workers':<10}{'elapsed, s':>12}{'films/s':>10}{'speedup':>10}")
+    for workers, elapsed in results:
+        print(f"{workers:<10}{elapsed:>12.2f}{films / elapsed:>10.0f}{baseline / elapsed:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+"""
+Микро-замер стадии transform: прежняя реализация против текущей на одинаковых строках.
+
+Прежняя реализация (воспроизведена здесь как legacy) получала строки словарями
+(dict(zip(colnames, row)) в PostgresMerger), собирала множества по ролям, отдельными
+проходами строила списки персон и имён, а документ затем кодировался json.dumps(..., default=str).
+Текущая распаковывает кортежи, группирует за один проход и сразу выдаёт байты (RawDocument).
+Поэтому в обоих случаях замеряется путь от строк PostgreSQL до JSON документа.
+
+Строки синтетические и без базы: id — uuid.UUID, как их возвращает psycopg; у плоского режима
+строка на каждую пару персона/жанр, как у JOIN. Перед замером проверяется, что обе реализации
+дают одинаковые документы (с точностью до порядка персон и жанров у прежней).
+
+Запуск: python -m benchmarks.transformer_benchmark --films 2000 --repeat 5
+"""
+import argparse
+import json
+import random
+import statistics
+import time
+import uuid
+
+from serializers import as_dict
+from transformer import PostgresTransformer
+
+FLAT_COLUMNS = ['fw_id', 'title', 'description', 'rating', 'role', 'person_id', 'full_name', 'genre_id', 'genre_name']
+AGGREGATED_COLUMNS = ['fw_id', 'title', 'description', 'rating', 'persons', 'genres']
+ROLES = ['actor'] * 8 + ['writer'] * 2 + ['director']
+GENRES = [(uuid.UUID(int=n), name) for n, name in enumerate(
+    ['Action', 'Drama', 'Comedy', 'Sci-Fi', 'Horror', 'Documentary', 'Animation', 'Thriller'], start=1)]
+
+
+def make_films(rng: random.Random, count: int, mean_cast: float):
+    """Фильмы в виде (строка фильма, [(роль, id, имя)], [(id жанра, имя)])."""
+    people = [(uuid.UUID(int=rng.getrandbits(128)), f"Person {n}") for n in range(max(1000, count // 2))]
+    films = []
+    for n in range(count):
+        film = (uuid.UUID(int=rng.getrandbits(128)), f"Movie {n}",
+                ' '.join(rng.choice(['star', 'war', 'space', 'hero', 'dark', 'light']) for _ in range(40)),
+                round(rng.uniform(1, 10), 1))
+        cast_size = min(200, 1 + int(rng.expovariate(1 / mean_cast)))
+        cast = [(rng.choice(ROLES), *person) for person in rng.sample(people, cast_size)]
+        films.append((film, cast, rng.sample(GENRES, rng.randint(1, 3))))
+    return films
+
+
+def flat_rows(films):
+    """Строки FLAT_SELECT: декартово произведение персон и жанров фильма."""
+    return [
+        (*film, role, person_id, name, genre_id, genre_name)
+        for film, cast, genres in films
+        for role, person_id, name in cast
+        for genre_id, genre_name in genres
+    ]
+
+
+def aggregated_rows(films):
+    """Строки AGGREGATED_SELECT: персоны по ролям (как после разбора json), жанры массивом."""
+    rows = []
+    for film, cast, genres in films:
+        persons = {}
+        for role, person_id, name in sorted(cast, key=lambda person: (person[2], person[1])):
+            persons.setdefault(role, []).append({'id': str(person_id), 'name': name})
+        rows.append((*film, persons, sorted(name for _, name in genres)))
+    return rows
+
+
+def legacy_transform_data(rows):
+    movies_data = {}
+    for row in rows:
+        fw_id = str(row['fw_id'])
+        if fw_id not in movies_data:
+            movies_data[fw_id] = {
+                'id': fw_id,
+                'title': row['title'],
+                'description': row['description'],
+                'imdb_rating': row['rating'],
+                '_genres': set(),
+                '_actors': set(),
+                '_writers': set(),
+                '_directors': set(),
+            }
+
+        if row['genre_id']:
+            movies_data[fw_id]['_genres'].add(row['genre_name'])
+
+        if row['person_id']:
+            person_tuple = (str(row['person_id']), row['full_name'])
+            role = row['role']
+            if role == 'actor':
+                movies_data[fw_id]['_actors'].add(person_tuple)
+            elif role == 'writer':
+                movies_data[fw_id]['_writers'].add(person_tuple)
+            elif role == 'director':
+                movies_data[fw_id]['_directors'].add(person_tuple)
+
+    final_list = []
+    for movie in movies_data.values():
+        movie['genres'] = list(movie['_genres'])
+        movie['actors'] = [{'id': pid, 'name': pname} for pid, pname in movie['_actors']]
+        movie['writers'] = [{'id': pid, 'name': pname} for pid, pname in movie['_writers']]
+        movie['directors'] = [{'id': pid, 'name': pname} for pid, pname in movie['_directors']]
+        movie['actors_names'] = [pname for _, pname in movie['_actors']]
+        movie['writers_names'] = [pname for _, pname in movie['_writers']]
+        movie['directors_names'] = [pname for _, pname in movie['_directors']]
+
+        del movie['_genres']
+        del movie['_actors']
+        del movie['_writers']
+        del movie['_directors']
+
+        final_list.append(movie)
+
+    return final_list
+
+
+def legacy_transform_aggregated_data(rows):
+    final_list = []
+    for row in rows:
+        persons = row['persons'] or {}
+        actors = persons.get('actor', [])
+        writers = persons.get('writer', [])
+        directors = persons.get('director', [])
+
+        final_list.append({
+            'id': str(row['fw_id']),
+            'title': row['title'],
+            'description': row['description'],
+            'imdb_rating': row['rating'],
+            'genres': list(row['genres'] or []),
+            'actors': actors,
+            'writers': writers,
+            'directors': directors,
+            'actors_names': [person['name'] for person in actors],
+            'writers_names': [person['name'] for person in writers],
+            'directors_names': [person['name'] for person in directors],
+        })
+
+    return final_list
+
+
+def legacy(rows, mode):
+    columns = FLAT_COLUMNS if mode == 'flat' else AGGREGATED_COLUMNS
+    dict_rows = [dict(zip(columns, row)) for row in rows]
+    documents = legacy_transform_data(dict_rows) if mode == 'flat' else legacy_transform_aggregated_data(dict_rows)
+    return [json.dumps(doc, default=str).encode('utf-8') for doc in documents]
+
+
+def normalized(doc: dict) -> dict:
+    """Документ без учёта порядка: прежняя реализация собирала персоны и жанры через множества."""
+    doc = dict(doc)
+    for key in ('actors', 'writers', 'directors'):
+        doc[key] = sorted((str(person['id']), person['name']) for person in doc[key])
+    for key in ('genres', 'actors_names', 'writers_names', 'directors_names'):
+        doc[key] = sorted(doc[key])
+    return doc
+
+
+def check_equivalent(rows, mode, transformer):
+    old = [normalized(json.loads(source)) for source in legacy(rows, mode)]
+    new = [normalized(as_dict(doc)) for doc in transformer.transform(rows, mode)]
+    if old != new:
+        raise AssertionError(f"Реализации дают разные документы в режиме '{mode}'.")
+
+
+def measure(func, batches, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for batch in batches:
+            func(batch)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--films', type=int, default=2000, help='Количество фильмов')
+    parser.add_argument('--batch', type=int, default=100, help='Фильмов в одной пачке трансформации')
+    parser.add_argument('--mean-cast', type=float, default=8, help='Средний размер состава фильма')
+    parser.add_argument('--repeat', type=int, default=5, help='Повторов, берётся медиана')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    films = make_films(random.Random(args.seed), args.films, args.mean_cast)
+    film_batches = [films[i:i + args.batch] for i in range(0, len(films), args.batch)]
+    transformer = PostgresTransformer(pg_enricher=None)
+
+    print(f"Фильмов: {args.films}, пачка: {args.batch}, средний состав: {args.mean_cast}\n")
+    print(f"{'mode':<12}{'rows':>10}{'legacy, s':>12}{'current, s':>12}{'docs/s':>10}{'speedup':>9}")
+    for mode, make_rows in (('flat', flat_rows), ('aggregated', aggregated_rows)):
+        batches = [make_rows(batch) for batch in film_batches]
+        check_equivalent(batches[0], mode, transformer)
+        legacy_s = measure(lambda rows: legacy(rows, mode), batches, args.repeat)
+        current_s = measure(lambda rows: transformer.transform(rows, mode), batches, args.repeat)
+        rows_count = sum(len(batch) for batch in batches)
+        print(f"{mode:<12}{rows_count:>10}{legacy_s:>12.4f}{current_s:>12.4f}"
+              f"{args.films / current_s:>10.0f}{legacy_s / current_s:>8.2f}x")
+
+
+if __name__ == '__main__':
+    main()
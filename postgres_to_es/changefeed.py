@@ -0,0 +1,97 @@
+"""Push-источник изменений: подписка на NOTIFY от триггеров каталога."""
+import json
+import logging
+import select
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, Set
+
+from psycopg import OperationalError, sql
+from utils import backoff, connect_pg
+
+TRIGGERS_SQL = Path(__file__).parent / 'sql' / 'change_notify.sql'
+
+
+class PostgresChangeListener:
+    """
+    Слушает канал NOTIFY, в который триггеры из sql/change_notify.sql публикуют
+    id изменённых строк. Держит собственное autocommit-соединение и сам
+    переподключается при его потере. Уведомления, пришедшие пока соединения не было,
+    теряются — их подбирает keyset-опрос продюсеров.
+    """
+
+    def __init__(self, pg_settings: dict, channel: str = 'etl_changes'):
+        self.pg_settings = pg_settings
+        self.channel = channel
+        self.conn = None
+
+    def connect(self) -> None:
+        self.close()
+        self.conn = connect_pg(**self.pg_settings, autocommit=True)
+        self.conn.execute(sql.SQL("LISTEN {}").format(sql.Identifier(self.channel)))
+        logging.info(f"Подписка на канал PostgreSQL '{self.channel}' установлена.")
+
+    def close(self) -> None:
+        if self.conn is not None and not self.conn.closed:
+            self.conn.close()
+        self.conn = None
+
+    @backoff(exceptions=(OperationalError,), service_name="PostgreSQL")
+    def install_triggers(self) -> None:
+        """Создаёт (или пересоздаёт) функцию и триггеры уведомлений."""
+        with connect_pg(**self.pg_settings, autocommit=True) as conn:
+            # Канал передаётся в триггеры аргументом, в файле он записан как 'etl_changes'.
+            script = TRIGGERS_SQL.read_text(encoding='utf-8').replace(
+                "'etl_changes'", sql.Literal(self.channel).as_string(conn)
+            )
+            conn.execute(script)
+        logging.info("Триггеры уведомлений об изменениях установлены.")
+
+    def poll(self, timeout: float, max_items: int = 10000) -> Dict[str, Set[str]]:
+        """
+        Ждёт уведомления не дольше timeout секунд и возвращает id изменённых
+        строк, сгруппированные по источнику: {'film_work': {...}, 'person': {...}, ...}.
+        """
+        changes = defaultdict(set)
+        deadline = time.monotonic() + timeout
+        try:
+            if self.conn is None or self.conn.closed:
+                self.connect()
+            pgconn = self.conn.pgconn
+            # Уведомления, прочитанные из сокета в прошлый раз сверх max_items, сокет уже не разбудит
+            received = self._drain(changes, pgconn, max_items)
+            while received < max_items:
+                remaining = deadline - time.monotonic()
+                if received == 0 and remaining <= 0:
+                    break
+                # После первого уведомления только добираем то, что уже пришло.
+                ready, _, _ = select.select([self.conn.fileno()], [], [], max(remaining, 0) if received == 0 else 0)
+                if not ready:
+                    break
+                pgconn.consume_input()
+                received += self._drain(changes, pgconn, max_items - received)
+        except (OperationalError, OSError) as e:
+            logging.warning(f"Соединение для уведомлений PostgreSQL потеряно: {e}. Переподключение в следующем цикле.")
+            self.close()
+        return changes
+
+    def _drain(self, changes, pgconn, limit: int) -> int:
+        """Разбирает не больше limit уведомлений, уже прочитанных из сокета. Возвращает их число."""
+        received = 0
+        while received < limit:
+            notify = pgconn.notifies()
+            if notify is None:
+                break
+            received += 1
+            self._collect(changes, notify.extra)
+        return received
+
+    @staticmethod
+    def _collect(changes, payload: bytes) -> None:
+        try:
+            data = json.loads(payload)
+            table, row_id = data['table'], data['id']
+            changes[table].add(row_id)
+        except (ValueError, KeyError, TypeError):
+            logging.warning(f"Некорректное уведомление об изменении: {payload!r}")
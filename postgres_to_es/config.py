@@ -1,6 +1,7 @@
 """Модуль для управления конфигурацией ETL процесса."""
 import logging
-from typing import List, Dict, Any
+from pathlib import Path
+from typing import List, Dict, Any, Literal, Optional
 from pydantic import BaseModel, Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -34,7 +35,16 @@ class ElasticsearchSettings(BaseSettings):
     """Настройки для подключения к Elasticsearch."""
     host: str = Field(..., validation_alias='ELASTIC_HOST')
     port: int = Field(..., validation_alias='ELASTIC_PORT')
+    # Имя алиаса, через который читают и пишут; версии индекса называются '<index>_v<N>'
     index: str = 'movies'
+    schema_path: str = str(Path(__file__).parent / 'es_schema.json')
+    # Параметры bulk-загрузки: чанки ограничены и количеством документов, и размером в байтах
+    bulk_workers: int = Field(1, validation_alias='ES_BULK_WORKERS')
+    bulk_chunk_size: int = Field(500, validation_alias='ES_BULK_CHUNK_SIZE')
+    bulk_max_chunk_bytes: int = Field(10 * 1024 * 1024, validation_alias='ES_BULK_MAX_CHUNK_BYTES')
+    bulk_max_retries: int = Field(5, validation_alias='ES_BULK_MAX_RETRIES')
+    bulk_initial_backoff: float = Field(1, validation_alias='ES_BULK_INITIAL_BACKOFF')
+    bulk_max_backoff: float = Field(60, validation_alias='ES_BULK_MAX_BACKOFF')
 
 
 class ProducerConfig(BaseModel):
@@ -61,8 +71,77 @@ class AppSettings(BaseSettings):
         ProducerConfig(source_type='person', table='content.person', state_key='person_producer', enrich=True),
         ProducerConfig(source_type='genre', table='content.genre', state_key='genre_producer', enrich=True),
     ]
+    # Пул соединений с PostgreSQL. Запросы готовятся на сервере после pg_prepare_threshold
+    # выполнений на одном соединении (0 — сразу, None — никогда).
+    pg_pool_min_size: int = Field(1, validation_alias='PG_POOL_MIN_SIZE')
+    pg_pool_max_size: int = Field(4, validation_alias='PG_POOL_MAX_SIZE')
+    pg_prepare_threshold: Optional[int] = Field(1, validation_alias='PG_PREPARE_THRESHOLD')
+    # Подписка на изменения через LISTEN/NOTIFY (триггеры ставит команда install-triggers).
+    # Keyset-опрос при этом остаётся сверочным путём и выполняется раз в change_feed_reconcile_interval секунд.
+    change_feed: bool = Field(False, validation_alias='CHANGE_FEED')
+    change_feed_channel: str = Field('etl_changes', validation_alias='CHANGE_FEED_CHANNEL')
+    change_feed_reconcile_interval: int = Field(60, validation_alias='CHANGE_FEED_RECONCILE_INTERVAL')
+    change_feed_max_batch: int = Field(10000, validation_alias='CHANGE_FEED_MAX_BATCH')
+    # Очередь документов между трансформацией и загрузкой (Redis Stream с consumer group)
+    queue_stream: str = Field('processed_movies_stream', validation_alias='QUEUE_STREAM')
+    queue_group: str = Field('es_loader', validation_alias='QUEUE_GROUP')
+    # Через сколько миллисекунд неподтверждённое сообщение забирает другой загрузчик
+    queue_claim_idle_ms: int = Field(60000, validation_alias='QUEUE_CLAIM_IDLE_MS')
+    # Кодек пачек в очереди: 'json' или 'msgpack', с необязательным сжатием '+zstd' / '+lz4'
+    queue_codec: str = Field('json', validation_alias='QUEUE_CODEC')
+    # Отдавать JSON-документы в bulk как есть, без декодирования и повторной сериализации
+    queue_passthrough: bool = Field(True, validation_alias='QUEUE_PASSTHROUGH')
+    # Поток документов, окончательно отклонённых Elasticsearch (по записи на документ: id, status, error, source)
+    queue_dead_letter_stream: str = Field('processed_movies_dead_letter', validation_alias='QUEUE_DEAD_LETTER_STREAM')
+    # Где хранить курсоры источников: 'redis' (hash на источник) или 'file' (JSON-файлы в state_dir для локальных запусков)
+    state_storage: Literal['redis', 'file'] = Field('redis', validation_alias='STATE_STORAGE')
+    state_dir: str = Field('state', validation_alias='STATE_DIR')
+    # Множество фильмов, которые нужно пересобрать в текущем цикле
+    dirty_set_key: str = Field('etl:dirty_films', validation_alias='DIRTY_SET_KEY')
+    # Переименования персон и жанров применяются к документам скриптом, без пересборки фильмов.
+    # Снимки имён и связей хранятся в hash '<snapshot_key_prefix>:<источник>'.
+    partial_updates: bool = Field(True, validation_alias='PARTIAL_UPDATES')
+    snapshot_key_prefix: str = Field('etl:snapshots', validation_alias='SNAPSHOT_KEY_PREFIX')
+    # Шардированный режим (команда worker): фильмы делятся на shard_count шардов по hash(id),
+    # шарды раздаются процессам через аренды в Redis с TTL shard_lease_ttl секунд.
+    # shard_workers включают, если синхронизацию ведут процессы worker: тогда reindex и rollback
+    # выставляют и курсоры каждого шарда.
+    shard_workers: bool = Field(False, validation_alias='SHARD_WORKERS')
+    shard_count: int = Field(8, validation_alias='SHARD_COUNT')
+    shard_lease_ttl: int = Field(30, validation_alias='SHARD_LEASE_TTL')
+    shard_key_prefix: str = Field('etl:shards', validation_alias='SHARD_KEY_PREFIX')
+    # Курсоры источников на момент переключения алиаса с версии индекса: '<swap_cursors_prefix>:<индекс>'.
+    # Откат на эту версию возвращает к ним курсоры, чтобы повторить изменения, сделанные после переключения.
+    swap_cursors_prefix: str = Field('etl:swap_cursors', validation_alias='SWAP_CURSORS_PREFIX')
+    # Порт HTTP-эндпоинта /metrics для Prometheus (0 — не поднимать)
+    metrics_port: int = Field(8000, validation_alias='METRICS_PORT')
+    # Писать в лог пачки стадий дольше этого порога, мс (не задан — не писать)
+    trace_slow_batch_ms: Optional[float] = Field(None, validation_alias='TRACE_SLOW_BATCH_MS')
+    # Стадии через запятую (например, 'merge,transform'), каждая пачка которых профилируется cProfile в profile_dir
+    profile_stages: str = Field('', validation_alias='PROFILE_STAGES')
+    profile_dir: str = Field('/tmp/etl_profiles', validation_alias='PROFILE_DIR')
+    # Отпечатки загруженных документов: неизменившиеся документы не отправляются в Elasticsearch
+    fingerprint_cache: bool = Field(True, validation_alias='FINGERPRINT_CACHE')
+    fingerprint_key: str = Field('etl:fingerprints', validation_alias='FINGERPRINT_KEY')
     batch_size: int = Field(100, validation_alias='BATCH_SIZE')
     sleep_time: int = Field(1, validation_alias='SLEEP_TIME')
+    # Пауза простаивающего источника растёт в sleep_backoff_factor раз до max_sleep_time
+    max_sleep_time: int = Field(30, validation_alias='MAX_SLEEP_TIME')
+    sleep_backoff_factor: float = Field(2, validation_alias='SLEEP_BACKOFF_FACTOR')
+    # Как часто (в полных пачках) сообщать о прогрессе догоняющей выгрузки
+    catchup_report_every: int = Field(10, ge=1, validation_alias='CATCHUP_REPORT_EVERY')
+    # Сверка индекса с PostgreSQL (команда reconcile): размер страниц обоих потоков
+    # и ограничение скорости в документах в секунду (0 — без ограничения)
+    reconcile_chunk_size: int = Field(1000, validation_alias='RECONCILE_CHUNK_SIZE')
+    reconcile_rate: float = Field(0, validation_alias='RECONCILE_RATE')
+    # Размер пачки серверного курсора при полной переиндексации
+    reindex_chunk_size: int = Field(1000, validation_alias='REINDEX_CHUNK_SIZE')
+    # 'sync' — последовательный цикл, 'async' — конкурентные источники и перекрывающиеся стадии
+    execution_mode: Literal['sync', 'async'] = Field('sync', validation_alias='EXECUTION_MODE')
+    # Сколько страниц источника может ждать обработки в асинхронном режиме
+    async_stage_queue_size: int = Field(4, validation_alias='ASYNC_STAGE_QUEUE_SIZE')
+    # 'aggregated' — одна строка на фильм, 'flat' — исходный JOIN со строкой на каждую пару персона/жанр
+    merge_mode: Literal['aggregated', 'flat'] = Field('aggregated', validation_alias='MERGE_MODE')
 
 
 try:
@@ -0,0 +1,109 @@
+"""Множество «грязных» фильмов цикла синхронизации."""
+import logging
+from collections import Counter
+from typing import Iterable, Iterator, List
+
+from redis import Redis
+from redis import asyncio as aioredis
+
+from metrics import DIRTY_CONTRIBUTED, DIRTY_DEDUP_RATIO, DIRTY_FLUSHED
+
+
+class DirtyFilmSet:
+    """
+    Все источники цикла (film_work, person, genre, уведомления об изменениях)
+    складывают id затронутых фильмов в одно множество Redis, и каждый фильм
+    собирается и индексируется один раз за цикл, сколько бы источников его ни затронуло.
+
+    Множество живёт в Redis, поэтому память процесса не зависит от размера разворачивания,
+    а после падения незавершённый цикл дочищается. id удаляются из множества
+    в одной транзакции с записью их документов в очередь (stage_remove).
+    """
+
+    def __init__(self, redis_connection: Redis, key: str = 'etl:dirty_films'):
+        self.redis = redis_connection
+        self.key = key
+        self.contributed = Counter()
+        self.flushed = 0
+
+    def add(self, film_work_ids: Iterable, source_type: str) -> None:
+        """Отмечает фильмы как требующие пересборки."""
+        ids = [str(fw_id) for fw_id in film_work_ids]
+        if not ids:
+            return
+        self.redis.sadd(self.key, *ids)
+        self.contributed[source_type] += len(ids)
+
+    def stage_add(self, pipe, film_work_ids: Iterable, source_type: str) -> None:
+        """То же, что add, но командой в транзакции pipe (например, вместе с отметкой разворачивания)."""
+        ids = [str(fw_id) for fw_id in film_work_ids]
+        if not ids:
+            return
+        pipe.sadd(self.key, *ids)
+        self.contributed[source_type] += len(ids)
+
+    def stage_remove(self, pipe, film_work_ids: List[str]) -> None:
+        """Удаляет собранную пачку из множества командой в транзакции pipe."""
+        if film_work_ids:
+            pipe.srem(self.key, *film_work_ids)
+            self.flushed += len(film_work_ids)
+
+    def __len__(self) -> int:
+        return self.redis.scard(self.key)
+
+    def batches(self, batch_size: int) -> Iterator[List[str]]:
+        """
+        Выдаёт id пачками. Пачку удаляет потребитель через stage_remove, иначе
+        следующая пачка может её повторить.
+        """
+        while True:
+            ids = self.redis.srandmember(self.key, batch_size)
+            if not ids:
+                return
+            yield ids
+
+    def dedup_ratio(self) -> float:
+        """Доля лишних пересборок, которые сэкономило множество за цикл."""
+        contributed = sum(self.contributed.values())
+        if not contributed:
+            return 0.0
+        return max(0.0, 1 - self.flushed / contributed)
+
+    def end_cycle(self) -> None:
+        """Логирует и публикует в Prometheus метрики цикла, затем сбрасывает счётчики."""
+        contributed = sum(self.contributed.values())
+        if contributed:
+            logging.info(
+                f"Грязных фильмов за цикл: вклад источников {dict(self.contributed)}, "
+                f"собрано уникальных {self.flushed}, доля дублей {self.dedup_ratio():.1%}."
+            )
+            DIRTY_DEDUP_RATIO.set(self.dedup_ratio())
+        for source_type, count in self.contributed.items():
+            DIRTY_CONTRIBUTED.labels(source_type).inc(count)
+        DIRTY_FLUSHED.inc(self.flushed)
+        self.contributed.clear()
+        self.flushed = 0
+
+
+class AsyncDirtyFilmSet(DirtyFilmSet):
+    """То же множество поверх redis.asyncio для асинхронного режима. stage_* пишут в асинхронный pipe."""
+
+    def __init__(self, redis_connection: aioredis.Redis, key: str = 'etl:dirty_films'):
+        super().__init__(redis_connection, key)
+
+    async def add(self, film_work_ids: Iterable, source_type: str) -> None:
+        ids = [str(fw_id) for fw_id in film_work_ids]
+        if not ids:
+            return
+        await self.redis.sadd(self.key, *ids)
+        self.contributed[source_type] += len(ids)
+
+    async def size(self) -> int:
+        return await self.redis.scard(self.key)
+
+    async def batches(self, batch_size: int):
+        while True:
+            ids = await self.redis.srandmember(self.key, batch_size)
+            if not ids:
+                return
+            yield [fw_id.decode() if isinstance(fw_id, bytes) else fw_id for fw_id in ids]
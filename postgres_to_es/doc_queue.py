@@ -0,0 +1,274 @@
+"""Надёжная очередь документов между трансформацией и загрузкой на Redis Streams."""
+import asyncio
+import logging
+import math
+import os
+import socket
+from typing import Any, Callable, Dict, List, NamedTuple, Tuple, Union
+
+from redis import Redis, ResponseError
+
+from serializers import RawDocument, encode_document, get_codec
+
+
+def default_consumer_name() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def stream_version(message_id: bytes) -> int:
+    """
+    Внешняя версия документов сообщения для Elasticsearch: id записи потока (миллисекунды-номер)
+    в виде числа. Id растут в порядке XADD, поэтому более поздняя пачка всегда получает большую версию.
+    """
+    ms, seq = message_id.decode().split('-')
+    return (int(ms) << 20) + int(seq)
+
+
+def current_version(redis_connection: Redis) -> int:
+    """
+    Внешняя версия текущего момента по часам Redis в шкале stream_version. Документы, загруженные
+    с ней в обход очереди, старше сообщений, добавленных позже, и новее всех прежних.
+    """
+    seconds, microseconds = redis_connection.time()
+    return (seconds * 1000 + microseconds // 1000) << 20
+
+
+def _doc_id(doc) -> str:
+    return doc.id if isinstance(doc, RawDocument) else str(doc['id'])
+
+
+class QueueMessage(NamedTuple):
+    """Сообщение потока: пачка документов, подтверждаемая целиком."""
+    id: bytes
+    docs: List[Union[Dict[str, Any], RawDocument]]
+
+    @property
+    def version(self) -> int:
+        return stream_version(self.id)
+
+
+def latest_documents(messages: List[QueueMessage]) -> Tuple[list, Dict[str, int]]:
+    """
+    Документы сообщений и их внешние версии {id: версия}. Если документ пришёл в нескольких
+    сообщениях (например, зависшее сообщение забрано вместе с более новым), остаётся самая новая копия.
+    """
+    latest = {}
+    for message in sorted(messages, key=lambda message: message.version):
+        for doc in message.docs:
+            latest[_doc_id(doc)] = (doc, message.version)
+    return [doc for doc, _ in latest.values()], {doc_id: version for doc_id, (_, version) in latest.items()}
+
+
+class RedisStreamQueue:
+    """
+    Очередь документов на Redis Stream с consumer group.
+    Запись идёт одним пайплайном на пачку. Чтение через XREADGROUP делит сообщения
+    между несколькими загрузчиками. Сообщение удаляется только после явного ack,
+    а сообщения упавшего загрузчика, провисевшие дольше claim_idle_ms, забирает себе
+    другой загрузчик через XAUTOCLAIM. Такое сообщение может оказаться старше уже
+    загруженного, поэтому документы пишутся с внешней версией из id сообщения
+    (stream_version) и устаревшая копия отклоняется Elasticsearch.
+
+    Документы, которые Elasticsearch окончательно отклонил, при подтверждении пачки
+    переносятся в поток недоставленных dead_letter_stream (по записи на документ):
+    повтор их не исправит, а отбросить их молча значило бы потерять изменение.
+
+    Одно сообщение — пачка до entry_size документов, закодированная кодеком codec
+    (см. serializers). Соединение должно быть открыто с decode_responses=False.
+    При passthrough JSON-документы отдаются загрузчику как RawDocument без декодирования.
+    """
+
+    def __init__(self, redis_connection: Redis, stream: str, group: str, consumer: str = None,
+                 claim_idle_ms: int = 60000, maxlen: int = None, codec: str = 'json',
+                 entry_size: int = 100, passthrough: bool = True, dead_letter_stream: str = None):
+        self.redis = redis_connection
+        self.stream = stream
+        self.dead_letter_stream = dead_letter_stream or f"{stream}:dead_letter"
+        self.group = group
+        self.consumer = consumer or default_consumer_name()
+        self.claim_idle_ms = claim_idle_ms
+        self.maxlen = maxlen
+        self.codec = get_codec(codec)
+        self.entry_size = entry_size
+        self.passthrough = passthrough
+        self._group_ready = False
+
+    def ensure_group(self) -> None:
+        """Создаёт поток и группу потребителей, если их ещё нет."""
+        if self._group_ready:
+            return
+        try:
+            self.redis.xgroup_create(self.stream, self.group, id='0', mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+        self._group_ready = True
+
+    def push(self, docs: List[Union[Dict[str, Any], RawDocument]], stage: Callable = None) -> int:
+        """
+        Кладёт пачку документов в поток за один round trip. Возвращает объём закодированных пачек в байтах.
+        stage(pipe) добавляет свои команды (удаление фильмов из множества грязных, сдвиг курсора)
+        в ту же транзакцию MULTI/EXEC и может вернуть функцию, которая вызывается после неё.
+        Документы и отметка о том, что они переданы, попадают в Redis вместе или не попадают вовсе.
+        """
+        if not docs and stage is None:
+            return 0
+        size = 0
+        pipe = self.redis.pipeline(transaction=stage is not None)
+        for fields in self._entries(docs):
+            size += len(fields['payload'])
+            pipe.xadd(self.stream, fields, maxlen=self.maxlen, approximate=True)
+        applied = stage(pipe) if stage is not None else None
+        pipe.execute()
+        if applied is not None:
+            applied()
+        return size
+
+    def _entries(self, docs):
+        for start in range(0, len(docs), self.entry_size):
+            chunk = docs[start:start + self.entry_size]
+            yield {
+                'codec': self.codec.name,
+                'ids': ','.join(_doc_id(doc) for doc in chunk),
+                'payload': self.codec.encode(chunk),
+            }
+
+    def read(self, max_docs: int, block_ms: int = None) -> List[QueueMessage]:
+        """
+        Возвращает сообщения, в сумме содержащие около max_docs документов.
+        Сначала забирает зависшие сообщения других потребителей, затем новые.
+        """
+        self.ensure_group()
+        count = self._read_count(max_docs)
+        messages = self._claim_stale(count)
+        if len(messages) < count:
+            response = self.redis.xreadgroup(
+                self.group, self.consumer, {self.stream: '>'}, count=count - len(messages), block=block_ms
+            )
+            for _, entries in response or []:
+                messages.extend(entries)
+        return self._messages(messages)
+
+    def _read_count(self, max_docs):
+        return max(1, math.ceil(max_docs / self.entry_size))
+
+    def _messages(self, entries):
+        return [QueueMessage(msg_id, self._decode(fields)) for msg_id, fields in entries if fields]
+
+    def _decode(self, fields):
+        codec = get_codec(fields[b'codec'].decode())
+        payload = fields[b'payload']
+        if self.passthrough:
+            raw = codec.raw_documents(payload)
+            if raw is not None:
+                ids = fields[b'ids'].decode().split(',')
+                return [RawDocument(doc_id, source) for doc_id, source in zip(ids, raw)]
+        return codec.decode(payload)
+
+    def _claim_stale(self, count: int):
+        messages, deleted = self._claimed(self.redis.xautoclaim(
+            self.stream, self.group, self.consumer, min_idle_time=self.claim_idle_ms, start_id='0-0', count=count
+        ))
+        self.ack(deleted)
+        return messages
+
+    def _claimed(self, response):
+        """
+        Разбирает ответ XAUTOCLAIM на (сообщения, id удалённых сообщений).
+        Redis 7 сам убирает удалённые сообщения из ожидающих и перечисляет их третьим элементом.
+        Redis 6.2 возвращает только [next_id, messages] и отдаёт удалённое сообщение с пустым
+        телом, оставляя его ожидающим: без ack его забирали бы снова при каждом чтении.
+        """
+        messages = [entry for entry in response[1] if entry[1]]
+        deleted = [msg_id for msg_id, fields in response[1] if msg_id is not None and not fields]
+        if messages:
+            logging.warning(f"Потребитель '{self.consumer}' забрал {len(messages)} зависших сообщений из '{self.stream}'.")
+        return messages, deleted
+
+    def ack(self, message_ids: List[bytes], dead_letters: List[Dict[str, Any]] = None) -> None:
+        """
+        Подтверждает обработку и удаляет сообщения из потока. dead_letters — отклонённые документы
+        (LoadResult.failed): они записываются в поток недоставленных в той же транзакции.
+        """
+        if not message_ids:
+            return
+        pipe = self.redis.pipeline(transaction=True)
+        self._stage_ack(pipe, message_ids, dead_letters)
+        pipe.execute()
+
+    def _stage_ack(self, pipe, message_ids, dead_letters=None) -> None:
+        for fields in self._dead_letter_entries(dead_letters or []):
+            pipe.xadd(self.dead_letter_stream, fields)
+        pipe.xack(self.stream, self.group, *message_ids)
+        pipe.xdel(self.stream, *message_ids)
+        if dead_letters:
+            logging.warning(f"{len(dead_letters)} отклонённых документов перенесены в '{self.dead_letter_stream}'.")
+
+    @staticmethod
+    def _dead_letter_entries(dead_letters):
+        for failed in dead_letters:
+            record = failed['record']
+            yield {
+                'id': _doc_id(record),
+                'status': str(failed['status']),
+                'error': encode_document(failed['error']),
+                'source': record.source if isinstance(record, RawDocument) else encode_document(record),
+            }
+
+    def length(self) -> int:
+        """Количество сообщений (пачек) в потоке, включая ещё не подтверждённые."""
+        return self.redis.xlen(self.stream)
+
+
+class AsyncRedisStreamQueue(RedisStreamQueue):
+    """Та же очередь поверх redis.asyncio для асинхронного режима."""
+
+    async def ensure_group(self) -> None:
+        if self._group_ready:
+            return
+        try:
+            await self.redis.xgroup_create(self.stream, self.group, id='0', mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+        self._group_ready = True
+
+    async def push(self, docs: List[Union[Dict[str, Any], RawDocument]], stage: Callable = None) -> int:
+        if not docs and stage is None:
+            return 0
+        size = 0
+        async with self.redis.pipeline(transaction=stage is not None) as pipe:
+            for fields in self._entries(docs):
+                size += len(fields['payload'])
+                pipe.xadd(self.stream, fields, maxlen=self.maxlen, approximate=True)
+            applied = stage(pipe) if stage is not None else None
+            await pipe.execute()
+        if applied is not None:
+            # Функция после транзакции синхронно пишет в хранилище состояния, если то не Redis
+            await asyncio.to_thread(applied)
+        return size
+
+    async def read(self, max_docs: int, block_ms: int = None) -> List[QueueMessage]:
+        await self.ensure_group()
+        count = self._read_count(max_docs)
+        messages, deleted = self._claimed(await self.redis.xautoclaim(
+            self.stream, self.group, self.consumer, min_idle_time=self.claim_idle_ms, start_id='0-0', count=count
+        ))
+        await self.ack(deleted)
+        if len(messages) < count:
+            response = await self.redis.xreadgroup(
+                self.group, self.consumer, {self.stream: '>'}, count=count - len(messages), block=block_ms
+            )
+            for _, entries in response or []:
+                messages.extend(entries)
+        return self._messages(messages)
+
+    async def ack(self, message_ids: List[bytes], dead_letters: List[Dict[str, Any]] = None) -> None:
+        if not message_ids:
+            return
+        async with self.redis.pipeline(transaction=True) as pipe:
+            self._stage_ack(pipe, message_ids, dead_letters)
+            await pipe.execute()
+
+    async def length(self) -> int:
+        return await self.redis.xlen(self.stream)
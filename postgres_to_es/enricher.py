@@ -7,31 +7,56 @@ class PostgresEnricher:
         'person': ('content.person_film_work', 'person_id'),
         'genre': ('content.genre_film_work', 'genre_id'),
     }
+    # Нижняя граница keyset-пагинации по id фильмов: меньше любого UUID
+    FIRST_FILM_ID = '00000000-0000-0000-0000-000000000000'
 
-    def __init__(self, pg_conn, chunk_size):
+    def __init__(self, pg_conn, chunk_size, shard=None):
         self.pg_conn = pg_conn
         self.chunk_size = chunk_size
+        # Шард (см. sharding.Shard): разворачиваются только фильмы этого шарда
+        self.shard = shard
     
-    @backoff(exceptions=(OperationalError,), service_name="PostgreSQL")
-    def enrich(self, source_ids, source_type):
-        if not source_ids or source_type not in self.RELATION_MAPPING:
-            return []
-            
+    def fanout_query(self, source_ids, source_type, after_id=None):
+        """
+        Запрос следующей keyset-страницы id фильмов, связанных с source_ids, и его параметры.
+        Один параметр-массив вместо списка плейсхолдеров: текст запроса не зависит
+        от числа id, поэтому подготовленный план переиспользуется между циклами.
+        """
         m2m_table, relation_field = self.RELATION_MAPPING[source_type]
-
-        placeholders = ','.join(['%s'] * len(source_ids))
+        shard_condition = f" AND {self.shard.predicate('film_work_id')}" if self.shard else ""
         query = f"""
-            SELECT DISTINCT fw.id
-            FROM content.film_work fw
-            LEFT JOIN {m2m_table} pfw ON pfw.film_work_id = fw.id
-            WHERE pfw.{relation_field} IN ({placeholders});
+            SELECT DISTINCT film_work_id
+            FROM {m2m_table}
+            WHERE {relation_field} = ANY(%s::uuid[]) AND film_work_id > %s::uuid{shard_condition}
+            ORDER BY film_work_id
+            LIMIT %s;
         """
+        return query, ([str(sid) for sid in source_ids], str(after_id or self.FIRST_FILM_ID), self.chunk_size)
+
+    @backoff(exceptions=(OperationalError,), service_name="PostgreSQL")
+    def fetch_fanout_page(self, source_ids, source_type, after_id=None):
+        query, params = self.fanout_query(source_ids, source_type, after_id)
         with self.pg_conn.cursor() as cur:
-            cur.execute(query, [str(sid) for sid in source_ids])
-            film_work_ids = []
-            while True:
-                rows = cur.fetchmany(self.chunk_size)
-                if not rows:
-                    break
-                film_work_ids.extend([row[0] for row in rows])
-        return film_work_ids
+            cur.execute(query, params)
+            return [row[0] for row in cur.fetchall()]
+
+    def iter_film_ids(self, source_ids, source_type, after_id=None):
+        """
+        Выдаёт id связанных фильмов пачками по chunk_size в порядке возрастания id,
+        начиная после after_id. Память не зависит от числа связанных фильмов:
+        популярный жанр с десятками тысяч фильмов разворачивается постранично.
+        """
+        if not source_ids or source_type not in self.RELATION_MAPPING:
+            return
+        while True:
+            film_work_ids = self.fetch_fanout_page(source_ids, source_type, after_id)
+            if not film_work_ids:
+                return
+            yield film_work_ids
+            if len(film_work_ids) < self.chunk_size:
+                return
+            after_id = film_work_ids[-1]
+
+    def enrich(self, source_ids, source_type):
+        """Все id фильмов, связанных с source_ids, одним списком."""
+        return [fw_id for chunk in self.iter_film_ids(source_ids, source_type) for fw_id in chunk]
@@ -0,0 +1,71 @@
+"""Отпечатки загруженных документов: пропуск переиндексации неизменившихся фильмов."""
+import hashlib
+import logging
+from typing import Dict
+
+from redis import Redis
+
+
+def fingerprint(source) -> str:
+    """Отпечаток JSON-представления документа."""
+    if isinstance(source, str):
+        source = source.encode('utf-8')
+    return hashlib.blake2b(source, digest_size=16).hexdigest()
+
+
+class FingerprintStore:
+    """
+    Хранит отпечаток последней загруженной в Elasticsearch версии каждого фильма:
+    hash Redis «id фильма -> отпечаток».
+
+    Многие изменения в источнике (например, обновлённый person.updated_at при том же
+    full_name) дают документ, совпадающий с уже проиндексированным. Такие документы
+    загрузчик отбрасывает до bulk, не вызывая лишней перезаписи сегментов.
+
+    Отпечаток записывается только после успешной загрузки. При полной переиндексации
+    и откате алиаса хранилище сбрасывается через reset().
+
+    Очередь могут разбирать несколько загрузчиков, поэтому отпечатки всей пачки каждый раз
+    читаются одним HMGET: кэш в памяти процесса не видел бы remember() и forget() других
+    процессов, а его совпадение, из-за которого документ пропускается, всё равно пришлось бы
+    сверять с hash.
+    """
+
+    def __init__(self, redis_connection: Redis, key: str = 'etl:fingerprints'):
+        self.redis = redis_connection
+        self.key = key
+        self.checked = 0
+        self.skipped = 0
+
+    def changed(self, digests: Dict[str, str]) -> Dict[str, str]:
+        """Оставляет из {id: отпечаток} только документы, отличающиеся от загруженных."""
+        if not digests:
+            return {}
+        doc_ids = list(digests)
+        known = {}
+        for doc_id, digest in zip(doc_ids, self.redis.hmget(self.key, doc_ids)):
+            known[doc_id] = digest.decode() if isinstance(digest, bytes) else digest
+        changed = {doc_id: digest for doc_id, digest in digests.items() if known[doc_id] != digest}
+        self.checked += len(digests)
+        self.skipped += len(digests) - len(changed)
+        return changed
+
+    def remember(self, digests: Dict[str, str]) -> None:
+        """Запоминает отпечатки успешно загруженных документов."""
+        if digests:
+            self.redis.hset(self.key, mapping=digests)
+
+    def forget(self, doc_ids) -> None:
+        """Забывает отпечатки документов, изменённых в обход загрузчика."""
+        doc_ids = [str(doc_id) for doc_id in doc_ids]
+        if doc_ids:
+            self.redis.hdel(self.key, *doc_ids)
+
+    def skip_rate(self) -> float:
+        """Доля документов, пропущенных как неизменившиеся, с момента запуска."""
+        return self.skipped / self.checked if self.checked else 0.0
+
+    def reset(self) -> None:
+        """Забывает все отпечатки, например перед полной переиндексацией."""
+        self.redis.delete(self.key)
+        logging.info(f"Отпечатки документов '{self.key}' сброшены.")
@@ -0,0 +1,145 @@
+"""Управление версионированными индексами Elasticsearch и алиасом поверх них."""
+import copy
+import json
+import logging
+import re
+from typing import Callable, List
+
+from elasticsearch import Elasticsearch, ConnectionError, NotFoundError
+from utils import backoff
+
+
+class IndexManager:
+    """
+    Держит алиас (например, 'movies') поверх версионированных индексов 'movies_v1', 'movies_v2', ...
+    Новая версия создаётся с отключённым refresh и без реплик, наполняется, после чего
+    индекс сливается в один сегмент, настройки восстанавливаются и алиас атомарно
+    переключается. Старые версии остаются для отката.
+    """
+
+    def __init__(self, es_conn: Elasticsearch, alias: str, schema_path: str):
+        self.es_conn = es_conn
+        self.alias = alias
+        self.schema_path = schema_path
+        self._version_re = re.compile(rf'^{re.escape(alias)}_v(\d+)$')
+
+    def load_schema(self) -> dict:
+        with open(self.schema_path, encoding='utf-8') as f:
+            return json.load(f)
+
+    @backoff(exceptions=(ConnectionError,), service_name="Elasticsearch")
+    def versions(self) -> list[tuple[int, str]]:
+        """Существующие версии индекса, отсортированные по номеру."""
+        indices = self.es_conn.indices.get(index=f"{self.alias}_v*", allow_no_indices=True, expand_wildcards='all')
+        found = []
+        for name in indices:
+            match = self._version_re.match(name)
+            if match:
+                found.append((int(match.group(1)), name))
+        return sorted(found)
+
+    @backoff(exceptions=(ConnectionError,), service_name="Elasticsearch")
+    def current_indices(self) -> list[str]:
+        """Индексы, на которые сейчас указывает алиас."""
+        try:
+            return list(self.es_conn.indices.get_alias(name=self.alias))
+        except NotFoundError:
+            return []
+
+    def next_index_name(self) -> str:
+        versions = self.versions()
+        next_version = versions[-1][0] + 1 if versions else 1
+        return f"{self.alias}_v{next_version}"
+
+    @backoff(exceptions=(ConnectionError,), service_name="Elasticsearch")
+    def create_bulk_index(self, index_name: str) -> str:
+        """Создаёт индекс по схеме с настройками для массовой загрузки."""
+        schema = copy.deepcopy(self.load_schema())
+        index_settings = schema.setdefault('settings', {})
+        index_settings['refresh_interval'] = '-1'
+        index_settings['number_of_replicas'] = 0
+        self.es_conn.indices.create(index=index_name, settings=index_settings, mappings=schema.get('mappings'))
+        logging.info(f"Создан индекс '{index_name}' для массовой загрузки (refresh отключён, реплик нет).")
+        return index_name
+
+    @backoff(exceptions=(ConnectionError,), service_name="Elasticsearch")
+    def restore_settings(self, index_name: str) -> None:
+        """Возвращает refresh_interval и число реплик к значениям из схемы."""
+        schema_settings = self.load_schema().get('settings', {})
+        self.es_conn.indices.put_settings(index=index_name, settings={
+            'index': {
+                'refresh_interval': schema_settings.get('refresh_interval'),
+                # None сбрасывает настройку к значению по умолчанию
+                'number_of_replicas': schema_settings.get('number_of_replicas'),
+            }
+        })
+        self.es_conn.indices.refresh(index=index_name)
+        logging.info(f"Настройки индекса '{index_name}' восстановлены.")
+
+    @backoff(exceptions=(ConnectionError,), service_name="Elasticsearch")
+    def force_merge(self, index_name: str) -> None:
+        """
+        Сливает индекс в один сегмент. Слияние идёт долго, и обрыв соединения не должен
+        прерывать переиндексацию после загрузки: повтор безопасен, уже слитые сегменты не сливаются заново.
+        """
+        self.es_conn.options(request_timeout=3600).indices.forcemerge(index=index_name, max_num_segments=1)
+        logging.info(f"Индекс '{index_name}' слит в один сегмент.")
+
+    @backoff(exceptions=(ConnectionError,), service_name="Elasticsearch")
+    def is_legacy_index(self) -> bool:
+        """Старая схема развёртывания: имя алиаса занято обычным индексом."""
+        return bool(self.es_conn.indices.exists(index=self.alias)) and not self.es_conn.indices.exists_alias(name=self.alias)
+
+    def check_legacy_index(self, drop_legacy_index: bool = False) -> bool:
+        """
+        Проверяет, можно ли переключить алиас. Алиас с именем обычного индекса можно создать,
+        только удалив этот индекс в той же операции, и откатиться на него потом нельзя,
+        поэтому без drop_legacy_index переключение запрещено. Возвращает True для старой схемы.
+        """
+        if not self.is_legacy_index():
+            return False
+        if not drop_legacy_index:
+            raise RuntimeError(f"'{self.alias}' — обычный индекс, а не алиас: переключение удалило бы его "
+                               f"без возможности отката. Сохраните его копию (например, snapshot) и запустите "
+                               f"reindex с --drop-legacy-index.")
+        logging.warning(f"'{self.alias}' — обычный индекс, он будет удалён при переключении алиаса (--drop-legacy-index).")
+        return True
+
+    @backoff(exceptions=(ConnectionError,), service_name="Elasticsearch")
+    def swap_alias(self, index_name: str, drop_legacy_index: bool = False) -> None:
+        """Атомарно переключает алиас на index_name. Обычный индекс с именем алиаса удаляется только с drop_legacy_index."""
+        actions = [{'remove': {'index': name, 'alias': self.alias}} for name in self.current_indices() if name != index_name]
+        if not actions and self.check_legacy_index(drop_legacy_index):
+            actions.append({'remove_index': {'index': self.alias}})
+
+        actions.append({'add': {'index': index_name, 'alias': self.alias}})
+        self.es_conn.indices.update_aliases(actions=actions)
+        logging.info(f"Алиас '{self.alias}' переключён на '{index_name}'.")
+
+    def finalize(self, index_name: str, before_swap: Callable[[List[str]], None] = None,
+                 drop_legacy_index: bool = False) -> None:
+        """
+        Завершает массовую загрузку: force merge, настройки, переключение алиаса.
+        Реплики включаются после слияния, чтобы копировать на них уже слитые сегменты, а не дважды.
+        before_swap(индексы алиаса) вызывается непосредственно перед переключением.
+        """
+        self.force_merge(index_name)
+        self.restore_settings(index_name)
+        if before_swap is not None:
+            before_swap(self.current_indices())
+        self.swap_alias(index_name, drop_legacy_index)
+
+    def rollback(self) -> str:
+        """Переключает алиас на предыдущую версию индекса."""
+        current = set(self.current_indices())
+        versions = self.versions()
+        current_versions = [version for version, name in versions if name in current]
+        if not current_versions:
+            raise RuntimeError(f"Алиас '{self.alias}' не указывает ни на одну версию индекса.")
+
+        previous = [name for version, name in versions if version < min(current_versions)]
+        if not previous:
+            raise RuntimeError(f"Для алиаса '{self.alias}' нет предыдущей версии индекса.")
+
+        self.swap_alias(previous[-1])
+        return previous[-1]
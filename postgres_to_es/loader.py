@@ -1,39 +1,260 @@
+import asyncio
 import logging
-from elasticsearch import Elasticsearch, helpers, ConnectionError
-from utils import backoff
+import random
+import time
+from dataclasses import dataclass, field
+
+from elasticsearch import AsyncElasticsearch, Elasticsearch, helpers, ConnectionError
+from fingerprints import FingerprintStore, fingerprint
+from metrics import DOCUMENTS_FAILED, DOCUMENTS_OUTDATED, DOCUMENTS_SKIPPED
+from serializers import RawDocument
+from utils import async_backoff, backoff
+
+# Статус, с которым Elasticsearch отклоняет запросы при переполнении очереди bulk
+TOO_MANY_REQUESTS = 429
+# Статус отказа по внешней версии: в индексе уже более новая версия документа
+VERSION_CONFLICT = 409
+
+
+@dataclass
+class LoadResult:
+    """Итог загрузки пачки: успешно загруженные и отклонённые документы."""
+    success: int = 0
+    # Отклонённые документы: {'record': ..., 'status': ..., 'error': ...}
+    failed: list = field(default_factory=list)
+    # Документы, пропущенные как неизменившиеся с прошлой загрузки
+    skipped: int = 0
+    # id документов, отклонённых как устаревшие: в индексе уже более новая версия
+    outdated: list = field(default_factory=list)
+    bytes: int = 0
+    elapsed: float = 0.0
+
+
+def record_id(record) -> str:
+    return record.id if isinstance(record, RawDocument) else str(record.get('id'))
+
 
 class ElasticsearchLoader:
-    def __init__(self, es_conn: Elasticsearch, index_name: str):
+    def __init__(self, es_conn: Elasticsearch, index_name: str, workers: int = 1, chunk_size: int = 500,
+                 max_chunk_bytes: int = 10 * 1024 * 1024, max_retries: int = 5,
+                 initial_backoff: float = 1, max_backoff: float = 60,
+                 fingerprints: FingerprintStore = None):
         self.es_conn = es_conn
         self.index_name = index_name
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.fingerprints = fingerprints
+        self._serializer = es_conn.transport.serializers.get_serializer('application/json')
 
-    @backoff(exceptions=(ConnectionError,), service_name="Elasticsearch")
-    def load_to_es(self, records: list[dict]):
+    def load_to_es(self, records: list, versions: dict = None) -> LoadResult:
         """
         Загружает пачку документов в Elasticsearch.
         В случае сбоя соединения будет повторять попытки благодаря декоратору @backoff.
         """
+        return self.load_stream(records, versions)
+
+    @backoff(exceptions=(ConnectionError,), service_name="Elasticsearch")
+    def load_stream(self, records: list, versions: dict = None) -> LoadResult:
+        """
+        Загружает документы потоково: чанки ограничены и по количеству, и по размеру в байтах,
+        при workers > 1 отправляются параллельно. Документы, отклонённые с 429,
+        повторяются с экспоненциальной задержкой. Остальные ошибки возвращаются
+        по каждому документу, не заставляя переотправлять всю пачку.
+        Записи — словари или RawDocument с уже готовым JSON.
+        Если задано хранилище отпечатков, неизменившиеся документы не отправляются.
+        versions — внешние версии {id: версия}: документ записывается с version_type=external_gte,
+        и копия старее уже загруженной отклоняется с 409. Такой отказ — не ошибка, документ учитывается в outdated.
+        """
         if not records:
+            return LoadResult()
+
+        batch = BulkBatch(self, records, versions)
+        batch.skip_unchanged()
+        while batch.pending:
+            for ok, item in self._bulk(batch.actions()):
+                batch.collect(ok, item)
+            delay = batch.next_attempt()
+            if delay is not None:
+                time.sleep(delay)
+        batch.remember()
+        return batch.finish()
+
+    def _retry_delay(self, attempt: int, rejected_count: int) -> float:
+        delay = min(self.initial_backoff * (2 ** attempt), self.max_backoff)
+        delay += random.uniform(0, delay)
+        logging.warning(f"Elasticsearch отклонил {rejected_count} документов (429). "
+                        f"Повтор {attempt + 1}/{self.max_retries} через {delay:.2f} сек...")
+        return delay
+
+    def _encode(self, records):
+        """Сериализует документы один раз: байты идут в тело bulk как есть и дают точный объём."""
+        encoded = {}
+        for record in records:
+            if isinstance(record, RawDocument):
+                encoded[record.id] = (record, record.source)
+            else:
+                encoded[str(record['id'])] = (record, self._serializer.dumps(record))
+        return encoded
+
+    def _actions(self, pending, versions=None):
+        if versions is None:
+            return (
+                {'_index': self.index_name, '_id': doc_id, '_source': source}
+                for doc_id, (_, source) in pending.items()
+            )
+        return (
+            {'_index': self.index_name, '_id': doc_id, '_source': source,
+             'version': versions[doc_id], 'version_type': 'external_gte'}
+            for doc_id, (_, source) in pending.items()
+        )
+
+    def _bulk_options(self):
+        return dict(
+            chunk_size=self.chunk_size,
+            max_chunk_bytes=self.max_chunk_bytes,
+            raise_on_error=False,
+            raise_on_exception=False,
+        )
+
+    def _bulk(self, actions):
+        if self.workers > 1:
+            return helpers.parallel_bulk(self.es_conn, actions, thread_count=self.workers, **self._bulk_options())
+        return helpers.streaming_bulk(self.es_conn, actions, **self._bulk_options())
+
+    @staticmethod
+    def _describe(failed):
+        return [{'id': record_id(f['record']), 'status': f['status'], 'error': f['error']} for f in failed]
+
+    def _log_throughput(self, result: LoadResult):
+        elapsed = result.elapsed or 1e-9
+        message = (
+            f"Успешно загружено: {result.success}. Не удалось загрузить: {len(result.failed)}. "
+            f"{result.success / elapsed:.0f} док./сек., {result.bytes / elapsed / 1024:.0f} КиБ/сек."
+        )
+        if result.outdated:
+            message += f" Отклонено как устаревшие: {len(result.outdated)}."
+        if self.fingerprints is not None:
+            message += (f" Пропущено без изменений: {result.skipped} "
+                        f"(всего {self.fingerprints.skip_rate():.1%}).")
+        logging.info(message)
+
+
+class BulkBatch:
+    """
+    Загрузка одной пачки, общая для синхронного и асинхронного загрузчиков: они только
+    отправляют bulk и ждут между попытками, а разбор ответов по документам, повторы после 429
+    и учёт отпечатков выполняются здесь.
+    """
+
+    def __init__(self, loader: ElasticsearchLoader, records: list, versions: dict = None):
+        self.loader = loader
+        self.versions = versions
+        self.result = LoadResult()
+        self.started = time.perf_counter()
+        # {id: (запись, байты JSON)} документов, которые ещё нужно отправить
+        self.pending = loader._encode(records)
+        self.digests = {}
+        self.attempt = 0
+        self._rejected = {}
+
+    def skip_unchanged(self) -> None:
+        """Убирает документы с прежним отпечатком и запоминает отпечатки остальных. Обращается к Redis."""
+        fingerprints = self.loader.fingerprints
+        if fingerprints is not None and self.pending:
+            self.digests = fingerprints.changed(
+                {doc_id: fingerprint(source) for doc_id, (_, source) in self.pending.items()}
+            )
+            for doc_id in self.pending.keys() - self.digests.keys():
+                del self.pending[doc_id]
+                self.result.skipped += 1
+        self.result.bytes = sum(len(source) for _, source in self.pending.values())
+
+    def actions(self):
+        return self.loader._actions(self.pending, self.versions)
+
+    def collect(self, ok, item) -> None:
+        """Раскладывает ответ по документу: успех, устаревшая версия, повтор после 429 или окончательный отказ."""
+        op_type, info = item.popitem()
+        if ok:
+            self.result.success += 1
+            return
+        doc_id = info.get('_id')
+        record, source = self.pending[doc_id]
+        if info.get('status') == VERSION_CONFLICT:
+            self.result.outdated.append(doc_id)
+        elif info.get('status') == TOO_MANY_REQUESTS and self.attempt < self.loader.max_retries:
+            self._rejected[doc_id] = (record, source)
+        else:
+            self.result.failed.append({'record': record, 'status': info.get('status'), 'error': info.get('error')})
+
+    def next_attempt(self):
+        """Завершает попытку. Возвращает задержку перед повтором отклонённых с 429 или None, если повторять нечего."""
+        self.pending, self._rejected = self._rejected, {}
+        if not self.pending:
+            return None
+        delay = self.loader._retry_delay(self.attempt, len(self.pending))
+        self.attempt += 1
+        return delay
+
+    def remember(self) -> None:
+        """Запоминает отпечатки загруженных документов пачки, кроме отклонённых и устаревших. Обращается к Redis."""
+        if self.loader.fingerprints is None or not self.digests:
             return
+        for failed in self.result.failed:
+            self.digests.pop(record_id(failed['record']), None)
+        for doc_id in self.result.outdated:
+            self.digests.pop(doc_id, None)
+        self.loader.fingerprints.remember(self.digests)
+
+    def finish(self) -> LoadResult:
+        """Логирует скорость и отказы пачки и возвращает её итог."""
+        result = self.result
+        result.elapsed = time.perf_counter() - self.started
+        self.loader._log_throughput(result)
+        if result.failed:
+            # Эти ошибки не связаны со сбоем соединения, а с самими данными.
+            # Backoff их не поймает, они будут просто залогированы.
+            logging.error(f"Ошибки при загрузке данных (не связаны с соединением): {self.loader._describe(result.failed)}")
+        return result
+
+
+def observe_result(result: LoadResult) -> None:
+    """Учитывает итог пачки в метриках; общий для загрузки из очереди в обоих режимах."""
+    DOCUMENTS_SKIPPED.inc(result.skipped)
+    DOCUMENTS_OUTDATED.inc(len(result.outdated))
+    DOCUMENTS_FAILED.inc(len(result.failed))
+    if result.failed:
+        # Отказ по самим данным немедленным повтором не исправить: документы переносятся
+        # в поток недоставленных при подтверждении пачки (см. RedisStreamQueue.ack).
+        logging.warning(f"{len(result.failed)} документов отклонены Elasticsearch: после исправления данных их "
+                        f"загрузит следующее изменение фильма или команда reconcile.")
+
+
+class AsyncElasticsearchLoader(ElasticsearchLoader):
+    """Загрузчик поверх AsyncElasticsearch: та же логика чанков, повторов и отчёта по документам (BulkBatch)."""
+
+    def __init__(self, es_conn: AsyncElasticsearch, index_name: str, **kwargs):
+        super().__init__(es_conn, index_name, **kwargs)
+
+    async def load_to_es(self, records: list, versions: dict = None) -> LoadResult:
+        return await self.load_stream(records, versions)
+
+    @async_backoff(exceptions=(ConnectionError,), service_name="Elasticsearch")
+    async def load_stream(self, records: list, versions: dict = None) -> LoadResult:
+        if not records:
+            return LoadResult()
 
-        actions = [
-            {
-                "_index": self.index_name,
-                "_id": record['id'],
-                "_source": record
-            }
-            for record in records
-        ]
-
-        try:
-            success, failed = helpers.bulk(self.es_conn, actions)
-            logging.info(f"Успешно загружено: {success}. Не удалось загрузить: {failed}.")
-            if failed:
-                # Эти ошибки не связаны со сбоем соединения, а с самими данными.
-                # Backoff их не поймает, они будут просто залогированы.
-                logging.error(f"Ошибки при загрузке данных (не связаны с соединением): {failed}")
-
-        except Exception as e:
-            # Эта секция может поймать другие ошибки, не ConnectionError
-            logging.error(f"Непредвиденная ошибка при bulk-загрузке в Elasticsearch: {e}")
-            raise
+        batch = BulkBatch(self, records, versions)
+        await asyncio.to_thread(batch.skip_unchanged)
+        while batch.pending:
+            async for ok, item in helpers.async_streaming_bulk(self.es_conn, batch.actions(), **self._bulk_options()):
+                batch.collect(ok, item)
+            delay = batch.next_attempt()
+            if delay is not None:
+                await asyncio.sleep(delay)
+        await asyncio.to_thread(batch.remember)
+        return batch.finish()
@@ -1,111 +1,710 @@
+import argparse
+import asyncio
+import json
 import logging
+import os
 import time
-import json
 
 from psycopg import OperationalError
 from redis import Redis
 
-from utils import pg_conn_context, redis_conn_context, connect_es
-from state import State, RedisStorage
+from utils import pg_conn_context, pg_pool_context, redis_conn_context, connect_es
+from state import BaseStorage, State, RedisStorage, JsonFileStorage, FanoutCheckpoint
 from producer import PostgresProducer
 from enricher import PostgresEnricher
 from merger import PostgresMerger
 from transformer import PostgresTransformer
-from loader import ElasticsearchLoader
+from loader import ElasticsearchLoader, observe_result
+from fingerprints import FingerprintStore
+from partial_updates import PartialUpdater
+from doc_queue import RedisStreamQueue, current_version, latest_documents
+from scheduler import AdaptiveScheduler
+from dirty_set import DirtyFilmSet
+from sharding import Shard, ShardCoordinator
+from reindex import FullReindexer
+from changefeed import PostgresChangeListener
+from async_pipeline import AsyncPipeline
+from index_manager import IndexManager
+from plan_audit import PlanAuditor, format_report
+from reconciler import Reconciler
+from metrics import (configure as configure_metrics, observe_lag, observe_queue, slow_batch_logger, start_metrics_server,
+                     track_stage)
 from config import settings
 
-def process_source(config: dict, producers: dict[str, PostgresProducer], enricher: PostgresEnricher, merger: PostgresMerger, transformer: PostgresTransformer, redis_connection: Redis):
+def push_films(film_work_ids: list, merger: PostgresMerger, transformer: PostgresTransformer, doc_queue: RedisStreamQueue,
+               stage=None):
+    """
+    Собирает документы указанных фильмов и кладёт их в очередь.
+    stage добавляет к записи в очередь свои команды в той же транзакции (см. RedisStreamQueue.push).
+    """
+    logging.info(f"Подготовка к обработке данных для {len(film_work_ids)} фильмов.")
+
+    with track_stage('merge', rows_in=len(film_work_ids)) as batch:
+        raw_data = merger.fetch(film_work_ids, settings.merge_mode)
+        batch.rows_out = len(raw_data)
+    with track_stage('transform', rows_in=len(raw_data)) as batch:
+        transformed_data = transformer.transform(raw_data, settings.merge_mode)
+        batch.rows_out = len(transformed_data)
+
+    if transformed_data:
+        logging.info(f"Отправка {len(transformed_data)} документов в очередь '{doc_queue.stream}'...")
+    else:
+        logging.warning("Данные не были трансформированы, т.к. transformer вернул пустой результат.")
+    if transformed_data or stage is not None:
+        with track_stage('queue_push', rows_in=len(transformed_data)) as batch:
+            batch.bytes = doc_queue.push(transformed_data, stage)
+            batch.rows_out = len(transformed_data)
+
+def process_changes(changes: dict, enricher: PostgresEnricher, merger: PostgresMerger, transformer: PostgresTransformer, doc_queue: RedisStreamQueue,
+                    dirty_set: DirtyFilmSet):
+    """
+    Обрабатывает изменения, пришедшие через NOTIFY: id персон и жанров
+    разворачиваются в фильмы, после чего фильмы проходят обычный путь merge -> transform -> очередь.
+    Состояния продюсеров не меняются: keyset-опрос остаётся сверочным путём.
+    """
+    logging.info(f"Получены уведомления об изменениях: {dict((k, len(v)) for k, v in changes.items())}.")
+    dirty_set.add(changes.get('film_work', ()), 'film_work')
+    for config in settings.producer_configs:
+        source_ids = changes.get(config.source_type)
+        if config.enrich and source_ids:
+            for chunk in enricher.iter_film_ids(list(source_ids), config.source_type):
+                dirty_set.add(chunk, config.source_type)
+
+    flush_dirty_films(dirty_set, merger, transformer, doc_queue)
+    dirty_set.end_cycle()
+
+def wait_for_changes(listener: PostgresChangeListener, timeout: float, enricher: PostgresEnricher, merger: PostgresMerger,
+                     transformer: PostgresTransformer, loader: ElasticsearchLoader, doc_queue: RedisStreamQueue, dirty_set: DirtyFilmSet):
+    """Вместо сна ждёт уведомления об изменениях и сразу прогоняет их до Elasticsearch."""
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        changes = listener.poll(remaining, max_items=settings.change_feed_max_batch)
+        if changes:
+            process_changes(changes, enricher, merger, transformer, doc_queue, dirty_set)
+            load_data_to_es(loader, doc_queue)
+
+def collect_source(config: dict, producer: PostgresProducer, enricher: PostgresEnricher, dirty_set: DirtyFilmSet,
+                   partial: PartialUpdater = None):
     """
-    Выполняет полный цикл ETL для одного источника данных (одной таблицы).
+    Извлекает страницу источника и отмечает затронутые фильмы в множестве грязных фильмов.
+    Связанные фильмы разворачиваются постранично, а прогресс разворачивания сохраняется
+    в одной транзакции с отметкой фильмов, чтобы после падения продолжить с того же места.
+    Если задан partial, переименования персон и жанров не разворачиваются,
+    а откладываются для частичного обновления.
+    Возвращает строки источника, отметку прогресса разворачивания и разбор изменений (или None).
+    У источников без разворачивания отметки нет: их курсор сдвигается здесь же.
     """
     source_type = config['source_type']
-    producer = producers[source_type]
 
     logging.info(f"-> Запуск producer для '{source_type}'...")
-    source_rows = producer.extract()
+    with track_stage('extract') as batch:
+        source_rows = producer.extract()
+        batch.rows_out = len(source_rows)
     if not source_rows:
         logging.info(f"Для '{source_type}' нет новых данных.")
-        return
+        return [], None, None
 
     logging.info(f"Producer извлек {len(source_rows)} записей из '{source_type}'.")
 
     source_ids = [row[0] for row in source_rows]
-    film_work_ids = enricher.enrich(source_ids, source_type) if config['enrich'] else source_ids
+    if not config['enrich']:
+        # Фильмы страницы и сдвиг курсора пишутся одной транзакцией: множество грязных фильмов
+        # хранится в Redis, поэтому после падения страница не извлекается и не собирается повторно.
+        cursor = producer.cursor_values(source_rows)
+        with dirty_set.redis.pipeline(transaction=True) as pipe:
+            dirty_set.stage_add(pipe, source_ids, source_type)
+            applied = producer.state.stage(pipe, cursor | FanoutCheckpoint.cleared())
+            pipe.execute()
+        applied()
+        logging.info(f"Состояние для '{source_type}' обновлено: modified={cursor['last_updated_at']}, id={cursor['last_id']}\n")
+        return source_rows, None, None
 
-    if film_work_ids:
-        logging.info(f"Подготовка к обработке данных для {len(film_work_ids)} фильмов.")
+    changes = None
+    if partial is not None and partial.supports(source_type):
+        changes = partial.classify(source_type, source_ids)
+        source_ids = changes.rebuild_ids
 
-        raw_data = merger.fetch_merged_data(film_work_ids)
-        transformed_data = transformer.transform_data(raw_data)
+    checkpoint = FanoutCheckpoint(producer.state, source_ids)
+    resume_after = checkpoint.resume_after()
+    if resume_after:
+        logging.info(f"Продолжение разворачивания '{source_type}' после фильма {resume_after}.")
+    with track_stage('enrich', rows_in=len(source_ids)) as batch:
+        for film_work_ids in enricher.iter_film_ids(source_ids, source_type, after_id=resume_after):
+            with dirty_set.redis.pipeline(transaction=True) as pipe:
+                dirty_set.stage_add(pipe, film_work_ids, source_type)
+                applied = checkpoint.stage(pipe, film_work_ids[-1])
+                pipe.execute()
+            applied()
+            batch.rows_out += len(film_work_ids)
+    return source_rows, checkpoint, changes
 
-        if transformed_data:
-            output_queue_name = 'processed_movies_queue'
-            logging.info(f"Отправка {len(transformed_data)} документов в очередь '{output_queue_name}'...")
-            for doc in transformed_data:
-                redis_connection.rpush(output_queue_name, json.dumps(doc, default=str))
-        else:
-            logging.warning("Данные не были трансформированы, т.к. transformer вернул пустой результат.")
-    else:
-        logging.warning(f"После обогащения для '{source_type}' не осталось фильмов для обработки.")
+def flush_dirty_films(dirty_set: DirtyFilmSet, merger: PostgresMerger, transformer: PostgresTransformer, doc_queue: RedisStreamQueue,
+                      on_chunk=None):
+    """
+    Собирает каждый грязный фильм ровно один раз: merge -> transform -> очередь пачками,
+    после каждой пачки вызывается on_chunk (например, загрузка в ES).
+    Пачка удаляется из множества в одной транзакции с записью её документов в очередь.
+    """
+    for film_work_ids in dirty_set.batches(settings.batch_size):
+        push_films(film_work_ids, merger, transformer, doc_queue,
+                   stage=lambda pipe, ids=film_work_ids: dirty_set.stage_remove(pipe, ids))
+        if on_chunk is not None:
+            on_chunk()
 
-    last_modified, last_id = source_rows[-1][1], str(source_rows[-1][0])
-    producer.state.set_state('last_updated_at', str(last_modified))
-    producer.state.set_state('last_id', last_id)
-    logging.info(f"Состояние для '{source_type}' обновлено: modified={last_modified}, id={last_id}\n")
+def commit_source(source_type: str, producer: PostgresProducer, source_rows: list, checkpoint: FanoutCheckpoint):
+    """Сдвигает курсор источника за обработанную страницу и снимает отметку разворачивания одной записью."""
+    cursor = producer.cursor_values(source_rows)
+    producer.state.set_states(cursor | checkpoint.cleared())
+    logging.info(f"Состояние для '{source_type}' обновлено: modified={cursor['last_updated_at']}, id={cursor['last_id']}\n")
 
-def load_data_to_es(es_loader: ElasticsearchLoader, redis_connection: Redis, queue_name: str = 'processed_movies_queue'):
+def process_sources(configs: list, producers: dict[str, PostgresProducer], enricher: PostgresEnricher, merger: PostgresMerger, transformer: PostgresTransformer,
+                    doc_queue: RedisStreamQueue, dirty_set: DirtyFilmSet, on_chunk=None, partial: PartialUpdater = None) -> dict[str, int]:
+    """
+    Выполняет один цикл ETL для указанных источников: все источники отмечают
+    затронутые фильмы в общем множестве, каждый фильм собирается один раз,
+    и только после этого сдвигаются курсоры разворачиваемых источников. Курсор остальных
+    сдвигается вместе с отметкой фильмов в collect_source.
+    Переименования применяются частичными обновлениями после пересборки и загрузки.
+    Скрипт обновления поднимает только внутреннюю версию документа, а у документа из очереди
+    внешняя версия больше, поэтому пока очередь не пуста, фильмы переименований
+    пересобираются целиком и проходят через очередь с новой версией.
+    Фильмы, которые не удалось обновить частично, тоже пересобираются целиком.
+    Возвращает количество извлечённых записей по каждому источнику.
+    """
+    collected = {}
+    for config in configs:
+        collected[config['source_type']] = collect_source(config, producers[config['source_type']], enricher, dirty_set, partial)
+
+    flush_dirty_films(dirty_set, merger, transformer, doc_queue, on_chunk)
+
+    for source_type, (_, _, changes) in collected.items():
+        if changes is not None and changes.renames:
+            if doc_queue.length():
+                logging.info(f"Очередь '{doc_queue.stream}' не пуста: переименования '{source_type}' "
+                             f"({len(changes.renames)}) применяются пересборкой фильмов.")
+                for film_work_ids in enricher.iter_film_ids(list(changes.renames), source_type):
+                    dirty_set.add(film_work_ids, source_type)
+                continue
+            with track_stage('partial_update', rows_in=len(changes.renames)) as batch:
+                failed = partial.apply_renames(source_type, changes.renames)
+                batch.rows_out = len(changes.renames)
+            dirty_set.add(failed, source_type)
+    flush_dirty_films(dirty_set, merger, transformer, doc_queue, on_chunk)
+
+    for source_type, (source_rows, checkpoint, changes) in collected.items():
+        if checkpoint is not None:
+            if changes is not None:
+                partial.commit(source_type, changes.snapshots)
+            commit_source(source_type, producers[source_type], source_rows, checkpoint)
+    dirty_set.end_cycle()
+
+    return {source_type: len(source_rows) for source_type, (source_rows, _, _) in collected.items()}
+
+def build_storage(redis_connection: Redis, state_key: str) -> BaseStorage:
+    """Хранилище состояния источника: hash в Redis или JSON-файл для локальных запусков."""
+    if settings.state_storage == 'file':
+        return JsonFileStorage(os.path.join(settings.state_dir, f"{state_key}.json"))
+    return RedisStorage(redis_connection, state_key)
+
+def configured_shards() -> list[Shard]:
+    """Шарды процессов worker: у каждого свои курсоры и снимки переименований. Пусто без SHARD_WORKERS."""
+    if not settings.shard_workers:
+        return []
+    return [Shard(index, settings.shard_count) for index in range(settings.shard_count)]
+
+def state_configs() -> list:
+    """Конфигурации источников с ключами всех состояний: общих и каждого шарда."""
+    return list(settings.producer_configs) + [
+        config.model_copy(update={'state_key': shard.key(config.state_key)})
+        for shard in configured_shards()
+        for config in settings.producer_configs
+    ]
+
+def swap_cursors_storage(redis_connection: Redis, index_name: str) -> BaseStorage:
+    """Курсоры источников на момент, когда алиас переключили с index_name: {ключ состояния: курсор}."""
+    return build_storage(redis_connection, f"{settings.swap_cursors_prefix}:{index_name}")
+
+def save_swap_cursors(redis_connection: Redis, index_names: list):
+    """
+    Запоминает текущие курсоры источников для индексов, с которых переключается алиас.
+    Изменения до этих курсоров в индексах уже есть, более новые уйдут только в новую версию.
+    """
+    cursors = {}
+    for config in state_configs():
+        state = State(build_storage(redis_connection, config.state_key))
+        if state.get_state('last_updated_at') is not None:
+            cursors[config.state_key] = {key: state.get_state(key) for key in ('last_updated_at', 'last_id')}
+    for index_name in index_names:
+        swap_cursors_storage(redis_connection, index_name).save_state(cursors)
+        logging.info(f"Курсоры {len(cursors)} состояний сохранены для отката на '{index_name}'.")
+
+def build_fingerprints(redis_connection: Redis):
+    """Хранилище отпечатков документов или None, если оно выключено."""
+    if not settings.fingerprint_cache:
+        return None
+    return FingerprintStore(redis_connection, settings.fingerprint_key)
+
+def build_loader(es_conn, index_name: str, fingerprints: FingerprintStore = None) -> ElasticsearchLoader:
+    """Создаёт загрузчик с параметрами bulk из настроек."""
+    return ElasticsearchLoader(
+        es_conn,
+        index_name,
+        workers=settings.es.bulk_workers,
+        chunk_size=settings.es.bulk_chunk_size,
+        max_chunk_bytes=settings.es.bulk_max_chunk_bytes,
+        max_retries=settings.es.bulk_max_retries,
+        initial_backoff=settings.es.bulk_initial_backoff,
+        max_backoff=settings.es.bulk_max_backoff,
+        fingerprints=fingerprints,
+    )
+
+def build_partial_updater(pg_conn, es_conn, redis_connection: Redis, enricher: PostgresEnricher,
+                          fingerprints: FingerprintStore = None, shard: Shard = None):
+    """Частичные обновления при переименованиях или None, если они выключены."""
+    if not settings.partial_updates:
+        return None
+    key_prefix = shard.key(settings.snapshot_key_prefix) if shard else settings.snapshot_key_prefix
+    return PartialUpdater(pg_conn, es_conn, settings.es.index, redis_connection, enricher, fingerprints, key_prefix)
+
+def build_queue(redis_connection: Redis) -> RedisStreamQueue:
+    """
+    Создаёт очередь документов между трансформацией и загрузкой.
+    Соединение должно быть бинарным (decode_responses=False).
+    """
+    return RedisStreamQueue(
+        redis_connection,
+        stream=settings.queue_stream,
+        group=settings.queue_group,
+        claim_idle_ms=settings.queue_claim_idle_ms,
+        codec=settings.queue_codec,
+        entry_size=settings.batch_size,
+        passthrough=settings.queue_passthrough,
+        dead_letter_stream=settings.queue_dead_letter_stream,
+    )
+
+def load_data_to_es(es_loader: ElasticsearchLoader, doc_queue: RedisStreamQueue, block_ms: int = None):
     """
     Извлекает данные из очереди Redis и загружает их в Elasticsearch пачками.
+    Сообщения подтверждаются только после bulk-загрузки, поэтому после падения
+    неподтверждённая пачка будет доставлена повторно, а несколько загрузчиков
+    могут разбирать очередь параллельно. Отклонённые документы при подтверждении
+    переносятся в поток недоставленных.
     """
-    logging.info(f"Проверка очереди '{queue_name}' на наличие данных для загрузки в Elasticsearch...")
-    
-    while redis_connection.llen(queue_name) > 0:
-        records_to_load_str = redis_connection.lrange(queue_name, 0, settings.batch_size - 1)
-        records_to_load = [json.loads(rec) for rec in records_to_load_str]
+    logging.info(f"Проверка очереди '{doc_queue.stream}' на наличие данных для загрузки в Elasticsearch...")
 
+    while True:
+        messages = doc_queue.read(settings.batch_size, block_ms=block_ms)
+        if not messages:
+            break
+
+        message_ids = [message.id for message in messages]
+        # Внешние версии из id сообщений: повторно доставленная устаревшая пачка не перезапишет более новую.
+        records_to_load, versions = latest_documents(messages)
         logging.info(f"Извлечено {len(records_to_load)} документов из Redis для загрузки.")
 
-        es_loader.load_to_es(records_to_load)
+        with track_stage('bulk_load', rows_in=len(records_to_load)) as batch:
+            result = es_loader.load_to_es(records_to_load, versions)
+            batch.rows_out, batch.bytes = result.success, result.bytes
+        observe_result(result)
 
-        redis_connection.ltrim(queue_name, len(records_to_load), -1)
-        logging.info(f"Успешно обработанная пачка удалена из очереди '{queue_name}'.")
+        doc_queue.ack(message_ids, result.failed)
+        logging.info(f"Пачка подтверждена и удалена из очереди '{doc_queue.stream}'.")
 
+    observe_queue(doc_queue)
     logging.info("Очередь пуста. Загрузка в Elasticsearch завершена на данный момент.")
 
-def main():
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-
+def run_sync():
+    """Инкрементальная синхронизация: бесконечный цикл опроса источников."""
     try:
         with redis_conn_context(**settings.redis.to_dict()) as redis_connection, \
-             connect_es(hosts=[f"http://{settings.es.host}:{settings.es.port}"]) as es_conn:
+             redis_conn_context(**settings.redis.to_dict() | {'decode_responses': False}) as queue_connection, \
+             connect_es(hosts=[f"http://{settings.es.host}:{settings.es.port}"]) as es_conn, \
+             pg_pool_context(
+                 min_size=settings.pg_pool_min_size,
+                 max_size=settings.pg_pool_max_size,
+                 prepare_threshold=settings.pg_prepare_threshold,
+                 **settings.pg.to_dict(),
+             ) as pg_pool:
+
+            logging.info("Соединения с Redis, Elasticsearch и пул PostgreSQL установлены.")
 
-            logging.info("Соединения с Redis и Elasticsearch установлены.")
+            loader = build_loader(es_conn, settings.es.index, build_fingerprints(redis_connection))
+            doc_queue = build_queue(queue_connection)
+            dirty_set = DirtyFilmSet(redis_connection, settings.dirty_set_key)
+            # С подпиской на изменения опрос нужен только как сверка и может идти реже.
+            poll_interval = settings.change_feed_reconcile_interval if settings.change_feed else settings.sleep_time
+            scheduler = AdaptiveScheduler(
+                [config.source_type for config in settings.producer_configs],
+                batch_size=settings.batch_size,
+                sleep_time=poll_interval,
+                max_sleep_time=max(settings.max_sleep_time, poll_interval),
+                backoff_factor=settings.sleep_backoff_factor,
+                report_every=settings.catchup_report_every,
+            )
 
-            loader = ElasticsearchLoader(es_conn, settings.es.index)
+            listener = None
+            if settings.change_feed:
+                listener = PostgresChangeListener(settings.pg.to_dict(), settings.change_feed_channel)
 
             while True:
                 try:
-                    with pg_conn_context(**settings.pg.to_dict()) as p_conn:
-                        states = {config.state_key: State(RedisStorage(redis_connection, config.state_key)) for config in settings.producer_configs}
+                    # Соединение из пула живёт между циклами, поэтому подготовленные
+                    # на нём запросы переиспользуются, а не разбираются заново.
+                    with pg_pool.connection() as p_conn:
+                        cycle_started = time.perf_counter()
+                        states = {config.state_key: State(build_storage(redis_connection, config.state_key)) for config in settings.producer_configs}
                         producers = {config.source_type: PostgresProducer(p_conn, states[config.state_key], config.table, settings.batch_size) for config in settings.producer_configs}
                         enricher = PostgresEnricher(p_conn, settings.batch_size)
                         merger = PostgresMerger(p_conn, settings.batch_size)
                         transformer = PostgresTransformer(enricher)
+                        partial = build_partial_updater(p_conn, es_conn, redis_connection, enricher, loader.fingerprints)
 
-                        for config in settings.producer_configs:
-                            process_source(config.model_dump(), producers, enricher, merger, transformer, redis_connection)
+                        # Пока хотя бы один источник отдаёт полные пачки, забираем следующие страницы без паузы.
+                        while True:
+                            due_sources = scheduler.due()
+                            due_configs = [config.model_dump() for config in settings.producer_configs if config.source_type in due_sources]
+                            rows_counts = process_sources(
+                                due_configs, producers, enricher, merger, transformer, doc_queue, dirty_set,
+                                on_chunk=lambda: load_data_to_es(loader, doc_queue), partial=partial,
+                            )
+                            for source_type, rows_count in rows_counts.items():
+                                observe_lag(source_type, producers[source_type])
+                                scheduler.record(source_type, rows_count)
+                                if scheduler.should_report(source_type):
+                                    scheduler.report_progress(source_type, producers[source_type])
 
-                except OperationalError as e:
-                    logging.warning(f"Не удалось подключиться к PostgreSQL в этом цикле. Повтор через 5 секунд. Ошибка: {e}")
+                            if not scheduler.has_backlog():
+                                break
+                            # Разгружаем очередь между страницами, чтобы она не разрасталась во время догоняющей выгрузки.
+                            load_data_to_es(loader, doc_queue)
 
-                load_data_to_es(loader, redis_connection)
+                        load_data_to_es(loader, doc_queue)
 
-                logging.info(f"--- Все источники обработаны. Пауза {settings.sleep_time} секунд. ---\n")
-                time.sleep(settings.sleep_time)
+                        pause = scheduler.next_sleep()
+                        logging.info(f"--- Все источники обработаны за {time.perf_counter() - cycle_started:.3f} сек. "
+                                     f"Пауза {pause:.1f} секунд. ---\n")
+                        if listener is not None:
+                            wait_for_changes(listener, pause, enricher, merger, transformer, loader, doc_queue, dirty_set)
+                        else:
+                            time.sleep(pause)
+
+                except OperationalError as e:
+                    logging.warning(f"Не удалось подключиться к PostgreSQL в этом цикле. Ошибка: {e}")
+                    load_data_to_es(loader, doc_queue)
+                    time.sleep(settings.sleep_time)
 
     except Exception as e:
         logging.error(f"Критическая ошибка в главном цикле ETL: {e}", exc_info=True)
 
 
+def process_shard(shard: Shard, p_conn, es_conn, redis_connection: Redis, loader: ElasticsearchLoader,
+                  doc_queue: RedisStreamQueue) -> dict[str, int]:
+    """
+    Один цикл ETL для шарда. У шарда свои курсоры источников, множество грязных фильмов
+    и снимки для частичных обновлений. film_work читается только в пределах шарда
+    (по индексу plan_audit.shard_index), а изменения персон и жанров каждый шард читает
+    целиком по своему курсору и разворачивает в свои фильмы. Страницы изменений персон
+    и жанров читаются по индексу (updated_at, id), и повторное чтение каждым шардом дешевле,
+    чем раскладывать фильмы одного чтения по множествам чужих шардов.
+    """
+    enricher = PostgresEnricher(p_conn, settings.batch_size, shard=shard)
+    producers = {
+        config.source_type: PostgresProducer(
+            p_conn,
+            State(build_storage(redis_connection, shard.key(config.state_key))),
+            config.table,
+            settings.batch_size,
+            shard=None if config.enrich else shard,
+        )
+        for config in settings.producer_configs
+    }
+    rows_counts = process_sources(
+        [config.model_dump() for config in settings.producer_configs],
+        producers,
+        enricher,
+        PostgresMerger(p_conn, settings.batch_size),
+        PostgresTransformer(enricher),
+        doc_queue,
+        DirtyFilmSet(redis_connection, shard.key(settings.dirty_set_key)),
+        on_chunk=lambda: load_data_to_es(loader, doc_queue),
+        partial=build_partial_updater(p_conn, es_conn, redis_connection, enricher, loader.fingerprints, shard),
+    )
+    for source_type, producer in producers.items():
+        observe_lag(f"{source_type}:{shard.suffix}", producer)
+    return rows_counts
+
+
+def run_worker():
+    """
+    Шардированный режим: процессы делят фильмы по hash(id) mod SHARD_COUNT
+    и координируются арендами в Redis. Можно запускать любое число экземпляров.
+    """
+    with redis_conn_context(**settings.redis.to_dict()) as redis_connection, \
+         redis_conn_context(**settings.redis.to_dict() | {'decode_responses': False}) as queue_connection, \
+         connect_es(hosts=[f"http://{settings.es.host}:{settings.es.port}"]) as es_conn, \
+         pg_pool_context(
+             min_size=settings.pg_pool_min_size,
+             max_size=settings.pg_pool_max_size,
+             prepare_threshold=settings.pg_prepare_threshold,
+             **settings.pg.to_dict(),
+         ) as pg_pool:
+
+        if not settings.shard_workers:
+            logging.warning("SHARD_WORKERS не включён: reindex не выставит курсоры шардов, "
+                            "и после переиндексации шарды начнут выгрузку сначала.")
+        loader = build_loader(es_conn, settings.es.index, build_fingerprints(redis_connection))
+        doc_queue = build_queue(queue_connection)
+        coordinator = ShardCoordinator(redis_connection, settings.shard_count,
+                                       lease_ttl=settings.shard_lease_ttl, prefix=settings.shard_key_prefix)
+        coordinator.start()
+        try:
+            while True:
+                has_backlog = False
+                try:
+                    with pg_pool.connection() as p_conn:
+                        cycle_started = time.perf_counter()
+                        shards = coordinator.rebalance()
+                        for shard in shards:
+                            rows_counts = process_shard(shard, p_conn, es_conn, redis_connection, loader, doc_queue)
+                            has_backlog |= any(count >= settings.batch_size for count in rows_counts.values())
+                        load_data_to_es(loader, doc_queue)
+                        logging.info(f"--- Шарды {[shard.index for shard in shards]} обработаны "
+                                     f"за {time.perf_counter() - cycle_started:.3f} сек. ---\n")
+                except OperationalError as e:
+                    logging.warning(f"Не удалось подключиться к PostgreSQL в этом цикле. Ошибка: {e}")
+                    load_data_to_es(loader, doc_queue)
+                if not has_backlog:
+                    time.sleep(settings.sleep_time)
+        finally:
+            coordinator.stop()
+
+
+def run_async():
+    """Инкрементальная синхронизация в асинхронном режиме (EXECUTION_MODE=async)."""
+    try:
+        asyncio.run(AsyncPipeline(settings).run())
+    except Exception as e:
+        logging.error(f"Критическая ошибка в асинхронном конвейере ETL: {e}", exc_info=True)
+
+
+def run_load_worker():
+    """
+    Отдельный загрузчик: бесконечно разбирает очередь документов в Elasticsearch.
+    Можно запускать в нескольких экземплярах параллельно.
+    """
+    with redis_conn_context(**settings.redis.to_dict() | {'decode_responses': False}) as queue_connection, \
+         connect_es(hosts=[f"http://{settings.es.host}:{settings.es.port}"]) as es_conn:
+
+        loader = build_loader(es_conn, settings.es.index, build_fingerprints(queue_connection))
+        doc_queue = build_queue(queue_connection)
+        logging.info(f"Загрузчик '{doc_queue.consumer}' запущен.")
+        while True:
+            load_data_to_es(loader, doc_queue, block_ms=settings.sleep_time * 1000)
+
+
+def run_reindex(in_place: bool = False, drop_legacy_index: bool = False):
+    """
+    Полная переиндексация каталога с последующим переводом состояний на high-water mark.
+    По умолчанию загружает новую версию индекса и атомарно переключает на неё алиас.
+    Если имя алиаса занято обычным индексом старой схемы, переиндексация не начинается:
+    при переключении он был бы удалён, поэтому это разрешается только с drop_legacy_index.
+    """
+    with redis_conn_context(**settings.redis.to_dict()) as redis_connection, \
+         connect_es(hosts=[f"http://{settings.es.host}:{settings.es.port}"]) as es_conn, \
+         pg_conn_context(**settings.pg.to_dict()) as p_conn:
+
+        index_manager = IndexManager(es_conn, settings.es.index, settings.es.schema_path)
+        if in_place:
+            index_name = settings.es.index
+        else:
+            index_manager.check_legacy_index(drop_legacy_index)
+            index_name = index_manager.create_bulk_index(index_manager.next_index_name())
+
+        # Отпечатки описывают документы, загруженные через алиас. При загрузке на месте
+        # их сбрасываем заранее, а для новой версии индекса — после переключения алиаса,
+        # потому что до него инкрементальная синхронизация продолжает писать в старую версию.
+        fingerprints = build_fingerprints(redis_connection)
+        if in_place and fingerprints is not None:
+            fingerprints.reset()
+        # Снимки переименований тоже описывают загруженные документы и сбрасываются вместе с отпечатками.
+        partials = [build_partial_updater(p_conn, es_conn, redis_connection, None)]
+        partials += [build_partial_updater(p_conn, es_conn, redis_connection, None, shard=shard) for shard in configured_shards()]
+        partials = [partial for partial in partials if partial is not None]
+        if in_place:
+            for partial in partials:
+                partial.reset()
+        loader = build_loader(es_conn, index_name, fingerprints if in_place else None)
+        reindexer = FullReindexer(
+            p_conn,
+            PostgresMerger(p_conn, settings.reindex_chunk_size),
+            PostgresTransformer(PostgresEnricher(p_conn, settings.batch_size)),
+            loader,
+            # Курсоры шардов выставляются на те же high-water marks, что и общие.
+            state_configs(),
+            lambda state_key: build_storage(redis_connection, state_key),
+            clock=lambda: current_version(redis_connection),
+        )
+        marks = reindexer.run()
+
+        # Состояния переводятся только после переключения алиаса: изменения, которые
+        # синхронизация загрузит в старую версию за время force merge, она повторит в новой.
+        if not in_place:
+            index_manager.finalize(index_name, before_swap=lambda previous: save_swap_cursors(redis_connection, previous),
+                                   drop_legacy_index=drop_legacy_index)
+            if fingerprints is not None:
+                fingerprints.reset()
+            for partial in partials:
+                partial.reset()
+        reindexer.commit_states(marks)
+
+
+def run_rollback(reconcile: bool = True):
+    """
+    Переключает алиас на предыдущую версию индекса и возвращает курсоры источников к моменту,
+    когда алиас с неё переключили: синхронизация со следующего цикла повторит все изменения,
+    сделанные с тех пор. Документы, которые в тот момент были в очереди или в множестве грязных
+    фильмов, ушли в новую версию — их досылает сверка, она запускается после отката.
+    """
+    with redis_conn_context(**settings.redis.to_dict()) as redis_connection, \
+         connect_es(hosts=[f"http://{settings.es.host}:{settings.es.port}"]) as es_conn:
+        index_name = IndexManager(es_conn, settings.es.index, settings.es.schema_path).rollback()
+        # Предыдущая версия индекса содержит более старые документы.
+        fingerprints = build_fingerprints(redis_connection)
+        if fingerprints is not None:
+            fingerprints.reset()
+        partials = [build_partial_updater(None, es_conn, redis_connection, None)]
+        partials += [build_partial_updater(None, es_conn, redis_connection, None, shard=shard) for shard in configured_shards()]
+        for partial in partials:
+            if partial is not None:
+                partial.reset()
+
+        cursors = swap_cursors_storage(redis_connection, index_name).retrieve_state()
+        for state_key, cursor in cursors.items():
+            State(build_storage(redis_connection, state_key)).set_states(cursor | FanoutCheckpoint.cleared())
+            logging.info(f"Состояние '{state_key}' возвращено к моменту переключения: "
+                         f"modified={cursor['last_updated_at']}, id={cursor['last_id']}")
+        if not cursors:
+            logging.warning(f"Курсоры на момент переключения с '{index_name}' не сохранены: "
+                            f"изменения после него досылает только сверка.")
+        logging.info(f"Откат выполнен, алиас '{settings.es.index}' указывает на '{index_name}'.")
+
+    if reconcile:
+        run_reconcile()
+    else:
+        logging.warning("Сверка после отката пропущена: запустите команду reconcile.")
+
+
+def run_audit_plans(create_indexes: bool = False, output: str = None):
+    """
+    EXPLAIN (ANALYZE, BUFFERS) запросов ETL с отметкой последовательных сканирований и сортировок.
+    С create_indexes создаёт недостающие индексы CONCURRENTLY и повторяет замер.
+    """
+    with pg_conn_context(**settings.pg.to_dict(), autocommit=True) as p_conn:
+        auditor = PlanAuditor(p_conn, settings.producer_configs, settings.batch_size,
+                              settings.shard_count if settings.shard_workers else None)
+        missing = auditor.missing_indexes()
+        if missing:
+            logging.warning(f"Нет индексов для запросов ETL: {'; '.join(spec.describe() for spec in missing)}.")
+        before = auditor.audit()
+        after, created = None, []
+        if create_indexes:
+            created = auditor.create_indexes()
+            after = auditor.audit()
+
+    logging.info("Планы запросов ETL:\n" + "\n".join(format_report(before, after)))
+    flagged = sum(bool(report.seq_scans or report.sorts) for report in after or before)
+    logging.info(f"Запросов с Seq Scan или сортировкой: {flagged} из {len(before)}.")
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump({
+                'created_indexes': created,
+                'before': [report._asdict() for report in before],
+                'after': [report._asdict() for report in after] if after is not None else None,
+            }, f, ensure_ascii=False, indent=2)
+        logging.info(f"Отчёт записан в {output}.")
+
+
+def run_reconcile(dry_run: bool = False, rate: float = None):
+    """Сверяет индекс с PostgreSQL и исправляет только расходящиеся документы."""
+    with redis_conn_context(**settings.redis.to_dict()) as redis_connection, \
+         connect_es(hosts=[f"http://{settings.es.host}:{settings.es.port}"]) as es_conn, \
+         pg_conn_context(**settings.pg.to_dict(), autocommit=True) as p_conn:
+        reconciler = Reconciler(
+            es_conn,
+            settings.es.index,
+            PostgresMerger(p_conn, settings.reconcile_chunk_size),
+            PostgresTransformer(PostgresEnricher(p_conn, settings.batch_size)),
+            build_loader(es_conn, settings.es.index),
+            build_fingerprints(redis_connection),
+            chunk_size=settings.reconcile_chunk_size,
+            rate=settings.reconcile_rate if rate is None else rate,
+            dry_run=dry_run,
+            clock=lambda: current_version(redis_connection),
+        )
+        result = reconciler.run()
+    logging.info(f"Сверка завершена за {result.elapsed:.1f} сек.: сравнено {result.compared}, "
+                 f"нет в индексе {result.missing}, лишних {result.extra}, отличается {result.mismatched}; "
+                 f"пересобрано {result.reindexed}, удалено {result.deleted}.")
+
+
+def run_install_triggers():
+    """Устанавливает триггеры NOTIFY для подписки на изменения."""
+    PostgresChangeListener(settings.pg.to_dict(), settings.change_feed_channel).install_triggers()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description='ETL PostgreSQL -> Elasticsearch')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('sync', help='Инкрементальная синхронизация (по умолчанию)')
+    reindex_parser = subparsers.add_parser('reindex', help='Полная переиндексация каталога в новую версию индекса')
+    reindex_parser.add_argument('--in-place', action='store_true', help='Писать в текущий индекс без создания новой версии')
+    reindex_parser.add_argument('--drop-legacy-index', action='store_true',
+                                help='Удалить обычный индекс с именем алиаса при переключении (без возможности отката)')
+    subparsers.add_parser('load-worker', help='Только загрузка из очереди в Elasticsearch')
+    subparsers.add_parser('worker', help='Шардированная синхронизация: несколько процессов делят фильмы между собой')
+    subparsers.add_parser('install-triggers', help='Установить триггеры NOTIFY для подписки на изменения')
+    rollback_parser = subparsers.add_parser('rollback', help='Вернуть алиас на предыдущую версию индекса')
+    rollback_parser.add_argument('--no-reconcile', action='store_true', help='Не запускать сверку после отката')
+    reconcile_parser = subparsers.add_parser('reconcile', help='Сверить индекс с PostgreSQL и исправить расхождения')
+    reconcile_parser.add_argument('--dry-run', action='store_true', help='Только посчитать расхождения')
+    reconcile_parser.add_argument('--rate', type=float, default=None, help='Документов в секунду (0 — без ограничения)')
+    audit_parser = subparsers.add_parser('audit-plans', help='EXPLAIN (ANALYZE, BUFFERS) запросов ETL и проверка индексов')
+    audit_parser.add_argument('--create-indexes', action='store_true', help='Создать недостающие индексы CONCURRENTLY')
+    audit_parser.add_argument('--output', default=None, help='Записать отчёт в JSON')
+    args = parser.parse_args()
+
+    configure_metrics(
+        batch_hook=slow_batch_logger(settings.trace_slow_batch_ms) if settings.trace_slow_batch_ms else None,
+        profile_stages=[stage for stage in settings.profile_stages.split(',') if stage],
+        profile_dir=settings.profile_dir,
+    )
+    if args.command not in ('install-triggers', 'rollback', 'audit-plans', 'reconcile'):
+        start_metrics_server(settings.metrics_port)
+
+    if args.command == 'reindex':
+        run_reindex(in_place=args.in_place, drop_legacy_index=args.drop_legacy_index)
+    elif args.command == 'load-worker':
+        run_load_worker()
+    elif args.command == 'worker':
+        run_worker()
+    elif args.command == 'install-triggers':
+        run_install_triggers()
+    elif args.command == 'rollback':
+        run_rollback(reconcile=not args.no_reconcile)
+    elif args.command == 'audit-plans':
+        run_audit_plans(create_indexes=args.create_indexes, output=args.output)
+    elif args.command == 'reconcile':
+        run_reconcile(dry_run=args.dry_run, rate=args.rate)
+    elif settings.execution_mode == 'async':
+        run_async()
+    else:
+        run_sync()
+
+
 if __name__ == '__main__':
     main()
@@ -1,11 +1,97 @@
 from psycopg import OperationalError
+from psycopg.rows import tuple_row
+from psycopg.types.json import set_json_loads
+
+from serializers import orjson
 from utils import backoff
 
+def configure_cursor(cur):
+    """Разбор json-колонок через orjson, если он установлен: персоны в агрегированном режиме — самая объёмная часть строки."""
+    if orjson is not None:
+        set_json_loads(orjson.loads, cur)
+    return cur
+
+
 class PostgresMerger:
+    # Строки возвращаются кортежами в порядке колонок SELECT, трансформер распаковывает их по позициям.
+    # Одна строка на фильм: персоны сгруппированы по ролям, жанры собраны в массив.
+    # LATERAL-подзапросы не перемножают персоны и жанры между собой,
+    # поэтому фильм с 40 персонами и 4 жанрами возвращается одной строкой, а не 160.
+    # Имена сортируются в COLLATE "C", по кодовым точкам, как sorted() в трансформере плоского режима,
+    # иначе порядок зависел бы от локали базы и документы двух режимов различались бы.
+    AGGREGATED_SELECT = """
+        SELECT
+            fw.id as fw_id,
+            fw.title,
+            fw.description,
+            fw.rating,
+            COALESCE(persons.by_role, '{}'::json) as persons,
+            COALESCE(genres.names, ARRAY[]::text[]) as genres
+        FROM content.film_work fw
+        LEFT JOIN LATERAL (
+            SELECT json_object_agg(r.role, r.people) as by_role
+            FROM (
+                SELECT
+                    d.role,
+                    json_agg(json_build_object('id', d.id, 'name', d.full_name) ORDER BY d.full_name COLLATE "C", d.id) as people
+                FROM (
+                    SELECT DISTINCT pfw.role, p.id, p.full_name
+                    FROM content.person_film_work pfw
+                    JOIN content.person p ON p.id = pfw.person_id
+                    WHERE pfw.film_work_id = fw.id
+                ) d
+                GROUP BY d.role
+            ) r
+        ) persons ON TRUE
+        LEFT JOIN LATERAL (
+            SELECT array_agg(DISTINCT g.name::text COLLATE "C" ORDER BY g.name::text COLLATE "C") as names
+            FROM content.genre_film_work gfw
+            JOIN content.genre g ON g.id = gfw.genre_id
+            WHERE gfw.film_work_id = fw.id
+        ) genres ON TRUE
+    """
+
+    FLAT_SELECT = """
+        SELECT
+            fw.id as fw_id,
+            fw.title,
+            fw.description,
+            fw.rating,
+            pfw.role,
+            p.id as person_id,
+            p.full_name,
+            g.id as genre_id,
+            g.name as genre_name
+        FROM content.film_work fw
+        LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
+        LEFT JOIN content.person p ON p.id = pfw.person_id
+        LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
+        LEFT JOIN content.genre g ON g.id = gfw.genre_id
+    """
+
     def __init__(self, pg_conn, chunk_size):
         self.pg_conn = pg_conn
         self.chunk_size = chunk_size
     
+    def merge_query(self, film_work_ids, mode='aggregated'):
+        """Запрос данных фильмов в режиме 'aggregated' или 'flat' и его параметры."""
+        select = self.FLAT_SELECT if mode == 'flat' else self.AGGREGATED_SELECT
+        query = f"{select} WHERE fw.id = ANY(%s::uuid[]);"
+        return query, ([str(fw_id) for fw_id in film_work_ids],)
+
+    def _fetch_rows(self, query, params):
+        with self.pg_conn.cursor(row_factory=tuple_row) as cur:
+            configure_cursor(cur)
+            cur.execute(query, params)
+            merged_data = []
+            while True:
+                rows = cur.fetchmany(self.chunk_size)
+                if not rows:
+                    break
+                merged_data.extend(rows)
+
+        return merged_data
+
     @backoff(exceptions=(OperationalError,), service_name="PostgreSQL")
     def fetch_merged_data(self, film_work_ids):
         """
@@ -13,40 +99,54 @@ class PostgresMerger:
         """
         if not film_work_ids:
             return []
+        return self._fetch_rows(*self.merge_query(film_work_ids, 'flat'))
 
-        placeholders = ','.join(['%s'] * len(film_work_ids))
-        
-        query = f"""
-            SELECT
-                fw.id as fw_id, 
-                fw.title, 
-                fw.description, 
-                fw.rating, 
-                fw.type, 
-                fw.created_at, 
-                fw.updated_at, 
-                pfw.role, 
-                p.id as person_id, 
-                p.full_name,
-                g.id as genre_id,
-                g.name as genre_name
-            FROM content.film_work fw
-            LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
-            LEFT JOIN content.person p ON p.id = pfw.person_id
-            LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
-            LEFT JOIN content.genre g ON g.id = gfw.genre_id
-            WHERE fw.id IN ({placeholders});
-        """
-
-        with self.pg_conn.cursor() as cur:
-            cur.execute(query, [str(fw_id) for fw_id in film_work_ids])
-            colnames = [desc[0] for desc in cur.description]
-            
-            merged_data = []
+    @backoff(exceptions=(OperationalError,), service_name="PostgreSQL")
+    def fetch_aggregated_data(self, film_work_ids):
+        """
+        Извлекает по одной строке на фильм для указанных film_work_ids.
+        Персоны приходят уже сгруппированными по ролям, жанры — массивом имён.
+        """
+        if not film_work_ids:
+            return []
+        return self._fetch_rows(*self.merge_query(film_work_ids, 'aggregated'))
+
+    def after_query(self, after_id, limit):
+        """Запрос keyset-страницы фильмов после after_id в агрегированном режиме и его параметры."""
+        return f"{self.AGGREGATED_SELECT} WHERE fw.id > %s::uuid ORDER BY fw.id LIMIT %s;", (str(after_id), limit)
+
+    @backoff(exceptions=(OperationalError,), service_name="PostgreSQL")
+    def fetch_after(self, after_id, limit):
+        """
+        Следующие limit фильмов в агрегированном режиме в порядке id, начиная после after_id.
+        Каждая страница — отдельный запрос без долгой транзакции, поэтому обход не мешает синхронизации.
+        """
+        return self._fetch_rows(*self.after_query(after_id, limit))
+
+    def fetch(self, film_work_ids, mode='aggregated'):
+        """Извлекает данные фильмов в выбранном режиме: 'aggregated' или 'flat'."""
+        if mode == 'flat':
+            return self.fetch_merged_data(film_work_ids)
+        return self.fetch_aggregated_data(film_work_ids)
+
+    def all_query(self, limit=None):
+        """Запрос всех фильмов в агрегированном режиме в порядке id и его параметры; limit — только первые строки."""
+        if limit is None:
+            return f"{self.AGGREGATED_SELECT} ORDER BY fw.id;", ()
+        return f"{self.AGGREGATED_SELECT} ORDER BY fw.id LIMIT %s;", (limit,)
+
+    def iter_all_aggregated(self, cursor_name='full_reindex'):
+        """
+        Потоково выдаёт все фильмы пачками по chunk_size строк агрегированного режима.
+        Использует именованный (серверный) курсор, поэтому память не зависит от размера каталога.
+        Должен вызываться внутри транзакции.
+        """
+        with self.pg_conn.cursor(name=cursor_name, row_factory=tuple_row) as cur:
+            configure_cursor(cur)
+            cur.itersize = self.chunk_size
+            cur.execute(*self.all_query())
             while True:
                 rows = cur.fetchmany(self.chunk_size)
                 if not rows:
                     break
-                merged_data.extend([dict(zip(colnames, row)) for row in rows])
-            
-        return merged_data
+                yield rows
@@ -0,0 +1,123 @@
+"""
+Метрики ETL в формате Prometheus и необязательная трассировка пачек.
+
+Каждая стадия (extract, enrich, merge, transform, queue_push, bulk_load) оборачивается
+в track_stage: время попадает в гистограмму, строки на входе и выходе и байты — в счётчики.
+После стадии вызывается хук пачки (если задан), а выбранные стадии можно профилировать
+через cProfile: на каждую пачку пишется файл .prof.
+"""
+import cProfile
+import json
+import logging
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+STAGE_SECONDS = Histogram(
+    'etl_stage_duration_seconds', 'Длительность обработки пачки стадией', ['stage'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+STAGE_ROWS_IN = Counter('etl_stage_rows_in_total', 'Строк или документов на входе стадии', ['stage'])
+STAGE_ROWS_OUT = Counter('etl_stage_rows_out_total', 'Строк или документов на выходе стадии', ['stage'])
+STAGE_BYTES = Counter('etl_stage_bytes_total', 'Байт, записанных стадией', ['stage'])
+BACKOFF_RETRIES = Counter('etl_backoff_retries_total', 'Повторов после ошибок сервиса', ['service'])
+DOCUMENTS_FAILED = Counter('etl_documents_failed_total', 'Документов, отклонённых Elasticsearch')
+DOCUMENTS_SKIPPED = Counter('etl_documents_skipped_total', 'Документов, пропущенных как неизменившиеся')
+DOCUMENTS_OUTDATED = Counter('etl_documents_outdated_total', 'Документов, отклонённых как устаревшие: в индексе версия новее')
+QUEUE_DEPTH = Gauge('etl_queue_depth', 'Сообщений (пачек) в очереди документов', ['stream'])
+# Доля дублей по всем циклам: 1 - rate(flushed) / rate(contributed)
+DIRTY_CONTRIBUTED = Counter('etl_dirty_films_contributed_total', 'id фильмов, добавленных источником в множество грязных', ['source'])
+DIRTY_FLUSHED = Counter('etl_dirty_films_flushed_total', 'Уникальных фильмов, собранных из множества грязных')
+DIRTY_DEDUP_RATIO = Gauge('etl_dirty_films_dedup_ratio', 'Доля пересборок, сэкономленных множеством грязных за последний цикл')
+REPLICATION_LAG = Gauge('etl_replication_lag_seconds', 'Отставание курсора источника: now - last_updated_at', ['source'])
+
+
+class StageBatch:
+    """Показатели одной пачки стадии; rows_out и bytes заполняет обёрнутый код."""
+    __slots__ = ('stage', 'rows_in', 'rows_out', 'bytes', 'duration')
+
+    def __init__(self, stage: str, rows_in: int = 0):
+        self.stage = stage
+        self.rows_in = rows_in
+        self.rows_out = 0
+        self.bytes = 0
+        self.duration = 0.0
+
+
+_batch_hook: Optional[Callable[[StageBatch], None]] = None
+_profile_stages = frozenset()
+_profile_dir: Optional[Path] = None
+
+
+def configure(batch_hook: Callable[[StageBatch], None] = None, profile_stages: Iterable[str] = (),
+              profile_dir: str = None) -> None:
+    """Задаёт хук, вызываемый после каждой пачки, и стадии, которые нужно профилировать."""
+    global _batch_hook, _profile_stages, _profile_dir
+    _batch_hook = batch_hook
+    _profile_stages = frozenset(profile_stages)
+    _profile_dir = Path(profile_dir) if profile_dir else None
+    if _profile_stages and _profile_dir is not None:
+        _profile_dir.mkdir(parents=True, exist_ok=True)
+
+
+def slow_batch_logger(threshold_ms: float) -> Callable[[StageBatch], None]:
+    """Хук, пишущий в лог JSON-строку о каждой пачке дольше threshold_ms."""
+    def hook(batch: StageBatch) -> None:
+        if batch.duration * 1000 >= threshold_ms:
+            logging.warning("Медленная пачка: " + json.dumps({
+                'stage': batch.stage,
+                'duration_ms': round(batch.duration * 1000, 2),
+                'rows_in': batch.rows_in,
+                'rows_out': batch.rows_out,
+                'bytes': batch.bytes,
+            }))
+    return hook
+
+
+@contextmanager
+def track_stage(stage: str, rows_in: int = 0):
+    """Замеряет пачку стадии. Исключения пробрасываются, время неудачной пачки тоже учитывается."""
+    batch = StageBatch(stage, rows_in)
+    profiler = cProfile.Profile() if stage in _profile_stages and _profile_dir is not None else None
+    started = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield batch
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(_profile_dir / f"{stage}-{time.time_ns()}.prof")
+        batch.duration = time.perf_counter() - started
+        STAGE_SECONDS.labels(stage).observe(batch.duration)
+        STAGE_ROWS_IN.labels(stage).inc(batch.rows_in)
+        STAGE_ROWS_OUT.labels(stage).inc(batch.rows_out)
+        if batch.bytes:
+            STAGE_BYTES.labels(stage).inc(batch.bytes)
+        if _batch_hook is not None:
+            _batch_hook(batch)
+
+
+def observe_lag(source: str, producer) -> None:
+    """Обновляет отставание источника по состоянию его продюсера."""
+    lag = producer.estimate_lag()
+    if lag is not None:
+        REPLICATION_LAG.labels(source).set(lag)
+
+
+def observe_queue(doc_queue) -> None:
+    QUEUE_DEPTH.labels(doc_queue.stream).set(doc_queue.length())
+
+
+def start_metrics_server(port: int) -> None:
+    """Поднимает HTTP-эндпоинт /metrics в фоновом потоке. Порт 0 — метрики не публикуются."""
+    if not port:
+        return
+    try:
+        start_http_server(port)
+        logging.info(f"Метрики Prometheus доступны на порту {port} (/metrics).")
+    except OSError as e:
+        logging.warning(f"Не удалось открыть порт метрик {port}: {e}")
@@ -0,0 +1,258 @@
+"""Частичные обновления документов при переименовании персон и жанров."""
+import json
+import logging
+from typing import Dict, List, NamedTuple, Tuple
+
+from elasticsearch import Elasticsearch, ConnectionError, helpers
+from psycopg import OperationalError
+from redis import Redis
+
+from enricher import PostgresEnricher
+from fingerprints import FingerprintStore
+from utils import backoff
+
+NOT_FOUND = 404
+
+# Сравнение строк по кодовым точкам, как у str в Python: String.compareTo сравнивает
+# UTF-16 и для символов вне BMP дал бы другой порядок. Списки документа короткие,
+# поэтому хватает сортировки вставками.
+SORT_FUNCTIONS = """
+int compareText(String a, String b) {
+    int i = 0;
+    int j = 0;
+    while (i < a.length() && j < b.length()) {
+        int ca = a.codePointAt(i);
+        int cb = b.codePointAt(j);
+        if (ca != cb) { return ca < cb ? -1 : 1; }
+        i += Character.charCount(ca);
+        j += Character.charCount(cb);
+    }
+    return (i < a.length() ? 1 : 0) - (j < b.length() ? 1 : 0);
+}
+int comparePeople(Map x, Map y) {
+    int c = compareText((String) x.name, (String) y.name);
+    return c != 0 ? c : compareText((String) x.id, (String) y.id);
+}
+void sortPeople(List people) {
+    for (int i = 1; i < people.size(); i++) {
+        Map person = (Map) people[i];
+        int j = i - 1;
+        while (j >= 0 && comparePeople((Map) people[j], person) > 0) {
+            people[j + 1] = people[j];
+            j--;
+        }
+        people[j + 1] = person;
+    }
+}
+void sortText(List values) {
+    for (int i = 1; i < values.size(); i++) {
+        String value = (String) values[i];
+        int j = i - 1;
+        while (j >= 0 && compareText((String) values[j], value) > 0) {
+            values[j + 1] = values[j];
+            j--;
+        }
+        values[j + 1] = value;
+    }
+}
+"""
+
+# Подменяет имена персон во вложенных списках ролей, пересортировывает их по (имя, id), как
+# трансформер, и пересобирает поля *_names. Если ни одна персона документа не переименована,
+# документ не перезаписывается.
+PERSON_RENAME_SCRIPT = SORT_FUNCTIONS + """
+boolean changed = false;
+for (String role : params.roles) {
+    def people = ctx._source[role];
+    if (people == null) { continue; }
+    for (def person : people) {
+        String name = params.names[person.id];
+        if (name != null && name != person.name) { person.name = name; changed = true; }
+    }
+}
+if (changed) {
+    for (String role : params.roles) {
+        def people = ctx._source[role];
+        if (people == null) { continue; }
+        sortPeople(people);
+        List names = new ArrayList();
+        for (def person : people) { names.add(person.name); }
+        ctx._source[role + '_names'] = names;
+    }
+} else {
+    ctx.op = 'noop';
+}
+"""
+
+# В документе жанры хранятся только названиями, поэтому замена идёт по старому названию.
+# Затем жанры сортируются и повторы убираются: переименование в существующее название
+# при пересборке тоже дало бы один жанр.
+GENRE_RENAME_SCRIPT = SORT_FUNCTIONS + """
+def genres = ctx._source.genres;
+boolean changed = false;
+if (genres != null) {
+    for (int i = 0; i < genres.size(); i++) {
+        String name = params.names[genres[i]];
+        if (name != null && name != genres[i]) { genres[i] = name; changed = true; }
+    }
+}
+if (changed) {
+    sortText(genres);
+    List unique = new ArrayList();
+    for (def genre : genres) {
+        if (unique.isEmpty() || unique[unique.size() - 1] != genre) { unique.add(genre); }
+    }
+    ctx._source.genres = unique;
+} else {
+    ctx.op = 'noop';
+}
+"""
+
+
+class SourceChanges(NamedTuple):
+    """Разбор страницы источника: что пересобрать целиком, что переименовать, какие снимки сохранить."""
+    rebuild_ids: List[str]
+    # {id источника: (старое имя, новое имя)}
+    renames: Dict[str, Tuple[str, str]]
+    snapshots: Dict[str, str]
+
+
+class PartialUpdater:
+    """
+    Для источников person и genre отличает переименование от изменения связей.
+
+    Для каждой записи источника хранится снимок: имя и отпечаток её связей с фильмами
+    (hash Redis '<key_prefix>:<источник>'). Сравнение снимков даёт три случая:
+    - связи изменились или снимка ещё нет — фильмы пересобираются целиком, как раньше;
+    - изменилось только имя — фильмы обновляются в Elasticsearch скриптом в bulk update,
+      без слияния данных в PostgreSQL;
+    - не изменилось ничего (например, только updated_at) — запись пропускается.
+
+    Снимок сохраняется вместе с курсором источника, после того как изменения применены.
+    """
+
+    SNAPSHOT_QUERIES = {
+        'person': """
+            SELECT p.id, p.full_name,
+                   md5(coalesce(string_agg(pfw.film_work_id::text || ':' || pfw.role, ','
+                                           ORDER BY pfw.film_work_id, pfw.role), ''))
+            FROM content.person p
+            LEFT JOIN content.person_film_work pfw ON pfw.person_id = p.id
+            WHERE p.id = ANY(%s::uuid[])
+            GROUP BY p.id, p.full_name;
+        """,
+        'genre': """
+            SELECT g.id, g.name,
+                   md5(coalesce(string_agg(gfw.film_work_id::text, ',' ORDER BY gfw.film_work_id), ''))
+            FROM content.genre g
+            LEFT JOIN content.genre_film_work gfw ON gfw.genre_id = g.id
+            WHERE g.id = ANY(%s::uuid[])
+            GROUP BY g.id, g.name;
+        """,
+    }
+    ROLES = ['actors', 'writers', 'directors']
+
+    def __init__(self, pg_conn, es_conn: Elasticsearch, index_name: str, redis_connection: Redis,
+                 enricher: PostgresEnricher, fingerprints: FingerprintStore = None,
+                 key_prefix: str = 'etl:snapshots'):
+        self.pg_conn = pg_conn
+        self.es_conn = es_conn
+        self.index_name = index_name
+        self.redis = redis_connection
+        self.enricher = enricher
+        self.fingerprints = fingerprints
+        self.key_prefix = key_prefix
+
+    def supports(self, source_type: str) -> bool:
+        return source_type in self.SNAPSHOT_QUERIES
+
+    def _key(self, source_type: str) -> str:
+        return f"{self.key_prefix}:{source_type}"
+
+    @backoff(exceptions=(OperationalError,), service_name="PostgreSQL")
+    def fetch_snapshots(self, source_type: str, source_ids) -> Dict[str, Tuple[str, str]]:
+        """Текущие {id: (имя, отпечаток связей)} записей источника."""
+        with self.pg_conn.cursor() as cur:
+            cur.execute(self.SNAPSHOT_QUERIES[source_type], ([str(sid) for sid in source_ids],))
+            return {str(row_id): (name, relations) for row_id, name, relations in cur.fetchall()}
+
+    def classify(self, source_type: str, source_ids) -> SourceChanges:
+        """Раскладывает изменённые записи источника на пересборку и переименования."""
+        ids = [str(sid) for sid in source_ids]
+        current = self.fetch_snapshots(source_type, ids)
+        previous = dict(zip(ids, self.redis.hmget(self._key(source_type), ids)))
+
+        rebuild_ids, renames = [], {}
+        for source_id in ids:
+            if source_id not in current:
+                # Запись удалена: её фильмы пересобираются по оставшимся связям
+                rebuild_ids.append(source_id)
+                continue
+            name, relations = current[source_id]
+            if previous[source_id] is None:
+                rebuild_ids.append(source_id)
+                continue
+            old_name, old_relations = json.loads(previous[source_id])
+            if old_relations != relations:
+                rebuild_ids.append(source_id)
+            elif old_name != name:
+                renames[source_id] = (old_name, name)
+
+        snapshots = {source_id: json.dumps(list(snapshot)) for source_id, snapshot in current.items()}
+        logging.info(f"'{source_type}': пересборка {len(rebuild_ids)}, переименований {len(renames)}, "
+                     f"без изменений {len(ids) - len(rebuild_ids) - len(renames)}.")
+        return SourceChanges(rebuild_ids, renames, snapshots)
+
+    def apply_renames(self, source_type: str, renames: Dict[str, Tuple[str, str]]) -> List[str]:
+        """
+        Обновляет имена в документах связанных фильмов скриптом через bulk update.
+        Возвращает id фильмов, которые обновить не удалось: их нужно пересобрать целиком.
+        Update не принимает внешнюю версию и лишь увеличивает текущую на единицу, поэтому
+        документ из очереди документов, загруженный позже, вернёт старое имя. Вызывать,
+        только когда очередь пуста (см. main.process_sources
+        и AsyncPipeline._apply_renames).
+        """
+        if not renames:
+            return []
+        if source_type == 'person':
+            script = {'source': PERSON_RENAME_SCRIPT, 'lang': 'painless',
+                      'params': {'roles': self.ROLES, 'names': {pid: new for pid, (_, new) in renames.items()}}}
+        else:
+            script = {'source': GENRE_RENAME_SCRIPT, 'lang': 'painless',
+                      'params': {'names': {old: new for old, new in renames.values()}}}
+
+        updated, failed = 0, []
+        for film_work_ids in self.enricher.iter_film_ids(list(renames), source_type):
+            page_failed = self._update(film_work_ids, script)
+            failed.extend(page_failed)
+            updated += len(film_work_ids) - len(page_failed)
+            if self.fingerprints is not None:
+                # Документы изменены в обход загрузчика: их отпечатки больше не действительны.
+                self.fingerprints.forget(film_work_ids)
+
+        logging.info(f"Частичное обновление '{source_type}': {len(renames)} переименований, "
+                     f"обновлено фильмов {updated}, на пересборку {len(failed)}.")
+        return failed
+
+    @backoff(exceptions=(ConnectionError,), service_name="Elasticsearch")
+    def _update(self, film_work_ids, script) -> List[str]:
+        actions = (
+            {'_op_type': 'update', '_index': self.index_name, '_id': str(fw_id), 'script': script, 'retry_on_conflict': 3}
+            for fw_id in film_work_ids
+        )
+        failed = []
+        for ok, item in helpers.streaming_bulk(self.es_conn, actions, raise_on_error=False, raise_on_exception=False):
+            _, info = item.popitem()
+            # Фильма ещё нет в индексе: его загрузит обычный путь
+            if not ok and info.get('status') != NOT_FOUND:
+                failed.append(info.get('_id'))
+        return failed
+
+    def commit(self, source_type: str, snapshots: Dict[str, str]) -> None:
+        """Сохраняет снимки записей источника после применения изменений."""
+        if snapshots:
+            self.redis.hset(self._key(source_type), mapping=snapshots)
+
+    def reset(self) -> None:
+        """Забывает все снимки: следующее изменение каждой записи пересоберёт её фильмы."""
+        self.redis.delete(*[self._key(source_type) for source_type in self.SNAPSHOT_QUERIES])
@@ -0,0 +1,223 @@
+"""
+Аудит планов запросов ETL и создание недостающих индексов.
+
+Каждый запрос продюсеров, разворачивания связей, слияния, снимков частичных обновлений,
+сверки и полной переиндексации прогоняется через EXPLAIN (ANALYZE, BUFFERS) с параметрами
+первой страницы: курсор с начала источника (догоняющая выгрузка — худший случай для
+keyset-пагинации) и id этой страницы. Обход всего каталога при переиндексации замеряется
+на первой пачке: серверный курсор тоже выбирает план с быстрым стартом.
+В плане отмечаются последовательные сканирования и сортировки, которые растут вместе с каталогом.
+
+В дампе нет индексов под keyset-курсоры (updated_at, id) источников и составных индексов
+связей, которые отдают фильмы персоны или жанра уже упорядоченными, поэтому отсутствующие
+индексы из ETL_INDEXES можно создать CONCURRENTLY, не блокируя запись, и сравнить стоимость
+планов до и после. В режиме worker к ним добавляется индекс по номеру шарда (shard_index).
+"""
+import json
+import logging
+import time
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+from psycopg import sql
+
+from enricher import PostgresEnricher
+from merger import PostgresMerger
+from partial_updates import PartialUpdater
+from producer import PostgresProducer
+from sharding import Shard
+
+
+class IndexSpec(NamedTuple):
+    name: str
+    table: str
+    columns: Tuple[str, ...]
+    # Выражение перед столбцами индекса, например номер шарда строки
+    expression: Optional[str] = None
+
+    @property
+    def schema(self) -> str:
+        return self.table.split('.')[0]
+
+    def describe(self) -> str:
+        keys = ([f"({self.expression})"] if self.expression else []) + list(self.columns)
+        return f"{self.table} ({', '.join(keys)})"
+
+    def create_statement(self) -> sql.Composed:
+        schema, table = self.table.split('.')
+        keys = [sql.SQL("({})").format(sql.SQL(self.expression))] if self.expression else []
+        return sql.SQL("CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} USING btree ({});").format(
+            sql.Identifier(self.name),
+            sql.Identifier(schema, table),
+            sql.SQL(', ').join(keys + [sql.Identifier(column) for column in self.columns]),
+        )
+
+
+# Составные индексы: (updated_at, id) повторяет ORDER BY продюсера, а (person_id, film_work_id)
+# и (genre_id, film_work_id) отдают фильмы персон и жанров уже упорядоченными по film_work_id
+# для постраничного разворачивания.
+ETL_INDEXES = [
+    IndexSpec('idx_film_work_updated_at_id', 'content.film_work', ('updated_at', 'id')),
+    IndexSpec('idx_person_updated_at_id', 'content.person', ('updated_at', 'id')),
+    IndexSpec('idx_genre_updated_at_id', 'content.genre', ('updated_at', 'id')),
+    IndexSpec('idx_person_film_work_person_id_film_work_id', 'content.person_film_work', ('person_id', 'film_work_id')),
+    IndexSpec('idx_genre_film_work_genre_id_film_work_id', 'content.genre_film_work', ('genre_id', 'film_work_id')),
+]
+
+
+def shard_index(shard_count: int) -> IndexSpec:
+    """
+    Индекс продюсера film_work в шардированном режиме: номер шарда, затем курсор (updated_at, id).
+    С ним шард читает свои строки диапазоном индекса, а без него отбрасывает фильтром строки
+    остальных шардов и на каждую страницу читает в shard_count раз больше строк.
+    Выражение зависит от числа шардов, поэтому оно входит в имя индекса.
+    """
+    return IndexSpec(f'idx_film_work_shard{shard_count}_updated_at_id', 'content.film_work', ('updated_at', 'id'),
+                     Shard(0, shard_count).expression('id'))
+
+
+class PlanReport(NamedTuple):
+    """Итог EXPLAIN одного запроса."""
+    query: str
+    total_cost: float
+    execution_ms: float
+    shared_hit: int
+    shared_read: int
+    # Отмеченные узлы плана в читаемом виде
+    seq_scans: List[str]
+    sorts: List[str]
+
+
+def walk(node: dict) -> Iterator[dict]:
+    yield node
+    for child in node.get('Plans', ()):
+        yield from walk(child)
+
+
+def describe_seq_scan(node: dict) -> str:
+    rows = node.get('Actual Rows', 0) * node.get('Actual Loops', 1)
+    removed = node.get('Rows Removed by Filter', 0) * node.get('Actual Loops', 1)
+    return f"{node['Relation Name']}: строк {rows}, отброшено фильтром {removed}"
+
+
+def describe_sort(node: dict) -> str:
+    keys = ', '.join(node.get('Sort Key', []))
+    method = node.get('Sort Method', '?')
+    space = f"{node.get('Sort Space Used', '?')} kB {node.get('Sort Space Type', '')}".strip()
+    return f"{node['Node Type']} по {keys}: {method}, {space}"
+
+
+class PlanAuditor:
+    def __init__(self, pg_conn, producer_configs, batch_size: int, shard_count: int = None):
+        # Соединение в autocommit: CREATE INDEX CONCURRENTLY нельзя выполнять в транзакции.
+        self.pg_conn = pg_conn
+        self.producer_configs = producer_configs
+        self.batch_size = batch_size
+        # Число шардов режима worker: тогда проверяется и запрос продюсера одного шарда
+        self.shard_count = shard_count
+        self.indexes = ETL_INDEXES + ([shard_index(shard_count)] if shard_count else [])
+
+    def queries(self) -> List[Tuple[str, str, tuple]]:
+        """Запросы ETL (имя, текст, параметры) с параметрами первой страницы каждого источника."""
+        queries = []
+        pages = {}
+        for config in self.producer_configs:
+            producer = PostgresProducer(self.pg_conn, None, config.table, self.batch_size)
+            cursor = (producer.DEFAULT_UPDATED_AT, producer.DEFAULT_ID)
+            extract = producer.extract_query(*cursor)
+            queries.append((f"producer.extract:{config.source_type}", *extract))
+            queries.append((f"producer.count_remaining:{config.source_type}", *producer.count_query(*cursor)))
+            with self.pg_conn.cursor() as cur:
+                cur.execute(*extract)
+                pages[config.source_type] = [row[0] for row in cur.fetchall()]
+            if self.shard_count and not config.enrich:
+                sharded = PostgresProducer(self.pg_conn, None, config.table, self.batch_size, Shard(0, self.shard_count))
+                queries.append((f"producer.extract:{config.source_type}:shard", *sharded.extract_query(*cursor)))
+
+        enricher = PostgresEnricher(self.pg_conn, self.batch_size)
+        for source_type in enricher.RELATION_MAPPING:
+            if pages.get(source_type):
+                queries.append((f"enricher.fanout:{source_type}", *enricher.fanout_query(pages[source_type], source_type)))
+
+        for source_type, query in PartialUpdater.SNAPSHOT_QUERIES.items():
+            if pages.get(source_type):
+                queries.append((f"partial.snapshot:{source_type}", query, ([str(sid) for sid in pages[source_type]],)))
+
+        merger = PostgresMerger(self.pg_conn, self.batch_size)
+        if pages.get('film_work'):
+            for mode in ('aggregated', 'flat'):
+                queries.append((f"merger.fetch:{mode}", *merger.merge_query(pages['film_work'], mode)))
+        queries.append(("merger.fetch_after", *merger.after_query(PostgresProducer.DEFAULT_ID, self.batch_size)))
+        queries.append(("merger.iter_all_aggregated", *merger.all_query(self.batch_size)))
+        return queries
+
+    def explain(self, name: str, query: str, params: tuple) -> PlanReport:
+        with self.pg_conn.cursor() as cur:
+            cur.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}", params)
+            result = cur.fetchone()[0]
+        if isinstance(result, str):
+            result = json.loads(result)
+        plan = result[0]
+        root = plan['Plan']
+        nodes = list(walk(root))
+        return PlanReport(
+            query=name,
+            total_cost=root['Total Cost'],
+            execution_ms=plan.get('Execution Time', 0.0),
+            shared_hit=root.get('Shared Hit Blocks', 0),
+            shared_read=root.get('Shared Read Blocks', 0),
+            seq_scans=[describe_seq_scan(node) for node in nodes if node['Node Type'] == 'Seq Scan'],
+            sorts=[describe_sort(node) for node in nodes if node['Node Type'] in ('Sort', 'Incremental Sort')],
+        )
+
+    def audit(self) -> List[PlanReport]:
+        """EXPLAIN (ANALYZE, BUFFERS) всех запросов ETL."""
+        return [self.explain(*query) for query in self.queries()]
+
+    def _index_valid(self, spec: IndexSpec) -> Optional[bool]:
+        """True — индекс есть, False — остался невалидным после прерванного построения, None — его нет."""
+        row = self.pg_conn.execute("""
+            SELECT i.indisvalid
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = %s AND c.relname = %s;
+        """, (spec.schema, spec.name)).fetchone()
+        return row[0] if row else None
+
+    def missing_indexes(self) -> List[IndexSpec]:
+        return [spec for spec in self.indexes if not self._index_valid(spec)]
+
+    def create_indexes(self) -> List[str]:
+        """Создаёт недостающие индексы CONCURRENTLY и обновляет статистику таблиц. Возвращает имена созданных."""
+        created = []
+        for spec in self.missing_indexes():
+            if self._index_valid(spec) is False:
+                logging.warning(f"Индекс '{spec.name}' невалиден после прерванного построения и будет пересоздан.")
+                self.pg_conn.execute(sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {};").format(sql.Identifier(spec.schema, spec.name)))
+            started = time.perf_counter()
+            self.pg_conn.execute(spec.create_statement())
+            created.append(spec.name)
+            logging.info(f"Индекс '{spec.name}' на {spec.describe()} создан за {time.perf_counter() - started:.1f} сек.")
+        tables = sorted({spec.table for spec in self.indexes if spec.name in created})
+        if tables:
+            self.pg_conn.execute(sql.SQL("ANALYZE {};").format(
+                sql.SQL(', ').join(sql.Identifier(*table.split('.')) for table in tables)))
+        return created
+
+
+def format_report(before: List[PlanReport], after: List[PlanReport] = None) -> List[str]:
+    """Строки отчёта: стоимость и время каждого запроса (до и после индексов) и отмеченные узлы."""
+    after_by_query = {report.query: report for report in after or []}
+    lines = [f"{'query':<40}{'cost':>12}{'ms':>10}{'hit/read':>16}" + (f"{'cost after':>12}{'ms after':>10}" if after else "")]
+    for report in before:
+        line = (f"{report.query:<40}{report.total_cost:>12.1f}{report.execution_ms:>10.2f}"
+                f"{f'{report.shared_hit}/{report.shared_read}':>16}")
+        new = after_by_query.get(report.query)
+        if new is not None:
+            line += f"{new.total_cost:>12.1f}{new.execution_ms:>10.2f}"
+        lines.append(line)
+        plans = [('', report)] if new is None else [('до: ', report), ('после: ', new)]
+        for label, plan in plans:
+            lines += [f"    {label}Seq Scan {scan}" for scan in plan.seq_scans]
+            lines += [f"    {label}{sort}" for sort in plan.sorts]
+    return lines
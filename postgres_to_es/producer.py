@@ -1,26 +1,78 @@
+from datetime import datetime, timezone
+
 from psycopg import OperationalError
 from utils import backoff
 
 class PostgresProducer:
-    def __init__(self, pg_conn, state, table, batch_size=100):
+    DEFAULT_UPDATED_AT = '1970-01-01T00:00:00+00:00'
+    DEFAULT_ID = '00000000-0000-0000-0000-000000000000'
+
+    def __init__(self, pg_conn, state, table, batch_size=100, shard=None):
         self.pg_conn = pg_conn
         self.state = state
         self.table = table
         self.batch_size = batch_size
+        # Шард (см. sharding.Shard): продюсер видит только свои строки
+        self.shard = shard
 
-    @backoff(exceptions=(OperationalError,), service_name="PostgreSQL")
-    def extract(self):
-        last_updated = self.state.get_state('last_updated_at', '1970-01-01T00:00:00+00:00')
-        last_id = self.state.get_state('last_id', '00000000-0000-0000-0000-000000000000')
-        
+    def _shard_condition(self):
+        return f" AND {self.shard.predicate('id')}" if self.shard else ""
+
+    def _cursor(self):
+        last_updated = self.state.get_state('last_updated_at', self.DEFAULT_UPDATED_AT)
+        last_id = self.state.get_state('last_id', self.DEFAULT_ID)
+        return last_updated, last_id
+
+    def extract_query(self, last_updated, last_id):
+        """Запрос следующей keyset-страницы источника и его параметры."""
         query = f"""
             SELECT id, updated_at
             FROM {self.table}
-            WHERE (updated_at, id) > (%s, %s)
+            WHERE (updated_at, id) > (%s::timestamptz, %s::uuid){self._shard_condition()}
             ORDER BY updated_at, id
             LIMIT %s;
         """
+        return query, (last_updated, last_id, self.batch_size)
+
+    @staticmethod
+    def cursor_values(rows):
+        """Значения состояния, сдвигающие курсор за последнюю строку страницы."""
+        last_id, last_updated = rows[-1][0], rows[-1][1]
+        return {'last_updated_at': str(last_updated), 'last_id': str(last_id)}
+
+    @backoff(exceptions=(OperationalError,), service_name="PostgreSQL")
+    def extract(self):
+        query, params = self.extract_query(*self._cursor())
         with self.pg_conn.cursor() as cur:
-            cur.execute(query, (last_updated, last_id, self.batch_size))
+            cur.execute(query, params)
             rows = cur.fetchall()
         return rows
+
+    def count_query(self, last_updated, last_id):
+        """Запрос количества записей источника после курсора и его параметры."""
+        query = f"""
+            SELECT count(*)
+            FROM {self.table}
+            WHERE (updated_at, id) > (%s::timestamptz, %s::uuid){self._shard_condition()};
+        """
+        return query, (last_updated, last_id)
+
+    @backoff(exceptions=(OperationalError,), service_name="PostgreSQL")
+    def count_remaining(self):
+        """Количество записей источника, ещё не пройденных курсором."""
+        with self.pg_conn.cursor() as cur:
+            cur.execute(*self.count_query(*self._cursor()))
+            return cur.fetchone()[0]
+
+    def estimate_lag(self):
+        """Отставание курсора от текущего момента в секундах (now - last_updated_at)."""
+        last_updated = self.state.get_state('last_updated_at')
+        if not last_updated:
+            return None
+        try:
+            last_updated_at = datetime.fromisoformat(last_updated)
+        except ValueError:
+            return None
+        if last_updated_at.tzinfo is None:
+            last_updated_at = last_updated_at.replace(tzinfo=timezone.utc)
+        return (datetime.now(timezone.utc) - last_updated_at).total_seconds()
@@ -0,0 +1,209 @@
+"""
+Сверка индекса Elasticsearch с PostgreSQL: исправляются только расхождения.
+
+Оба источника читаются потоком в порядке id фильма. PostgreSQL отдаёт keyset-страницы
+агрегированного запроса, из которых строятся те же документы, что пишет синхронизация,
+а Elasticsearch — страницы search_after с сортировкой по полю id. Для каждого документа
+считается контрольная сумма его канонических байтов, и потоки сливаются как при merge join.
+Порядок uuid в PostgreSQL совпадает с лексикографическим порядком их строк в keyword-поле,
+поэтому оба потока упорядочены одинаково. В памяти одновременно держится по одной странице.
+
+Расхождения:
+- фильма нет в индексе, или документ отличается — фильм пересобирается заново и загружается;
+- документа нет в PostgreSQL — документ удаляется, если фильма по-прежнему нет.
+
+Перед исправлением фильмы перечитываются из PostgreSQL, поэтому документ, который синхронизация
+обновила во время сверки, не будет перезаписан устаревшей версией. Исправления загружаются
+с внешней версией момента перечитывания (clock, см. doc_queue.current_version): сообщения очереди,
+добавленные раньше, в том числе повторно доставленные, их не перезапишут. Скорость сверки
+ограничивается rate документов в секунду, чтобы её можно было запускать рядом с синхронизацией.
+"""
+import logging
+import time
+from dataclasses import dataclass
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from elasticsearch import ConnectionError, Elasticsearch, helpers
+from psycopg import OperationalError
+
+from enricher import PostgresEnricher
+from fingerprints import FingerprintStore, fingerprint
+from loader import ElasticsearchLoader
+from merger import PostgresMerger
+from serializers import RawDocument, encode_document
+from transformer import PostgresTransformer
+from utils import backoff
+
+def checksum(doc) -> str:
+    """
+    Контрольная сумма канонических байтов документа: тех же, что пишет encode_film.
+    Ключи идут в порядке документа, а Elasticsearch возвращает _source в том виде, в каком
+    документ записан. Порядок элементов списков значим: трансформер сортирует персон
+    по (имя, id) и жанры по названию, частичные обновления пересортировывают их так же,
+    поэтому другой порядок — тоже расхождение.
+    """
+    return fingerprint(doc.source if isinstance(doc, RawDocument) else encode_document(doc))
+
+
+@dataclass
+class ReconcileResult:
+    """Итог сверки."""
+    compared: int = 0
+    # Фильмы, которых нет в индексе
+    missing: int = 0
+    # Документы, которых нет в PostgreSQL
+    extra: int = 0
+    # Документы с другой контрольной суммой
+    mismatched: int = 0
+    reindexed: int = 0
+    deleted: int = 0
+    elapsed: float = 0.0
+
+
+class Reconciler:
+    def __init__(self, es_conn: Elasticsearch, index_name: str, merger: PostgresMerger, transformer: PostgresTransformer,
+                 loader: ElasticsearchLoader, fingerprints: FingerprintStore = None, chunk_size: int = 1000,
+                 rate: float = 0, dry_run: bool = False, clock: Callable[[], int] = None):
+        self.es_conn = es_conn
+        self.index_name = index_name
+        self.merger = merger
+        self.transformer = transformer
+        # Загрузчик без отпечатков: иначе он пропустил бы документ, который в индексе испорчен
+        self.loader = loader
+        self.fingerprints = fingerprints
+        self.chunk_size = chunk_size
+        # Документов в секунду, 0 — без ограничения
+        self.rate = rate
+        self.dry_run = dry_run
+        # clock() -> внешняя версия текущего момента; без него исправления пишутся с внутренней версией
+        self.clock = clock
+
+    def pg_stream(self) -> Iterator[Tuple[str, str]]:
+        """(id, контрольная сумма) всех фильмов в порядке id."""
+        after_id = PostgresEnricher.FIRST_FILM_ID
+        while True:
+            rows = self.merger.fetch_after(after_id, self.chunk_size)
+            for doc in self.transformer.transform_aggregated_data(rows):
+                yield doc.id, checksum(doc)
+            if len(rows) < self.chunk_size:
+                return
+            after_id = rows[-1][0]
+
+    @backoff(exceptions=(ConnectionError,), service_name="Elasticsearch")
+    def _es_page(self, search_after: Optional[list]) -> list:
+        response = self.es_conn.search(
+            index=self.index_name,
+            size=self.chunk_size,
+            query={'match_all': {}},
+            sort=[{'id': 'asc'}],
+            search_after=search_after,
+            track_total_hits=False,
+        )
+        return response['hits']['hits']
+
+    def es_stream(self) -> Iterator[Tuple[str, str]]:
+        """(id, контрольная сумма) всех документов индекса в порядке id."""
+        search_after = None
+        while True:
+            hits = self._es_page(search_after)
+            for hit in hits:
+                yield hit['_id'], checksum(hit['_source'])
+            if len(hits) < self.chunk_size:
+                return
+            search_after = hits[-1]['sort']
+
+    def run(self) -> ReconcileResult:
+        """Один проход сверки. Расхождения исправляются пачками по chunk_size по ходу прохода."""
+        result = ReconcileResult()
+        started = time.perf_counter()
+        reindex_ids, delete_ids = [], []
+        pg_items, es_items = self.pg_stream(), self.es_stream()
+        pg_item, es_item = next(pg_items, None), next(es_items, None)
+
+        while pg_item is not None or es_item is not None:
+            if es_item is None or (pg_item is not None and pg_item[0] < es_item[0]):
+                result.missing += 1
+                reindex_ids.append(pg_item[0])
+                pg_item = next(pg_items, None)
+            elif pg_item is None or es_item[0] < pg_item[0]:
+                result.extra += 1
+                delete_ids.append(es_item[0])
+                es_item = next(es_items, None)
+            else:
+                if pg_item[1] != es_item[1]:
+                    result.mismatched += 1
+                    reindex_ids.append(pg_item[0])
+                pg_item, es_item = next(pg_items, None), next(es_items, None)
+
+            result.compared += 1
+            if len(reindex_ids) + len(delete_ids) >= self.chunk_size:
+                self._repair(reindex_ids, delete_ids, result)
+                reindex_ids, delete_ids = [], []
+            if result.compared % self.chunk_size == 0:
+                self._throttle(result.compared, started)
+                logging.info(f"Сверка: сравнено {result.compared}, нет в индексе {result.missing}, "
+                             f"лишних {result.extra}, отличается {result.mismatched}.")
+
+        self._repair(reindex_ids, delete_ids, result)
+        result.elapsed = time.perf_counter() - started
+        return result
+
+    def _throttle(self, compared: int, started: float) -> None:
+        if not self.rate:
+            return
+        pause = compared / self.rate - (time.perf_counter() - started)
+        if pause > 0:
+            time.sleep(pause)
+
+    def _repair(self, reindex_ids: List[str], delete_ids: List[str], result: ReconcileResult) -> None:
+        if not reindex_ids and not delete_ids:
+            return
+        if self.dry_run:
+            logging.info(f"Сверка (без исправлений): пересобрать {len(reindex_ids)}, удалить {len(delete_ids)}.")
+            return
+
+        if reindex_ids:
+            # Версия берётся до перечитывания: сообщение, добавленное в очередь позже, собрано не раньше
+            # и перезапишет исправление, а более раннее будет отклонено как устаревшее.
+            version = self.clock() if self.clock is not None else None
+            # Перечитываем фильмы: за время сверки синхронизация могла загрузить более новую версию
+            documents = self.transformer.transform_aggregated_data(self.merger.fetch_aggregated_data(reindex_ids))
+            versions = {doc.id: version for doc in documents} if version is not None else None
+            load = self.loader.load_to_es(documents, versions)
+            result.reindexed += load.success
+            if load.failed:
+                logging.warning(f"Сверка: Elasticsearch отклонил {len(load.failed)} документов.")
+            # Фильмы, удалённые из PostgreSQL за время сверки, удаляются и из индекса
+            delete_ids = delete_ids + sorted(set(reindex_ids) - {doc.id for doc in documents})
+
+        if delete_ids:
+            delete_ids = self._absent_in_pg(delete_ids)
+            result.deleted += self._delete(delete_ids)
+
+        if self.fingerprints is not None:
+            # Отпечатки описывали документы, которых в индексе уже не было или которые были другими
+            self.fingerprints.forget(reindex_ids + delete_ids)
+        logging.info(f"Сверка: пересобрано {len(reindex_ids)}, удалено {len(delete_ids)} документов.")
+
+    @backoff(exceptions=(OperationalError,), service_name="PostgreSQL")
+    def _absent_in_pg(self, film_work_ids: List[str]) -> List[str]:
+        """Фильмы, которых нет в PostgreSQL. Фильм мог появиться после того, как поток прошёл его id."""
+        with self.merger.pg_conn.cursor() as cur:
+            cur.execute("SELECT id FROM content.film_work WHERE id = ANY(%s::uuid[]);", (film_work_ids,))
+            present = {str(row[0]) for row in cur.fetchall()}
+        return [fw_id for fw_id in film_work_ids if fw_id not in present]
+
+    @backoff(exceptions=(ConnectionError,), service_name="Elasticsearch")
+    def _delete(self, doc_ids: List[str]) -> int:
+        if not doc_ids:
+            return 0
+        actions = ({'_op_type': 'delete', '_index': self.index_name, '_id': doc_id} for doc_id in doc_ids)
+        deleted = 0
+        for ok, item in helpers.streaming_bulk(self.es_conn, actions, chunk_size=self.chunk_size,
+                                               raise_on_error=False, raise_on_exception=False):
+            # 404 — документ уже удалён, это тоже нужный итог
+            if ok or item['delete'].get('status') == 404:
+                deleted += 1
+            else:
+                logging.warning(f"Сверка: не удалось удалить документ {item['delete'].get('_id')}: {item['delete'].get('error')}")
+        return deleted
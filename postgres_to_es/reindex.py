@@ -0,0 +1,89 @@
+"""Полная переиндексация каталога из PostgreSQL в Elasticsearch."""
+import logging
+import time
+from typing import Callable
+
+from psycopg import IsolationLevel
+
+from loader import ElasticsearchLoader
+from merger import PostgresMerger
+from state import FanoutCheckpoint, State
+from transformer import PostgresTransformer
+
+
+class FullReindexer:
+    """
+    Переливает все фильмы одним потоком: серверный курсор -> трансформер -> bulk в Elasticsearch.
+    Работает в снимке REPEATABLE READ и не трогает инкрементальные состояния продюсеров.
+    run() возвращает high-water marks снимка, а commit_states() выставляет на них состояния,
+    чтобы инкрементальная синхронизация продолжила с этой точки. Вызывать его нужно только
+    после переключения алиаса: до него синхронизация пишет в старую версию индекса.
+
+    Документы загружаются с внешней версией момента снимка (clock, см. doc_queue.current_version):
+    сообщения очереди, собранные до снимка и загруженные позже (в том числе повторно доставленные),
+    отклоняются как устаревшие, а более новые их перезаписывают.
+    """
+
+    def __init__(self, pg_conn, merger: PostgresMerger, transformer: PostgresTransformer,
+                 loader: ElasticsearchLoader, producer_configs, storage_factory, clock: Callable[[], int] = None):
+        self.pg_conn = pg_conn
+        self.merger = merger
+        self.transformer = transformer
+        self.loader = loader
+        self.producer_configs = producer_configs
+        # storage_factory(state_key) -> BaseStorage
+        self.storage_factory = storage_factory
+        # clock() -> внешняя версия текущего момента; без него документы пишутся с внутренней версией
+        self.clock = clock
+
+    def _high_water_marks(self):
+        """Последние (updated_at, id) каждого источника в текущем снимке."""
+        marks = {}
+        with self.pg_conn.cursor() as cur:
+            for config in self.producer_configs:
+                cur.execute(f"""
+                    SELECT updated_at, id
+                    FROM {config.table}
+                    ORDER BY updated_at DESC NULLS LAST, id DESC
+                    LIMIT 1;
+                """)
+                marks[config.state_key] = cur.fetchone()
+        return marks
+
+    def run(self):
+        """Выполняет полную переиндексацию. Возвращает high-water marks снимка для commit_states()."""
+        started = time.perf_counter()
+        total = 0
+
+        self.pg_conn.isolation_level = IsolationLevel.REPEATABLE_READ
+        self.pg_conn.read_only = True
+        try:
+            with self.pg_conn.transaction():
+                # Первый запрос фиксирует снимок: всё, что ниже, видит те же данные.
+                marks = self._high_water_marks()
+                # Версия берётся после снимка: сообщение, добавленное в очередь между снимком
+                # и этим моментом, проиграет, но его изменение синхронизация повторит с high-water mark.
+                version = self.clock() if self.clock is not None else None
+                for rows in self.merger.iter_all_aggregated():
+                    documents = self.transformer.transform_aggregated_data(rows)
+                    versions = {doc.id: version for doc in documents} if version is not None else None
+                    self.loader.load_to_es(documents, versions)
+                    total += len(documents)
+                    logging.info(f"Переиндексация: загружено {total} документов "
+                                 f"({total / (time.perf_counter() - started):.0f} док./сек.)")
+        finally:
+            self.pg_conn.isolation_level = None
+            self.pg_conn.read_only = None
+
+        logging.info(f"Полная переиндексация завершена: {total} документов за {time.perf_counter() - started:.1f} сек.")
+        return marks
+
+    def commit_states(self, marks):
+        """Выставляет состояния продюсеров на high-water marks и сбрасывает незавершённое разворачивание связей."""
+        for state_key, mark in marks.items():
+            if mark is None:
+                continue
+            updated_at, row_id = mark
+            state = State(self.storage_factory(state_key))
+            state.set_states({'last_updated_at': str(updated_at), 'last_id': str(row_id)} | FanoutCheckpoint.cleared())
+            logging.info(f"Состояние '{state_key}' выставлено на high-water mark: modified={updated_at}, id={row_id}")
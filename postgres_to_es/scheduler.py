@@ -0,0 +1,109 @@
+"""Адаптивное расписание опроса источников."""
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+
+@dataclass
+class SourceSchedule:
+    """Состояние расписания одного источника."""
+    interval: float
+    next_run: float = 0.0
+    last_batch: int = 0
+    catchup_started: Optional[float] = None
+    catchup_rows: int = 0
+    full_batches: int = 0
+    remaining: Optional[int] = field(default=None, repr=False)
+
+
+class AdaptiveScheduler:
+    """
+    Планировщик, который выкачивает источник подряд идущими keyset-страницами,
+    пока тот отдаёт полные пачки, и возвращается к паузе только когда источник догнан.
+    Пока источник простаивает, пауза для него растёт экспоненциально до max_sleep_time.
+    """
+
+    def __init__(self, source_types: List[str], batch_size: int, sleep_time: float,
+                 max_sleep_time: float, backoff_factor: float = 2, report_every: int = 10):
+        self.batch_size = batch_size
+        self.sleep_time = sleep_time
+        self.max_sleep_time = max(max_sleep_time, sleep_time)
+        self.backoff_factor = backoff_factor
+        self.report_every = report_every
+        self.sources: Dict[str, SourceSchedule] = {
+            source_type: SourceSchedule(interval=sleep_time) for source_type in source_types
+        }
+
+    def due(self, now: Optional[float] = None) -> List[str]:
+        """Возвращает источники, которые пора опрашивать."""
+        now = time.monotonic() if now is None else now
+        return [source_type for source_type, s in self.sources.items() if s.next_run <= now]
+
+    def record(self, source_type: str, rows_count: int, now: Optional[float] = None) -> None:
+        """Учитывает результат опроса источника и планирует следующий запуск."""
+        now = time.monotonic() if now is None else now
+        s = self.sources[source_type]
+        s.last_batch = rows_count
+
+        if rows_count >= self.batch_size:
+            # Полная пачка — источник отстаёт, следующую страницу забираем без паузы.
+            if s.catchup_started is None:
+                s.catchup_started = now
+                s.catchup_rows = 0
+                s.full_batches = 0
+            s.catchup_rows += rows_count
+            s.full_batches += 1
+            s.interval = self.sleep_time
+            s.next_run = now
+            return
+
+        if s.catchup_started is not None:
+            elapsed = now - s.catchup_started
+            total = s.catchup_rows + rows_count
+            logging.info(f"Источник '{source_type}' догнан: {total} записей за {elapsed:.1f} сек.")
+            s.catchup_started = None
+            s.remaining = None
+
+        if rows_count:
+            s.interval = self.sleep_time
+        else:
+            s.interval = min(s.interval * self.backoff_factor, self.max_sleep_time)
+        s.next_run = now + s.interval
+
+    def has_backlog(self) -> bool:
+        """Есть ли источник, вернувший полную пачку в последнем опросе."""
+        return any(s.last_batch >= self.batch_size for s in self.sources.values())
+
+    def next_sleep(self, now: Optional[float] = None) -> float:
+        """Сколько можно спать до ближайшего запланированного опроса."""
+        now = time.monotonic() if now is None else now
+        return max(0.0, min(s.next_run for s in self.sources.values()) - now)
+
+    def should_report(self, source_type: str) -> bool:
+        """Пора ли сообщить о прогрессе догоняющей выгрузки."""
+        s = self.sources[source_type]
+        return s.catchup_started is not None and (s.full_batches - 1) % self.report_every == 0
+
+    def report_progress(self, source_type: str, producer, now: Optional[float] = None) -> None:
+        """Логирует остаток записей, скорость и оценку времени до окончания догоняющей выгрузки."""
+        if self.sources[source_type].catchup_started is None:
+            return
+        self.log_progress(source_type, producer.estimate_lag(), producer.count_remaining(), now)
+
+    def log_progress(self, source_type: str, lag: Optional[float], remaining: int, now: Optional[float] = None) -> None:
+        """То же по уже посчитанным отставанию и остатку: асинхронный продюсер считает остаток сам."""
+        now = time.monotonic() if now is None else now
+        s = self.sources[source_type]
+        if s.catchup_started is None:
+            return
+
+        s.remaining = remaining
+        elapsed = now - s.catchup_started
+        rate = s.catchup_rows / elapsed if elapsed > 0 else 0.0
+        eta = f"{s.remaining / rate:.0f} сек." if rate else "неизвестно"
+        lag_str = f"{lag:.0f} сек." if lag is not None else "неизвестно"
+        logging.info(
+            f"Догоняющая выгрузка '{source_type}': обработано {s.catchup_rows}, осталось {s.remaining}, "
+            f"скорость {rate:.0f} зап./сек., до окончания {eta}, отставание {lag_str}"
+        )
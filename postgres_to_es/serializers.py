@@ -0,0 +1,167 @@
+"""
+Кодеки для документов в очереди: сериализация пачки (JSON или msgpack)
+и необязательное сжатие пачки целиком (zstd или lz4).
+Имя кодека записывается в сообщение, поэтому читатель декодирует любой формат.
+"""
+import abc
+import json
+from typing import Any, Dict, List, NamedTuple, Optional
+
+try:
+    import orjson
+except ImportError:  # orjson необязателен, без него используется стандартный json
+    orjson = None
+
+
+class RawDocument(NamedTuple):
+    """Документ, уже закодированный в JSON: байты уходят в тело bulk без повторной сериализации."""
+    id: str
+    source: bytes
+
+
+def encode_document(doc: Dict[str, Any]) -> bytes:
+    """Один документ в компактный JSON. UUID и прочие нестандартные типы пишутся строками."""
+    if orjson is not None:
+        return orjson.dumps(doc, default=str)
+    return json.dumps(doc, default=str, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def as_dict(doc) -> Dict[str, Any]:
+    """Документ в виде словаря: RawDocument декодируется."""
+    if isinstance(doc, RawDocument):
+        return orjson.loads(doc.source) if orjson is not None else json.loads(doc.source)
+    return doc
+
+
+class BaseSerializer(abc.ABC):
+    name: str
+
+    @abc.abstractmethod
+    def encode_batch(self, docs: List[Dict[str, Any]]) -> bytes:
+        """Кодирует пачку документов."""
+
+    @abc.abstractmethod
+    def decode_batch(self, data: bytes) -> List[Dict[str, Any]]:
+        """Декодирует пачку документов."""
+
+    def raw_documents(self, data: bytes) -> Optional[List[bytes]]:
+        """Документы пачки в виде готового JSON, если формат это позволяет."""
+        return None
+
+
+class JsonSerializer(BaseSerializer):
+    """NDJSON: по документу на строку. Строки можно отдать в bulk как есть."""
+    name = 'json'
+
+    def encode_batch(self, docs):
+        # Готовые RawDocument (их выдаёт трансформер) склеиваются без повторной сериализации
+        return b'\n'.join(doc.source if isinstance(doc, RawDocument) else encode_document(doc) for doc in docs)
+
+    def decode_batch(self, data):
+        loads = orjson.loads if orjson is not None else json.loads
+        return [loads(line) for line in data.split(b'\n') if line]
+
+    def raw_documents(self, data):
+        return [line for line in data.split(b'\n') if line]
+
+
+class MsgpackSerializer(BaseSerializer):
+    name = 'msgpack'
+
+    def __init__(self):
+        try:
+            import msgpack
+        except ImportError as e:
+            raise ImportError("Для кодека 'msgpack' установите пакет msgpack.") from e
+        self._msgpack = msgpack
+
+    def encode_batch(self, docs):
+        return self._msgpack.packb([as_dict(doc) for doc in docs], default=str, use_bin_type=True)
+
+    def decode_batch(self, data):
+        return self._msgpack.unpackb(data, raw=False)
+
+
+class BaseCompressor(abc.ABC):
+    name: str
+
+    @abc.abstractmethod
+    def compress(self, data: bytes) -> bytes: ...
+
+    @abc.abstractmethod
+    def decompress(self, data: bytes) -> bytes: ...
+
+
+class ZstdCompressor(BaseCompressor):
+    name = 'zstd'
+
+    def __init__(self, level: int = 3):
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError("Для сжатия 'zstd' установите пакет zstandard.") from e
+        self._compressor = zstandard.ZstdCompressor(level=level)
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def decompress(self, data):
+        return self._decompressor.decompress(data)
+
+
+class Lz4Compressor(BaseCompressor):
+    name = 'lz4'
+
+    def __init__(self):
+        try:
+            import lz4.frame
+        except ImportError as e:
+            raise ImportError("Для сжатия 'lz4' установите пакет lz4.") from e
+        self._lz4 = lz4.frame
+
+    def compress(self, data):
+        return self._lz4.compress(data)
+
+    def decompress(self, data):
+        return self._lz4.decompress(data)
+
+
+SERIALIZERS = {'json': JsonSerializer, 'msgpack': MsgpackSerializer}
+COMPRESSORS = {'zstd': ZstdCompressor, 'lz4': Lz4Compressor}
+
+
+class Codec:
+    """Сериализатор плюс необязательный компрессор. Имя вида 'json', 'msgpack+zstd'."""
+
+    def __init__(self, serializer: BaseSerializer, compressor: Optional[BaseCompressor] = None):
+        self.serializer = serializer
+        self.compressor = compressor
+        self.name = serializer.name + (f'+{compressor.name}' if compressor else '')
+
+    def encode(self, docs: List[Dict[str, Any]]) -> bytes:
+        data = self.serializer.encode_batch(docs)
+        return self.compressor.compress(data) if self.compressor else data
+
+    def _decompress(self, data: bytes) -> bytes:
+        return self.compressor.decompress(data) if self.compressor else data
+
+    def decode(self, data: bytes) -> List[Dict[str, Any]]:
+        return self.serializer.decode_batch(self._decompress(data))
+
+    def raw_documents(self, data: bytes) -> Optional[List[bytes]]:
+        return self.serializer.raw_documents(self._decompress(data))
+
+
+_codecs: Dict[str, Codec] = {}
+
+
+def get_codec(name: str) -> Codec:
+    """Возвращает (и кеширует) кодек по имени вида 'json' или 'msgpack+lz4'."""
+    if name not in _codecs:
+        serializer_name, _, compressor_name = name.partition('+')
+        if serializer_name not in SERIALIZERS or (compressor_name and compressor_name not in COMPRESSORS):
+            raise ValueError(f"Неизвестный кодек очереди: '{name}'")
+        compressor = COMPRESSORS[compressor_name]() if compressor_name else None
+        _codecs[name] = Codec(SERIALIZERS[serializer_name](), compressor)
+    return _codecs[name]
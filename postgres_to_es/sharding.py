@@ -0,0 +1,156 @@
+"""Распределение фильмов между процессами ETL: шарды по хешу id и аренды в Redis."""
+import logging
+import math
+import threading
+import time
+from typing import List, NamedTuple
+
+from redis import Redis, WatchError
+
+from doc_queue import default_consumer_name
+
+
+class Shard(NamedTuple):
+    """Шард index из count: фильмы, у которых hash(id) mod count == index."""
+    index: int
+    count: int
+
+    def expression(self, column: str) -> str:
+        """
+        Номер шарда строки. Условие predicate использует индекс, только если выражение
+        в нём совпадает с выражением индекса (см. plan_audit.shard_index).
+        """
+        return f"(hashtext({column}::text) & 2147483647) % {self.count}"
+
+    def predicate(self, column: str) -> str:
+        """
+        Условие принадлежности строки шарду для WHERE. Знак '%' экранирован:
+        условие подставляется в запросы с параметрами.
+        """
+        return f"{self.expression(column).replace('%', '%%')} = {self.index}"
+
+    @property
+    def suffix(self) -> str:
+        # Число шардов входит в ключи: при его смене шарды начинают с чистого состояния.
+        return f"shard:{self.index}of{self.count}"
+
+    def key(self, key: str) -> str:
+        """Ключ Redis (состояние, множество грязных фильмов и т.д.) для этого шарда."""
+        return f"{key}:{self.suffix}"
+
+
+class ShardCoordinator:
+    """
+    Раздаёт шарды работающим процессам через аренды в Redis.
+
+    Аренда шарда — ключ '<prefix>:lease:<index>' с id владельца и TTL. Процесс
+    регистрируется в '<prefix>:workers' (sorted set с временем последнего пульса),
+    а фоновый поток продлевает регистрацию и аренды каждые lease_ttl / 3 секунд.
+    Каждый процесс держит не больше ceil(shard_count / число живых процессов) шардов:
+    лишние отдаёт, свободные забирает. Аренды упавшего процесса истекают,
+    и его шарды подбирают остальные при следующей перебалансировке.
+
+    Состояния шардов лежат в Redis, поэтому новый владелец продолжает с того же курсора.
+    Если процесс потерял аренду посреди цикла, шард может быть обработан дважды —
+    повторная загрузка документов идемпотентна.
+    """
+
+    def __init__(self, redis_connection: Redis, shard_count: int, worker_id: str = None,
+                 lease_ttl: float = 30, prefix: str = 'etl:shards'):
+        self.redis = redis_connection
+        self.shard_count = shard_count
+        self.worker_id = worker_id or default_consumer_name()
+        self.lease_ttl_ms = int(lease_ttl * 1000)
+        self.heartbeat_interval = lease_ttl / 3
+        self.prefix = prefix
+        self.workers_key = f"{prefix}:workers"
+        self._owned = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _lease_key(self, index: int) -> str:
+        return f"{self.prefix}:lease:{index}"
+
+    def start(self) -> None:
+        self._beat()
+        self._thread = threading.Thread(target=self._heartbeat_loop, name='shard-heartbeat', daemon=True)
+        self._thread.start()
+        logging.info(f"Процесс '{self.worker_id}' зарегистрирован для {self.shard_count} шардов.")
+
+    def stop(self) -> None:
+        """Останавливает пульс и отдаёт все шарды, чтобы их сразу подобрали другие процессы."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            for index in list(self._owned):
+                self._release(index)
+        self.redis.zrem(self.workers_key, self.worker_id)
+
+    def _heartbeat_loop(self) -> None:
+        while not self._stopped.wait(self.heartbeat_interval):
+            try:
+                self._beat()
+            except Exception as e:
+                logging.warning(f"Не удалось продлить аренды шардов: {e}")
+
+    def _beat(self) -> None:
+        self.redis.zadd(self.workers_key, {self.worker_id: time.time()})
+        with self._lock:
+            for index in list(self._owned):
+                if not self._renew(index):
+                    self._owned.discard(index)
+                    logging.warning(f"Аренда шарда {index} потеряна процессом '{self.worker_id}'.")
+
+    def _compare_and(self, index: int, action) -> bool:
+        """Выполняет action(pipe, key), только если шардом владеет этот процесс."""
+        key = self._lease_key(index)
+        with self.redis.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                owner = pipe.get(key)
+                if isinstance(owner, bytes):
+                    owner = owner.decode()
+                if owner != self.worker_id:
+                    return False
+                pipe.multi()
+                action(pipe, key)
+                pipe.execute()
+                return True
+            except WatchError:
+                return False
+
+    def _renew(self, index: int) -> bool:
+        return self._compare_and(index, lambda pipe, key: pipe.pexpire(key, self.lease_ttl_ms))
+
+    def _release(self, index: int) -> None:
+        self._compare_and(index, lambda pipe, key: pipe.delete(key))
+        self._owned.discard(index)
+
+    def live_workers(self) -> int:
+        """Количество процессов, подававших пульс в пределах TTL аренды."""
+        self.redis.zremrangebyscore(self.workers_key, 0, time.time() - self.lease_ttl_ms / 1000)
+        return max(1, self.redis.zcard(self.workers_key))
+
+    def rebalance(self) -> List[Shard]:
+        """Отдаёт лишние шарды, забирает свободные и возвращает текущие шарды процесса."""
+        target = math.ceil(self.shard_count / self.live_workers())
+        with self._lock:
+            for index in sorted(self._owned, reverse=True)[:max(0, len(self._owned) - target)]:
+                self._release(index)
+                logging.info(f"Шард {index} отдан для перебалансировки.")
+
+            # Начинаем поиск свободных шардов с разных мест, чтобы процессы реже конкурировали.
+            offset = hash(self.worker_id) % self.shard_count
+            for step in range(self.shard_count):
+                if len(self._owned) >= target:
+                    break
+                index = (offset + step) % self.shard_count
+                if index in self._owned:
+                    continue
+                if self.redis.set(self._lease_key(index), self.worker_id, nx=True, px=self.lease_ttl_ms):
+                    self._owned.add(index)
+                    logging.info(f"Процесс '{self.worker_id}' взял шард {index}.")
+
+            return [Shard(index, self.shard_count) for index in sorted(self._owned)]
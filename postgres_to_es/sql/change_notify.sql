@@ -0,0 +1,48 @@
+-- Триггеры, публикующие изменения каталога в канал NOTIFY для ETL.
+-- Полезная нагрузка: {"table": "<источник>", "id": "<uuid>"}.
+-- Изменения связей (person_film_work, genre_film_work) публикуются как изменения фильма.
+-- Идемпотентно: можно выполнять повторно.
+
+CREATE OR REPLACE FUNCTION content.etl_notify_change() RETURNS trigger AS $$
+DECLARE
+    rec record;
+    source text := TG_TABLE_NAME;
+    row_id uuid;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        rec := OLD;
+    ELSE
+        rec := NEW;
+    END IF;
+
+    IF TG_TABLE_NAME IN ('person_film_work', 'genre_film_work') THEN
+        source := 'film_work';
+        row_id := rec.film_work_id;
+    ELSE
+        row_id := rec.id;
+    END IF;
+
+    PERFORM pg_notify(TG_ARGV[0], json_build_object('table', source, 'id', row_id)::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS etl_notify_change ON content.film_work;
+CREATE TRIGGER etl_notify_change AFTER INSERT OR UPDATE ON content.film_work
+    FOR EACH ROW EXECUTE FUNCTION content.etl_notify_change('etl_changes');
+
+DROP TRIGGER IF EXISTS etl_notify_change ON content.person;
+CREATE TRIGGER etl_notify_change AFTER INSERT OR UPDATE ON content.person
+    FOR EACH ROW EXECUTE FUNCTION content.etl_notify_change('etl_changes');
+
+DROP TRIGGER IF EXISTS etl_notify_change ON content.genre;
+CREATE TRIGGER etl_notify_change AFTER INSERT OR UPDATE ON content.genre
+    FOR EACH ROW EXECUTE FUNCTION content.etl_notify_change('etl_changes');
+
+DROP TRIGGER IF EXISTS etl_notify_change ON content.person_film_work;
+CREATE TRIGGER etl_notify_change AFTER INSERT OR UPDATE OR DELETE ON content.person_film_work
+    FOR EACH ROW EXECUTE FUNCTION content.etl_notify_change('etl_changes');
+
+DROP TRIGGER IF EXISTS etl_notify_change ON content.genre_film_work;
+CREATE TRIGGER etl_notify_change AFTER INSERT OR UPDATE OR DELETE ON content.genre_film_work
+    FOR EACH ROW EXECUTE FUNCTION content.etl_notify_change('etl_changes');
@@ -1,7 +1,11 @@
 import abc
+import hashlib
 import json
-from typing import Any, Dict
-from redis import Redis
+import logging
+import os
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+from redis import Redis, ResponseError
 
 class BaseStorage(abc.ABC):
     """
@@ -18,29 +22,113 @@ class BaseStorage(abc.ABC):
     def retrieve_state(self) -> Dict[str, Any]:
         """Получить состояние из хранилища."""
 
+    def save_values(self, values: Dict[str, Any], state: Dict[str, Any]) -> None:
+        """
+        Сохранить изменённые ключи values; state — состояние целиком после изменения.
+        По умолчанию состояние перезаписывается целиком.
+        """
+        self.save_state(state)
+
+    def stage(self, pipe, values: Dict[str, Any]) -> bool:
+        """
+        Добавить запись values в транзакцию Redis pipe.
+        False — хранилище в транзакциях Redis не участвует.
+        """
+        return False
+
 class RedisStorage(BaseStorage):
     """
     Хранилище состояния, использующее Redis.
-    Данные хранятся в виде JSON-строки по заданному ключу.
+    Состояние хранится в hash: поле на ключ состояния, значение — JSON.
+    Изменённые ключи пишутся одной командой HSET, поэтому курсор (last_updated_at, last_id)
+    не может сохраниться наполовину, а запись можно включить в транзакцию вместе
+    с записью документов в очередь (см. stage).
+    Состояние в прежнем формате (JSON-строка по тому же ключу) переводится в hash при чтении.
     """
 
     def __init__(self, redis_adapter: Redis, redis_key: str = 'etl_state'):
         self.redis_adapter = redis_adapter
         self.redis_key = redis_key
 
+    @staticmethod
+    def _encode(values: Dict[str, Any]) -> Dict[str, str]:
+        return {key: json.dumps(value) for key, value in values.items()}
+
     def save_state(self, state: Dict[str, Any]) -> None:
-        """Сохраняет состояние в Redis."""
-        self.redis_adapter.set(self.redis_key, json.dumps(state))
+        """Перезаписывает состояние в Redis целиком."""
+        pipe = self.redis_adapter.pipeline(transaction=True)
+        pipe.delete(self.redis_key)
+        if state:
+            pipe.hset(self.redis_key, mapping=self._encode(state))
+        pipe.execute()
+
+    def save_values(self, values: Dict[str, Any], state: Dict[str, Any]) -> None:
+        """Сохраняет только изменённые ключи."""
+        if values:
+            self.redis_adapter.hset(self.redis_key, mapping=self._encode(values))
+
+    def stage(self, pipe, values: Dict[str, Any]) -> bool:
+        if values:
+            pipe.hset(self.redis_key, mapping=self._encode(values))
+        return True
 
     def retrieve_state(self) -> Dict[str, Any]:
         """Загружает состояние из Redis."""
-        data = self.redis_adapter.get(self.redis_key)
-        if data:
+        try:
+            data = self.redis_adapter.hgetall(self.redis_key)
+        except ResponseError as e:
+            if 'WRONGTYPE' not in str(e):
+                raise
+            return self._migrate()
+        state = {}
+        for key, value in data.items():
+            if isinstance(key, bytes):
+                key = key.decode()
             try:
-                return json.loads(data)
+                state[key] = json.loads(value)
             except json.JSONDecodeError:
-                return {}
-        return {}
+                continue
+        return state
+
+    def _migrate(self) -> Dict[str, Any]:
+        """Переводит состояние из JSON-строки в hash."""
+        data = self.redis_adapter.get(self.redis_key)
+        try:
+            state = json.loads(data) if data else {}
+        except json.JSONDecodeError as e:
+            logging.warning(f"Состояние '{self.redis_key}' повреждено ({e}), выгрузка начнётся с начала.")
+            state = {}
+        self.save_state(state)
+        return state
+
+class JsonFileStorage(BaseStorage):
+    """
+    Хранилище состояния в JSON-файле для локальных запусков.
+    Файл перезаписывается атомарно: состояние пишется во временный файл и подменяет прежний.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = Path(file_path)
+
+    def save_state(self, state: Dict[str, Any]) -> None:
+        self.file_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.file_path.with_name(self.file_path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.file_path)
+
+    def retrieve_state(self) -> Dict[str, Any]:
+        try:
+            with open(self.file_path, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except json.JSONDecodeError as e:
+            # Пустое состояние запускает все курсоры с начала источника: об этом нужно знать.
+            logging.warning(f"Файл состояния '{self.file_path}' повреждён ({e}), выгрузка начнётся с начала.")
+            return {}
 
 class State:
     """
@@ -55,9 +143,66 @@ class State:
 
     def set_state(self, key: str, value: Any) -> None:
         """Установить значение для ключа и сохранить состояние."""
-        self._state[key] = value
-        self.storage.save_state(self._state)
+        self.set_states({key: value})
+
+    def set_states(self, values: Dict[str, Any]) -> None:
+        """Установить несколько значений и сохранить их одной записью."""
+        self._state.update(values)
+        self.storage.save_values(values, self._state)
+
+    def stage(self, pipe, values: Dict[str, Any]) -> Callable[[], None]:
+        """
+        Добавляет запись values в транзакцию pipe (MULTI/EXEC) вместе с другими командами,
+        например с записью документов в очередь. Возвращает функцию, которую нужно вызвать
+        после успешного execute: она обновляет состояние в памяти, а если хранилище
+        в транзакциях Redis не участвует — сохраняет значения отдельной записью.
+        """
+        staged = self.storage.stage(pipe, values)
+
+        def applied() -> None:
+            self._state.update(values)
+            if not staged:
+                self.storage.save_values(values, self._state)
+        return applied
 
     def get_state(self, key: str, default: Any = None) -> Any:
         """Получить значение по ключу из состояния."""
         return self._state.get(key, default)
+
+
+class FanoutCheckpoint:
+    """
+    Прогресс разворачивания страницы источника (персон или жанров) в фильмы.
+    Хранится в состоянии продюсера рядом с курсором, поэтому после падения
+    посреди разворачивания та же страница продолжается с последнего обработанного фильма.
+    Если страница источника изменилась, отметка игнорируется и разворачивание начинается заново.
+    """
+
+    KEY = 'fanout'
+
+    def __init__(self, state: State, source_ids: List[Any]):
+        self.state = state
+        self.page = hashlib.md5(','.join(str(sid) for sid in source_ids).encode()).hexdigest()
+
+    def resume_after(self) -> Optional[str]:
+        """id последнего обработанного фильма этой страницы или None."""
+        checkpoint = self.state.get_state(self.KEY)
+        if checkpoint and checkpoint.get('page') == self.page:
+            return checkpoint.get('last_film_id')
+        return None
+
+    def values(self, last_film_id: Any) -> Dict[str, Any]:
+        """Значения состояния, отмечающие last_film_id обработанным."""
+        return {self.KEY: {'page': self.page, 'last_film_id': str(last_film_id)}}
+
+    def save(self, last_film_id: Any) -> None:
+        self.state.set_states(self.values(last_film_id))
+
+    def stage(self, pipe, last_film_id: Any) -> Callable[[], None]:
+        """Отметка в транзакции pipe, см. State.stage."""
+        return self.state.stage(pipe, self.values(last_film_id))
+
+    @classmethod
+    def cleared(cls) -> Dict[str, Any]:
+        """Значения, снимающие отметку. Добавляются к сдвигу курсора, чтобы записать всё одной командой."""
+        return {cls.KEY: None}
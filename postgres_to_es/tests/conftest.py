@@ -0,0 +1,81 @@
+import os
+import sys
+
+import fakeredis
+import orjson
+import pytest
+
+# Модули ETL лежат плоско в postgres_to_es и импортируются без пакета, как при запуске main.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# config.settings читается при импорте main: адреса сервисов тестам не нужны, но обязательны
+for name, value in {
+    'POSTGRES_DB': 'movies', 'POSTGRES_USER': 'app', 'POSTGRES_PASSWORD': 'app', 'SQL_HOST': 'localhost', 'SQL_PORT': '5432',
+    'REDIS_HOST': 'localhost', 'REDIS_PORT': '6379', 'ELASTIC_HOST': 'localhost', 'ELASTIC_PORT': '9200',
+}.items():
+    os.environ.setdefault(name, value)
+
+import loader as loader_module  # noqa: E402
+from doc_queue import RedisStreamQueue  # noqa: E402
+
+
+class FakeIndex:
+    """
+    Индекс в памяти вместо Elasticsearch: {id: (версия, документ)}.
+    index с version_type=external_gte отклоняет версию меньше сохранённой (409),
+    а скриптовый update (см. update) увеличивает сохранённую версию на единицу.
+    """
+
+    def __init__(self):
+        self.docs = {}
+
+    def streaming_bulk(self, client, actions, **kwargs):
+        for action in actions:
+            doc_id, version = action['_id'], action.get('version')
+            stored = self.docs.get(doc_id)
+            if version is not None and stored is not None and version < stored[0]:
+                yield False, {'index': {'_id': doc_id, 'status': 409, 'error': {'type': 'version_conflict_engine_exception'}}}
+                continue
+            self.docs[doc_id] = (version, orjson.loads(action['_source']))
+            yield True, {'index': {'_id': doc_id, 'status': 200}}
+
+    async def async_streaming_bulk(self, client, actions, **kwargs):
+        for response in self.streaming_bulk(client, actions, **kwargs):
+            yield response
+
+    def update(self, doc_id, **fields):
+        version, doc = self.docs[doc_id]
+        self.docs[doc_id] = ((version or 0) + 1, doc | fields)
+
+    def source(self, doc_id):
+        return self.docs[doc_id][1]
+
+
+@pytest.fixture
+def index(monkeypatch):
+    """Индекс в памяти, в который пишут оба загрузчика."""
+    fake = FakeIndex()
+    monkeypatch.setattr(loader_module.helpers, 'streaming_bulk', fake.streaming_bulk)
+    monkeypatch.setattr(loader_module.helpers, 'async_streaming_bulk', fake.async_streaming_bulk)
+    return fake
+
+
+@pytest.fixture
+def server():
+    """Общий fakeredis-сервер: соединения с ним ведут себя как отдельные процессы."""
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def redis_connection(server):
+    """Текстовое соединение, как у состояния, множества грязных фильмов и отпечатков."""
+    return fakeredis.FakeRedis(server=server, decode_responses=True)
+
+
+@pytest.fixture
+def make_queue(server):
+    """make_queue(consumer, **options) -> очередь документов потребителя consumer на общем сервере."""
+    def make(consumer, **options):
+        options = {'stream': 'movies', 'group': 'loaders', 'entry_size': 10} | options
+        return RedisStreamQueue(fakeredis.FakeRedis(server=server), consumer=consumer, **options)
+    return make
@@ -0,0 +1,206 @@
+"""
+Обработчики источников асинхронного режима: фильмы отмечаются в общем множестве грязных фильмов
+и собираются один раз, сколько бы источников их ни затронуло, а переименования применяются
+частичными обновлениями, только когда очередь пуста. Экстрактор сообщает о прогрессе
+догоняющей выгрузки. Очередь, множество и состояние работают на fakeredis,
+PostgreSQL и Elasticsearch заменены заглушками.
+"""
+import asyncio
+import logging
+
+import fakeredis
+import pytest
+
+from async_pipeline import AsyncPipeline, AsyncPostgresEnricher, AsyncPostgresProducer
+from config import settings
+from dirty_set import AsyncDirtyFilmSet
+from doc_queue import AsyncRedisStreamQueue, latest_documents
+from partial_updates import SourceChanges
+from producer import PostgresProducer
+from state import FanoutCheckpoint, RedisStorage, State
+from transformer import PostgresTransformer, encode_film
+
+FILM_A, FILM_B, FILM_C = (f'{n:08d}-0000-0000-0000-000000000000' for n in (1, 2, 3))
+PERSON_ID = '6a3c1a29-5bd0-4d19-8a6f-2a4bd0e9a3c5'
+FILM_WORK = settings.producer_configs[0]
+PERSON = settings.producer_configs[1]
+
+
+class FakeEnricher:
+    """Персона связана с фильмами A и C."""
+
+    async def iter_film_ids(self, source_ids, source_type, after_id=None):
+        if source_ids:
+            yield [FILM_A, FILM_C]
+
+
+class FakeMerger:
+    def __init__(self):
+        self.fetched = []
+
+    async def fetch(self, film_work_ids, mode='aggregated'):
+        self.fetched.extend(film_work_ids)
+        return [(fw_id, 'Star Wars', None, None, {}, []) for fw_id in film_work_ids]
+
+
+class FakePartialUpdater:
+    """Персона переименована, её связи не изменились."""
+
+    def __init__(self):
+        self.applied = []
+        self.snapshots = {}
+
+    def supports(self, source_type):
+        return source_type == 'person'
+
+    def classify(self, source_type, source_ids):
+        return SourceChanges([], {PERSON_ID: ('Alice', 'Zoe')}, {PERSON_ID: '["Zoe", "relations"]'})
+
+    def apply_renames(self, source_type, renames):
+        self.applied.append(renames)
+        return []
+
+    def commit(self, source_type, snapshots):
+        self.snapshots.update(snapshots)
+
+
+@pytest.fixture
+def doc_queue(server):
+    return AsyncRedisStreamQueue(fakeredis.FakeAsyncRedis(server=server), stream='movies', group='loaders',
+                                 consumer='loader', entry_size=10)
+
+
+def producer(redis_connection, config):
+    return PostgresProducer(None, State(RedisStorage(redis_connection, config.state_key)), config.table)
+
+
+async def run_sources(pipeline, doc_queue, dirty_set, merger, pages_by_source, partial=None, dirty_before_flush=0,
+                      before_flush=None):
+    """
+    Запускает обработчики источников на одной странице каждый и ждёт, пока страницы обработаны.
+    Если задан dirty_before_flush, сборка фильмов заблокирована, пока в множестве не наберётся
+    столько фильмов, и перед ней вызывается before_flush.
+    """
+    tasks = []
+    async with pipeline._flush_lock:
+        for config, source_producer, rows in pages_by_source:
+            pages = asyncio.Queue()
+            await pages.put(rows)
+            stages = (FakeEnricher(), merger, PostgresTransformer(None), partial)
+            tasks.append((pages, asyncio.create_task(
+                pipeline._process(config, source_producer, pages, doc_queue, dirty_set, *stages))))
+        while await dirty_set.size() < dirty_before_flush:
+            await asyncio.sleep(0)
+        if before_flush is not None:
+            before_flush()
+    try:
+        await asyncio.wait_for(asyncio.gather(*(pages.join() for pages, _ in tasks)), timeout=5)
+    finally:
+        for _, task in tasks:
+            task.cancel()
+        await asyncio.gather(*(task for _, task in tasks), return_exceptions=True)
+
+
+def test_film_touched_by_several_sources_is_built_once(redis_connection, doc_queue):
+    pipeline = AsyncPipeline(settings)
+    dirty_set = AsyncDirtyFilmSet(doc_queue.redis, settings.dirty_set_key)
+    merger = FakeMerger()
+    film_work = producer(redis_connection, FILM_WORK)
+    person = producer(redis_connection, PERSON)
+
+    def before_flush():
+        # Курсор film_work сдвинут вместе с отметкой фильмов, а курсор персон ждёт сборки
+        assert State(RedisStorage(redis_connection, FILM_WORK.state_key)).get_state('last_id') == FILM_B
+        assert State(RedisStorage(redis_connection, PERSON.state_key)).get_state('last_id') is None
+
+    asyncio.run(run_sources(pipeline, doc_queue, dirty_set, merger, [
+        (FILM_WORK, film_work, [(FILM_A, '2024-01-01 00:00:00+00:00'), (FILM_B, '2024-01-02 00:00:00+00:00')]),
+        (PERSON, person, [(PERSON_ID, '2024-01-03 00:00:00+00:00')]),
+    ], dirty_before_flush=3, before_flush=before_flush))
+
+    assert sorted(merger.fetched) == [FILM_A, FILM_B, FILM_C]
+    records, _ = latest_documents(asyncio.run(doc_queue.read(10)))
+    assert sorted(record.id for record in records) == [FILM_A, FILM_B, FILM_C]
+    assert asyncio.run(dirty_set.size()) == 0
+
+    restarted = State(RedisStorage(redis_connection, PERSON.state_key))
+    assert restarted.get_state('last_id') == PERSON_ID
+    assert FanoutCheckpoint(restarted, [PERSON_ID]).resume_after() is None
+
+
+def test_rename_is_applied_in_place_when_queue_is_empty(redis_connection, doc_queue):
+    partial = FakePartialUpdater()
+    merger = FakeMerger()
+    person = producer(redis_connection, PERSON)
+
+    asyncio.run(run_sources(AsyncPipeline(settings), doc_queue, AsyncDirtyFilmSet(doc_queue.redis), merger,
+                            [(PERSON, person, [(PERSON_ID, '2024-01-03 00:00:00+00:00')])], partial))
+
+    assert partial.applied == [{PERSON_ID: ('Alice', 'Zoe')}]
+    assert merger.fetched == []
+    assert partial.snapshots == {PERSON_ID: '["Zoe", "relations"]'}
+    assert State(RedisStorage(redis_connection, PERSON.state_key)).get_state('last_id') == PERSON_ID
+
+
+def test_rename_rebuilds_films_while_queue_is_not_empty(redis_connection, doc_queue):
+    partial = FakePartialUpdater()
+    merger = FakeMerger()
+    person = producer(redis_connection, PERSON)
+    # В очереди документ, собранный до переименования: update он бы перезаписал
+    asyncio.run(doc_queue.push([encode_film(FILM_A, 'Star Wars', None, None, [], [{'id': PERSON_ID, 'name': 'Alice'}], [], [])]))
+
+    asyncio.run(run_sources(AsyncPipeline(settings), doc_queue, AsyncDirtyFilmSet(doc_queue.redis), merger,
+                            [(PERSON, person, [(PERSON_ID, '2024-01-03 00:00:00+00:00')])], partial))
+
+    assert partial.applied == []
+    assert sorted(merger.fetched) == [FILM_A, FILM_C]
+    assert partial.snapshots == {PERSON_ID: '["Zoe", "relations"]'}
+    assert State(RedisStorage(redis_connection, PERSON.state_key)).get_state('last_id') == PERSON_ID
+
+
+class PagedProducer(AsyncPostgresProducer):
+    """Источник из двух полных страниц; остаток считается по позиции экстрактора."""
+
+    def __init__(self, state, pages, total):
+        super().__init__(None, state, FILM_WORK.table, batch_size=len(pages[0]))
+        self.pages = pages
+        self.total = total
+        self.read = 0
+
+    async def extract(self):
+        rows = self.pages.pop(0) if self.pages else []
+        self.read += len(rows)
+        return rows
+
+    async def count_remaining(self):
+        return self.total - self.read
+
+
+def test_catchup_progress_is_reported(redis_connection, caplog):
+    pipeline = AsyncPipeline(settings.model_copy(update={'batch_size': 2, 'catchup_report_every': 1}))
+    rows = [(FILM_A, '2024-01-01 00:00:00+00:00'), (FILM_B, '2024-01-02 00:00:00+00:00')]
+    source = PagedProducer(State(RedisStorage(redis_connection, FILM_WORK.state_key)), [rows, rows], total=7)
+
+    async def extract_two_pages():
+        pages = asyncio.Queue()
+        task = asyncio.create_task(pipeline._extract(FILM_WORK, source, pages))
+        while pages.qsize() < 2:
+            await asyncio.sleep(0)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    with caplog.at_level(logging.INFO):
+        asyncio.run(extract_two_pages())
+    assert "Догоняющая выгрузка 'film_work': обработано 2, осталось 5" in caplog.text
+    assert "Догоняющая выгрузка 'film_work': обработано 4, осталось 3" in caplog.text
+
+
+class PagedEnricher(AsyncPostgresEnricher):
+    async def fetch_fanout_page(self, source_ids, source_type, after_id=None):
+        film_work_ids = [FILM_A, FILM_B, FILM_C]
+        start = film_work_ids.index(after_id) + 1 if after_id else 0
+        return film_work_ids[start:start + self.chunk_size]
+
+
+def test_async_enrich_collects_all_fanout_pages():
+    assert asyncio.run(PagedEnricher(None, chunk_size=2).enrich([PERSON_ID], 'person')) == [FILM_A, FILM_B, FILM_C]
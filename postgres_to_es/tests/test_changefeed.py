@@ -0,0 +1,125 @@
+"""
+Push-источник изменений: уведомления NOTIFY группируются по источнику и схлопываются
+до уникальных id, а пачка изменений собирает каждый затронутый фильм один раз.
+Соединение LISTEN заменено заглушкой поверх pipe, множество грязных фильмов и очередь — fakeredis.
+"""
+import json
+import os
+from types import SimpleNamespace
+
+from psycopg import OperationalError
+
+from changefeed import PostgresChangeListener
+from dirty_set import DirtyFilmSet
+from doc_queue import latest_documents
+from main import process_changes
+from transformer import PostgresTransformer
+
+FILM_A, FILM_B, FILM_C = (f'{n:08d}-0000-0000-0000-000000000000' for n in (1, 2, 3))
+PERSON_ID = '6a3c1a29-5bd0-4d19-8a6f-2a4bd0e9a3c5'
+
+
+def notification(table, row_id):
+    return json.dumps({'table': table, 'id': row_id}).encode()
+
+
+class StubNotifyConnection:
+    """
+    Соединение LISTEN: уведомления уже пришли в сокет (pipe готов к чтению),
+    и notifies() отдаёт их только после consume_input, как libpq.
+    """
+
+    def __init__(self, payloads, fail=False):
+        self.read_end, self.write_end = os.pipe()
+        self.unread = [SimpleNamespace(extra=payload) for payload in payloads]
+        self.pending = []
+        self.fail = fail
+        self.closed = False
+        self.pgconn = self
+        if payloads:
+            os.write(self.write_end, b'!')
+
+    def fileno(self):
+        return self.read_end
+
+    def consume_input(self):
+        if self.fail:
+            raise OperationalError('server closed the connection unexpectedly')
+        os.read(self.read_end, 1)
+        self.pending, self.unread = self.pending + self.unread, []
+
+    def notifies(self):
+        return self.pending.pop(0) if self.pending else None
+
+    def close(self):
+        self.closed = True
+        os.close(self.read_end)
+        os.close(self.write_end)
+
+
+def listen(payloads, **options):
+    listener = PostgresChangeListener({})
+    listener.conn = StubNotifyConnection(payloads, **options)
+    return listener
+
+
+def test_notifications_are_grouped_by_source_and_coalesced():
+    listener = listen([
+        notification('film_work', FILM_A),
+        notification('person', PERSON_ID),
+        notification('film_work', FILM_A),
+        notification('film_work', FILM_B),
+        b'not json',
+        json.dumps({'table': 'genre'}).encode(),
+    ])
+
+    assert listener.poll(timeout=1) == {'film_work': {FILM_A, FILM_B}, 'person': {PERSON_ID}}
+
+
+def test_poll_takes_at_most_max_items():
+    listener = listen([notification('film_work', film_id) for film_id in (FILM_A, FILM_B, FILM_C)])
+
+    assert listener.poll(timeout=1, max_items=2) == {'film_work': {FILM_A, FILM_B}}
+    assert listener.poll(timeout=0, max_items=2) == {'film_work': {FILM_C}}
+
+
+def test_poll_without_notifications_returns_after_timeout():
+    assert listen([]).poll(timeout=0.01) == {}
+
+
+def test_lost_connection_is_dropped_for_reconnect():
+    listener = listen([notification('film_work', FILM_A)], fail=True)
+    conn = listener.conn
+
+    assert listener.poll(timeout=1) == {}
+    assert conn.closed and listener.conn is None
+
+
+class StubEnricher:
+    """Персона связана с фильмами A и C."""
+
+    def iter_film_ids(self, source_ids, source_type, after_id=None):
+        yield [FILM_A, FILM_C]
+
+
+class StubMerger:
+    def __init__(self):
+        self.fetched = []
+
+    def fetch(self, film_work_ids, mode='aggregated'):
+        self.fetched.extend(film_work_ids)
+        return [(fw_id, 'Star Wars', None, None, {}, []) for fw_id in film_work_ids]
+
+
+def test_changes_build_each_film_once(redis_connection, make_queue):
+    dirty_set = DirtyFilmSet(redis_connection)
+    merger = StubMerger()
+    queue = make_queue('loader')
+
+    process_changes({'film_work': {FILM_A, FILM_B}, 'person': {PERSON_ID}}, StubEnricher(), merger,
+                    PostgresTransformer(None), queue, dirty_set)
+
+    assert sorted(merger.fetched) == [FILM_A, FILM_B, FILM_C]
+    records, _ = latest_documents(queue.read(10))
+    assert sorted(record.id for record in records) == [FILM_A, FILM_B, FILM_C]
+    assert len(dirty_set) == 0
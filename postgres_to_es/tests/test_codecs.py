@@ -0,0 +1,82 @@
+"""
+Кодеки очереди документов: пачка проходит через поток на fakeredis без потерь при любом
+сочетании сериализатора и сжатия, а JSON-документы при passthrough отдаются как есть.
+"""
+import uuid
+
+import orjson
+import pytest
+
+from doc_queue import latest_documents
+from serializers import RawDocument, get_codec
+from transformer import encode_film
+
+CODECS = ['json', 'json+zstd', 'json+lz4', 'msgpack', 'msgpack+zstd', 'msgpack+lz4']
+PERSON_ID = uuid.UUID('6a3c1a29-5bd0-4d19-8a6f-2a4bd0e9a3c5')
+
+
+def film_id(n):
+    return f'{n:08d}-0000-0000-0000-000000000000'
+
+
+def documents():
+    """Документы трансформера (RawDocument) вперемешку со словарями, в том числе с UUID."""
+    actors = [{'id': PERSON_ID, 'name': 'Марк Хэмилл'}]
+    return [
+        encode_film(film_id(1), 'Star Wars', 'Далёкая галактика', 8.6, ['Sci-Fi'], actors, [], []),
+        {'id': film_id(2), 'title': 'Empire', 'imdb_rating': None, 'actors': [{'id': PERSON_ID, 'name': 'Harrison'}]},
+    ]
+
+
+def expected():
+    return {
+        film_id(1): orjson.loads(documents()[0].source),
+        film_id(2): {'id': film_id(2), 'title': 'Empire', 'imdb_rating': None,
+                     'actors': [{'id': str(PERSON_ID), 'name': 'Harrison'}]},
+    }
+
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_batch_round_trips_through_queue(make_queue, codec):
+    queue = make_queue('loader', codec=codec, passthrough=False)
+    queue.push(documents())
+
+    records, _ = latest_documents(queue.read(10))
+
+    assert {record['id']: record for record in records} == expected()
+
+
+@pytest.mark.parametrize('codec', ['json', 'json+zstd', 'json+lz4'])
+def test_json_documents_are_passed_through_without_decoding(make_queue, codec):
+    queue = make_queue('loader', codec=codec)
+    queue.push(documents())
+
+    records, _ = latest_documents(queue.read(10))
+
+    assert all(isinstance(record, RawDocument) for record in records)
+    # Документ трансформера уходит в bulk теми же байтами, что он закодировал
+    assert next(record.source for record in records if record.id == film_id(1)) == documents()[0].source
+    assert {record.id: orjson.loads(record.source) for record in records} == expected()
+
+
+@pytest.mark.parametrize('codec', ['msgpack', 'msgpack+lz4'])
+def test_msgpack_is_decoded_even_with_passthrough(make_queue, codec):
+    queue = make_queue('loader', codec=codec)
+    queue.push(documents())
+
+    records, _ = latest_documents(queue.read(10))
+
+    assert {record['id']: record for record in records} == expected()
+
+
+@pytest.mark.parametrize('codec', ['json+zstd', 'json+lz4', 'msgpack+zstd'])
+def test_compression_shrinks_repetitive_batches(codec):
+    batch = [encode_film(film_id(n), 'Star Wars', 'Далёкая галактика', 8.6, ['Sci-Fi'], [], [], []) for n in range(100)]
+
+    assert len(get_codec(codec).encode(batch)) < len(get_codec('json').encode(batch)) / 2
+
+
+@pytest.mark.parametrize('name', ['xml', 'json+gzip'])
+def test_unknown_codec_is_rejected(name):
+    with pytest.raises(ValueError):
+        get_codec(name)
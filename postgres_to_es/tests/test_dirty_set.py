@@ -0,0 +1,88 @@
+"""Множество грязных фильмов: пачка уходит из множества только вместе с её документами в очереди."""
+import orjson
+import pytest
+
+from dirty_set import DirtyFilmSet
+from doc_queue import RedisStreamQueue
+from serializers import RawDocument
+
+FILM_IDS = ['film-1', 'film-2', 'film-3']
+
+
+@pytest.fixture
+def dirty_set(redis_connection):
+    return DirtyFilmSet(redis_connection)
+
+
+@pytest.fixture
+def doc_queue(redis_connection):
+    return RedisStreamQueue(redis_connection, stream='movies', group='loaders', consumer='loader-1', entry_size=10)
+
+
+def documents(film_work_ids):
+    return [RawDocument(fw_id, orjson.dumps({'id': fw_id})) for fw_id in film_work_ids]
+
+
+def test_batch_is_removed_with_its_documents(dirty_set, doc_queue):
+    dirty_set.add(FILM_IDS, 'film_work')
+
+    batch = next(dirty_set.batches(10))
+    assert sorted(batch) == FILM_IDS
+    doc_queue.push(documents(batch), stage=lambda pipe: dirty_set.stage_remove(pipe, batch))
+
+    assert len(dirty_set) == 0
+    assert doc_queue.length() == 1
+    assert next(dirty_set.batches(10), None) is None
+
+
+def test_interrupted_push_keeps_batch_dirty(dirty_set, doc_queue):
+    dirty_set.add(FILM_IDS, 'film_work')
+
+    def stage(pipe):
+        dirty_set.stage_remove(pipe, FILM_IDS)
+        raise RuntimeError("процесс упал до EXEC")
+
+    with pytest.raises(RuntimeError):
+        doc_queue.push(documents(FILM_IDS), stage=stage)
+
+    # Ни документы, ни удаление из множества не записаны: пачка соберётся снова
+    assert len(dirty_set) == 3
+    assert doc_queue.length() == 0
+
+
+def test_staged_add_is_written_only_by_exec(redis_connection, dirty_set):
+    with redis_connection.pipeline(transaction=True) as pipe:
+        dirty_set.stage_add(pipe, FILM_IDS, 'person')
+        assert len(dirty_set) == 0
+        pipe.execute()
+
+    assert len(dirty_set) == 3
+
+
+def test_batches_cover_the_set(dirty_set):
+    dirty_set.add(FILM_IDS, 'film_work')
+
+    seen = []
+    for batch in dirty_set.batches(2):
+        assert len(batch) <= 2
+        seen.extend(batch)
+        dirty_set.redis.srem(dirty_set.key, *batch)
+    assert sorted(seen) == FILM_IDS
+
+
+def test_dedup_ratio_counts_films_touched_by_several_sources(redis_connection, dirty_set):
+    assert dirty_set.dedup_ratio() == 0.0
+
+    dirty_set.add(FILM_IDS, 'film_work')
+    dirty_set.add(FILM_IDS[:2], 'person')
+    dirty_set.add(FILM_IDS[:1], 'genre')
+    with redis_connection.pipeline(transaction=True) as pipe:
+        dirty_set.stage_remove(pipe, FILM_IDS)
+        pipe.execute()
+
+    # Вклад источников 6, собрано 3 уникальных фильма
+    assert dirty_set.dedup_ratio() == pytest.approx(0.5)
+
+    dirty_set.end_cycle()
+    assert dirty_set.dedup_ratio() == 0.0
+    assert dirty_set.flushed == 0
@@ -0,0 +1,122 @@
+"""
+Повторная доставка и параллельные загрузчики: устаревшая пачка не перезаписывает более новый документ.
+
+Очередь работает на fakeredis, а вместо Elasticsearch — индекс в памяти (conftest.FakeIndex)
+с семантикой version_type=external_gte: запись с версией меньше сохранённой отклоняется с 409.
+"""
+import time
+
+import fakeredis
+import orjson
+from elasticsearch import Elasticsearch
+
+from doc_queue import current_version, latest_documents, stream_version
+from loader import ElasticsearchLoader
+from serializers import RawDocument
+
+FILM_ID = '3d825f60-9fff-4dfe-b294-1a45fa1e115d'
+
+
+def film(title):
+    return RawDocument(FILM_ID, orjson.dumps({'id': FILM_ID, 'title': title}))
+
+
+def load(queue, index_loader):
+    """Один шаг цикла загрузки: прочитать, загрузить с версиями, подтвердить."""
+    messages = queue.read(10)
+    records, versions = latest_documents(messages)
+    result = index_loader.load_to_es(records, versions)
+    queue.ack([message.id for message in messages])
+    return result
+
+
+def es_loader():
+    return ElasticsearchLoader(Elasticsearch('http://localhost:9200'), 'movies')
+
+
+def test_stream_version_follows_entry_order():
+    assert stream_version(b'1700000000000-1') > stream_version(b'1700000000000-0')
+    assert stream_version(b'1700000000001-0') > stream_version(b'1700000000000-999999')
+
+
+def test_current_version_is_between_earlier_and_later_messages(server, make_queue):
+    producer = make_queue('producer')
+    consumer = make_queue('consumer')
+    producer.push([film('before')])
+    time.sleep(0.002)
+    version = current_version(fakeredis.FakeRedis(server=server))
+    time.sleep(0.002)
+    producer.push([film('after')])
+
+    before, after = consumer.read(20)
+    assert before.version < version < after.version
+
+
+def test_redelivered_stale_message_is_rejected_and_acked(index, make_queue):
+    producer = make_queue('producer')
+    crashed = make_queue('crashed')
+    alive = make_queue('alive')
+
+    producer.push([film('old')])
+    # Загрузчик забрал старую пачку и упал, не подтвердив её
+    assert len(crashed.read(10)) == 1
+
+    producer.push([film('new')])
+    assert load(alive, es_loader()).success == 1
+    assert index.source(FILM_ID)['title'] == 'new'
+
+    # Старая пачка провисела дольше claim_idle_ms и доставляется повторно через XAUTOCLAIM
+    alive.claim_idle_ms = 0
+    result = load(alive, es_loader())
+    assert result.outdated == [FILM_ID]
+    assert result.failed == []
+    assert index.source(FILM_ID)['title'] == 'new'
+    assert producer.length() == 0
+
+
+def test_parallel_consumers_keep_newest_document(index, make_queue):
+    producer = make_queue('producer')
+    first, second = make_queue('first'), make_queue('second')
+
+    producer.push([film('old')])
+    producer.push([film('new')])
+    old_messages, new_messages = first.read(10), second.read(10)
+    assert len(old_messages) == len(new_messages) == 1
+
+    # Загрузчик с более новой пачкой успевает первым
+    for queue, messages in ((second, new_messages), (first, old_messages)):
+        records, versions = latest_documents(messages)
+        es_loader().load_to_es(records, versions)
+        queue.ack([message.id for message in messages])
+
+    assert index.source(FILM_ID)['title'] == 'new'
+    assert producer.length() == 0
+
+
+def test_latest_documents_keeps_newest_copy(make_queue):
+    producer = make_queue('producer')
+    consumer = make_queue('consumer', claim_idle_ms=0)
+    producer.push([film('old')])
+    make_queue('crashed').read(10)
+    producer.push([film('new')])
+
+    # Зависшая пачка и новая приходят в одном чтении
+    messages = consumer.read(20)
+    records, versions = latest_documents(messages)
+    assert len(messages) == 2
+    assert [orjson.loads(record.source)['title'] for record in records] == ['new']
+    assert versions == {FILM_ID: max(message.version for message in messages)}
+
+
+def test_deleted_message_claimed_on_redis_62_is_acked(make_queue, monkeypatch):
+    producer = make_queue('producer')
+    crashed = make_queue('crashed')
+    survivor = make_queue('survivor', claim_idle_ms=0)
+    producer.push([film('deleted')])
+    msg_id = crashed.read(10)[0].id
+    producer.redis.xdel('movies', msg_id)
+    # Redis 6.2 отдаёт удалённое сообщение с пустым телом и оставляет его ожидающим
+    monkeypatch.setattr(survivor.redis, 'xautoclaim', lambda *args, **kwargs: [b'0-0', [(msg_id, {})]])
+
+    assert survivor.read(10) == []
+    assert survivor.redis.xpending('movies', 'loaders')['pending'] == 0
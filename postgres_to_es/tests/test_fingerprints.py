@@ -0,0 +1,51 @@
+"""Отпечатки при нескольких загрузчиках: запись, удаление и сброс одного процесса сразу видны другому."""
+import fakeredis
+import pytest
+
+from fingerprints import FingerprintStore, fingerprint
+
+FILM_ID = '3d825f60-9fff-4dfe-b294-1a45fa1e115d'
+DIGEST_A, DIGEST_B = fingerprint(b'{"title":"A"}'), fingerprint(b'{"title":"B"}')
+
+
+@pytest.fixture
+def stores(server):
+    return (FingerprintStore(fakeredis.FakeRedis(server=server)),
+            FingerprintStore(fakeredis.FakeRedis(server=server)))
+
+
+def test_revert_after_other_loader_is_not_skipped(stores):
+    first, second = stores
+    first.remember({FILM_ID: DIGEST_A})
+    second.remember({FILM_ID: DIGEST_B})
+
+    # В индексе версия B, поэтому возврат к A у первого загрузчика нужно загрузить
+    assert first.changed({FILM_ID: DIGEST_A}) == {FILM_ID: DIGEST_A}
+
+
+def test_unchanged_document_is_skipped(stores):
+    first, second = stores
+    first.remember({FILM_ID: DIGEST_A})
+
+    assert first.changed({FILM_ID: DIGEST_A}) == {}
+    assert second.changed({FILM_ID: DIGEST_A}) == {}
+    assert first.skip_rate() == 1.0
+
+
+def test_forgotten_document_is_loaded_again(stores):
+    first, second = stores
+    first.remember({FILM_ID: DIGEST_A})
+    first.changed({FILM_ID: DIGEST_A})
+    second.forget([FILM_ID])
+
+    assert first.changed({FILM_ID: DIGEST_A}) == {FILM_ID: DIGEST_A}
+
+
+def test_reset_by_other_process_reloads_documents(stores):
+    first, second = stores
+    first.remember({FILM_ID: DIGEST_A})
+    assert first.changed({FILM_ID: DIGEST_A}) == {}
+
+    second.reset()
+
+    assert first.changed({FILM_ID: DIGEST_A}) == {FILM_ID: DIGEST_A}
@@ -0,0 +1,129 @@
+"""
+Версии индекса и алиас поверх них: Elasticsearch заменён заглушкой, которая хранит индексы
+и алиасы в памяти и записывает вызовы по порядку.
+"""
+import pytest
+
+from config import settings
+from index_manager import IndexManager
+
+
+class StubIndices:
+    """indices-клиент в памяти: {индекс: настройки} и {алиас: множество индексов}."""
+
+    def __init__(self, indices=(), aliases=None):
+        self.indices = {name: {} for name in indices}
+        self.aliases = aliases or {}
+        self.calls = []
+
+    def get(self, index, **kwargs):
+        prefix = index.rstrip('*')
+        return {name: {} for name in self.indices if name.startswith(prefix)}
+
+    def get_alias(self, name):
+        return {index: {} for index in sorted(self.aliases.get(name, ()))}
+
+    def exists(self, index):
+        return index in self.indices
+
+    def exists_alias(self, name):
+        return name in self.aliases
+
+    def create(self, index, settings, mappings):
+        self.calls.append(('create', index))
+        self.indices[index] = dict(settings, mappings=mappings)
+
+    def forcemerge(self, index, max_num_segments):
+        self.calls.append(('forcemerge', index))
+
+    def put_settings(self, index, settings):
+        self.calls.append(('put_settings', index))
+        self.indices[index].update(settings['index'])
+
+    def refresh(self, index):
+        self.calls.append(('refresh', index))
+
+    def update_aliases(self, actions):
+        self.calls.append(('update_aliases', actions))
+        for action in actions:
+            (kind, params), = action.items()
+            if kind == 'add':
+                self.aliases.setdefault(params['alias'], set()).add(params['index'])
+            elif kind == 'remove':
+                self.aliases[params['alias']].discard(params['index'])
+            else:
+                del self.indices[params['index']]
+
+
+class StubElasticsearch:
+    def __init__(self, indices):
+        self.indices = indices
+
+    def options(self, **kwargs):
+        return self
+
+
+def make_manager(indices=(), aliases=None):
+    stub = StubIndices(indices, aliases)
+    return IndexManager(StubElasticsearch(stub), 'movies', settings.es.schema_path), stub
+
+
+def test_bulk_index_is_created_for_loading():
+    manager, stub = make_manager(['movies_v1', 'movies_v2', 'movies_other'], {'movies': {'movies_v2'}})
+
+    index_name = manager.create_bulk_index(manager.next_index_name())
+
+    assert index_name == 'movies_v3'
+    assert stub.indices['movies_v3']['refresh_interval'] == '-1'
+    assert stub.indices['movies_v3']['number_of_replicas'] == 0
+    assert stub.indices['movies_v3']['mappings'] == manager.load_schema()['mappings']
+
+
+def test_finalize_merges_restores_settings_and_swaps_alias():
+    manager, stub = make_manager(['movies_v1', 'movies_v2'], {'movies': {'movies_v1'}})
+    seen_before_swap = []
+
+    manager.finalize('movies_v2', before_swap=seen_before_swap.extend)
+
+    schema_settings = manager.load_schema().get('settings', {})
+    assert [call[0] for call in stub.calls] == ['forcemerge', 'put_settings', 'refresh', 'update_aliases']
+    assert stub.indices['movies_v2']['refresh_interval'] == schema_settings.get('refresh_interval')
+    assert seen_before_swap == ['movies_v1']
+    # Переключение одним запросом: между remove и add алиас не бывает пустым
+    assert stub.calls[-1][1] == [{'remove': {'index': 'movies_v1', 'alias': 'movies'}},
+                                 {'add': {'index': 'movies_v2', 'alias': 'movies'}}]
+    assert stub.aliases['movies'] == {'movies_v2'}
+
+
+def test_rollback_returns_to_previous_version():
+    manager, stub = make_manager(['movies_v1', 'movies_v2', 'movies_v3'], {'movies': {'movies_v3'}})
+
+    assert manager.rollback() == 'movies_v2'
+    assert stub.aliases['movies'] == {'movies_v2'}
+    assert manager.rollback() == 'movies_v1'
+    with pytest.raises(RuntimeError):
+        manager.rollback()
+    assert stub.aliases['movies'] == {'movies_v1'}
+
+
+def test_legacy_index_is_not_dropped_without_flag():
+    manager, stub = make_manager(['movies', 'movies_v1'])
+
+    with pytest.raises(RuntimeError, match='--drop-legacy-index'):
+        manager.check_legacy_index()
+    with pytest.raises(RuntimeError, match='--drop-legacy-index'):
+        manager.swap_alias('movies_v1')
+
+    assert 'movies' in stub.indices
+    assert stub.calls == []
+
+
+def test_legacy_index_is_dropped_with_flag():
+    manager, stub = make_manager(['movies', 'movies_v1'])
+
+    manager.swap_alias('movies_v1', drop_legacy_index=True)
+
+    assert stub.calls[-1][1] == [{'remove_index': {'index': 'movies'}},
+                                 {'add': {'index': 'movies_v1', 'alias': 'movies'}}]
+    assert 'movies' not in stub.indices
+    assert stub.aliases['movies'] == {'movies_v1'}
@@ -0,0 +1,107 @@
+"""
+Синхронный и асинхронный загрузчики одинаково разбирают ответы bulk: повтор после 429,
+устаревшая версия (409), окончательный отказ и пропуск неизменившихся документов.
+Окончательно отклонённые документы при подтверждении пачки уходят в поток недоставленных.
+"""
+import asyncio
+
+import fakeredis
+import orjson
+import pytest
+from elasticsearch import AsyncElasticsearch, Elasticsearch
+
+import loader as loader_module
+from fingerprints import FingerprintStore
+from loader import AsyncElasticsearchLoader, ElasticsearchLoader
+from main import load_data_to_es
+from serializers import RawDocument
+
+OK, RETRY, OUTDATED, FAILED = 'ok', 'retry', 'outdated', 'failed'
+
+
+class ScriptedBulk:
+    """Ответы bulk по документам: по одному статусу на каждую попытку."""
+
+    STATUSES = {OK: 200, RETRY: 429, OUTDATED: 409, FAILED: 400}
+
+    def __init__(self, script):
+        self.script = {doc_id: list(statuses) for doc_id, statuses in script.items()}
+        self.sent = []
+
+    def respond(self, actions):
+        for action in actions:
+            doc_id = action['_id']
+            self.sent.append(doc_id)
+            status = self.STATUSES[self.script[doc_id].pop(0)]
+            yield status == 200, {'index': {'_id': doc_id, 'status': status, 'error': None if status == 200 else {'type': 'x'}}}
+
+    def streaming_bulk(self, client, actions, **kwargs):
+        return self.respond(actions)
+
+    async def async_streaming_bulk(self, client, actions, **kwargs):
+        for response in self.respond(actions):
+            yield response
+
+
+def film(doc_id, title='Star Wars'):
+    return RawDocument(doc_id, orjson.dumps({'id': doc_id, 'title': title}))
+
+
+@pytest.fixture(params=['sync', 'async'])
+def load(request, monkeypatch):
+    """load(script, records, fingerprints=None) -> LoadResult через загрузчик нужного режима."""
+    def run(script, records, fingerprints=None):
+        bulk = ScriptedBulk(script)
+        monkeypatch.setattr(loader_module.helpers, 'streaming_bulk', bulk.streaming_bulk)
+        monkeypatch.setattr(loader_module.helpers, 'async_streaming_bulk', bulk.async_streaming_bulk)
+        options = dict(initial_backoff=0, max_retries=2, fingerprints=fingerprints)
+        if request.param == 'sync':
+            result = ElasticsearchLoader(Elasticsearch('http://localhost:9200'), 'movies', **options).load_to_es(records)
+        else:
+            result = asyncio.run(_load_async(records, options))
+        return result, bulk.sent
+    return run
+
+
+async def _load_async(records, options):
+    es_conn = AsyncElasticsearch('http://localhost:9200')
+    try:
+        return await AsyncElasticsearchLoader(es_conn, 'movies', **options).load_to_es(records)
+    finally:
+        await es_conn.close()
+
+
+def test_responses_are_classified_per_document(load):
+    script = {'a': [OK], 'b': [RETRY, OK], 'c': [OUTDATED], 'd': [FAILED], 'e': [RETRY, RETRY, RETRY]}
+    result, sent = load(script, [film(doc_id) for doc_id in script])
+
+    assert result.success == 2
+    assert result.outdated == ['c']
+    assert sorted(failed['record'].id for failed in result.failed) == ['d', 'e']
+    # После 429 повторяются только отклонённые документы, не дольше max_retries попыток
+    assert sent == ['a', 'b', 'c', 'd', 'e', 'b', 'e', 'e']
+
+
+def test_unchanged_documents_are_skipped_and_rejected_are_not_remembered(load):
+    fingerprints = FingerprintStore(fakeredis.FakeRedis())
+    result, _ = load({'a': [OK], 'b': [FAILED]}, [film('a'), film('b')], fingerprints)
+    assert result.success == 1
+
+    result, sent = load({'b': [OK]}, [film('a'), film('b')], fingerprints)
+    assert result.skipped == 1
+    assert sent == ['b']
+
+
+def test_rejected_documents_are_moved_to_dead_letter_stream(make_queue, monkeypatch):
+    queue = make_queue('loader')
+    queue.push([film('a'), film('b', 'Broken')])
+    bulk = ScriptedBulk({'a': [OK], 'b': [FAILED]})
+    monkeypatch.setattr(loader_module.helpers, 'streaming_bulk', bulk.streaming_bulk)
+
+    load_data_to_es(ElasticsearchLoader(Elasticsearch('http://localhost:9200'), 'movies'), queue)
+
+    assert queue.length() == 0
+    (_, fields), = queue.redis.xrange(queue.dead_letter_stream)
+    assert fields[b'id'] == b'b'
+    assert fields[b'status'] == b'400'
+    assert orjson.loads(fields[b'source']) == {'id': 'b', 'title': 'Broken'}
@@ -0,0 +1,100 @@
+"""
+Замеры стадий: track_stage пишет время, строки и байты пачки в метрики Prometheus,
+вызывает хук пачки (трассировку медленных пачек) и профилирует выбранные стадии.
+Метрики общие для процесса, поэтому тесты сравнивают значения до и после пачки.
+"""
+import json
+import logging
+
+import pytest
+from prometheus_client import REGISTRY
+
+import metrics
+from metrics import observe_queue, slow_batch_logger, track_stage
+from serializers import RawDocument
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def stage_samples(stage):
+    return {
+        'count': sample('etl_stage_duration_seconds_count', stage=stage),
+        'rows_in': sample('etl_stage_rows_in_total', stage=stage),
+        'rows_out': sample('etl_stage_rows_out_total', stage=stage),
+        'bytes': sample('etl_stage_bytes_total', stage=stage),
+    }
+
+
+def delta(before, after):
+    return {key: after[key] - before[key] for key in before}
+
+
+@pytest.fixture(autouse=True)
+def unconfigured():
+    """Хук и профилирование задаются глобально: каждый тест начинает и заканчивает без них."""
+    metrics.configure()
+    yield
+    metrics.configure()
+
+
+def test_batch_is_counted_per_stage():
+    before = stage_samples('merge')
+
+    with track_stage('merge', rows_in=10) as batch:
+        batch.rows_out, batch.bytes = 7, 2048
+
+    assert delta(before, stage_samples('merge')) == {'count': 1, 'rows_in': 10, 'rows_out': 7, 'bytes': 2048}
+    assert batch.duration > 0
+
+
+def test_failed_batch_is_timed_and_reported():
+    traced = []
+    metrics.configure(batch_hook=traced.append)
+    before = stage_samples('bulk_load')
+
+    with pytest.raises(ConnectionError):
+        with track_stage('bulk_load', rows_in=5):
+            raise ConnectionError('Elasticsearch недоступен')
+
+    assert delta(before, stage_samples('bulk_load')) == {'count': 1, 'rows_in': 5, 'rows_out': 0, 'bytes': 0}
+    assert [(batch.stage, batch.rows_in) for batch in traced] == [('bulk_load', 5)]
+
+
+def test_only_slow_batches_are_traced(caplog):
+    with caplog.at_level(logging.WARNING):
+        metrics.configure(batch_hook=slow_batch_logger(threshold_ms=60_000))
+        with track_stage('transform', rows_in=3):
+            pass
+        metrics.configure(batch_hook=slow_batch_logger(threshold_ms=0))
+        with track_stage('transform', rows_in=3) as batch:
+            batch.rows_out, batch.bytes = 3, 512
+
+    traces = [record.getMessage() for record in caplog.records if record.getMessage().startswith('Медленная пачка: ')]
+    assert len(traces) == 1
+    trace = json.loads(traces[0].removeprefix('Медленная пачка: '))
+    assert trace.pop('duration_ms') >= 0
+    assert trace == {'stage': 'transform', 'rows_in': 3, 'rows_out': 3, 'bytes': 512}
+
+
+def test_selected_stages_are_profiled(tmp_path):
+    metrics.configure(profile_stages=['merge'], profile_dir=str(tmp_path / 'profiles'))
+
+    with track_stage('merge'):
+        sorted(range(1000), reverse=True)
+    with track_stage('transform'):
+        pass
+
+    profiles = list((tmp_path / 'profiles').iterdir())
+    assert [profile.name.split('-')[0] for profile in profiles] == ['merge']
+    assert profiles[0].suffix == '.prof'
+
+
+def test_queue_depth_follows_stream_length(make_queue):
+    queue = make_queue('loader', stream='metrics_queue', entry_size=2)
+    queue.push([RawDocument(str(n), b'{}') for n in range(5)])
+
+    observe_queue(queue)
+
+    assert sample('etl_queue_depth', stream='metrics_queue') == 3
@@ -0,0 +1,85 @@
+"""
+Частичное обновление даёт тот же документ, что и пересборка: скрипты переименования
+пересортировывают персон и жанры так же, как трансформер.
+
+Скрипты painless выполняет только Elasticsearch, поэтому тесты идут против живого кластера
+(ES_TEST_URL, например http://localhost:9200 из docker-compose) во временном индексе.
+"""
+import json
+import os
+import uuid
+from pathlib import Path
+
+import pytest
+from elasticsearch import Elasticsearch
+
+from partial_updates import PartialUpdater
+from serializers import as_dict
+from transformer import FilmRecord
+
+ES_TEST_URL = os.environ.get('ES_TEST_URL')
+pytestmark = pytest.mark.skipif(not ES_TEST_URL, reason='нужен Elasticsearch: задайте ES_TEST_URL')
+
+SCHEMA_PATH = Path(__file__).parent.parent / 'es_schema.json'
+FILM_ID = '3d825f60-9fff-4dfe-b294-1a45fa1e115d'
+ALICE, BOB, CARL = (str(uuid.UUID(int=n)) for n in (1, 2, 3))
+
+
+class FakeEnricher:
+    """Все переименования затрагивают один фильм."""
+
+    def iter_film_ids(self, source_ids, source_type):
+        yield [FILM_ID]
+
+
+@pytest.fixture
+def es():
+    es_conn = Elasticsearch(ES_TEST_URL)
+    schema = json.loads(SCHEMA_PATH.read_text(encoding='utf-8'))
+    index_name = f"test_partial_{uuid.uuid4().hex}"
+    es_conn.indices.create(index=index_name, settings=schema.get('settings'), mappings=schema.get('mappings'))
+    yield es_conn, index_name
+    es_conn.indices.delete(index=index_name)
+
+
+def film(persons, genres):
+    record = FilmRecord(FILM_ID, 'Star Wars', 'A long time ago', 8.6)
+    for role, people in persons.items():
+        record.persons[role].update(people)
+    record.genres.update(genres)
+    return record.document()
+
+
+def index_document(es_conn, index_name, document):
+    es_conn.index(index=index_name, id=document.id, document=as_dict(document), refresh=True)
+
+
+def stored(es_conn, index_name):
+    return es_conn.get(index=index_name, id=FILM_ID)['_source']
+
+
+def test_person_rename_matches_rebuilt_document(es):
+    es_conn, index_name = es
+    before = {'actor': {ALICE: 'Alice', BOB: 'Bob', CARL: 'carl'}, 'writer': {ALICE: 'Alice', CARL: 'carl'}}
+    index_document(es_conn, index_name, film(before, {'Sci-Fi'}))
+
+    # Новые имена меняют порядок: регистр и символ вне BMP сортируются по кодовым точкам
+    renames = {ALICE: ('Alice', 'Zoe'), CARL: ('carl', '\U0001F600 Carl')}
+    updater = PartialUpdater(None, es_conn, index_name, None, FakeEnricher())
+    assert updater.apply_renames('person', renames) == []
+
+    after = {'actor': {ALICE: 'Zoe', BOB: 'Bob', CARL: '\U0001F600 Carl'}, 'writer': {ALICE: 'Zoe', CARL: '\U0001F600 Carl'}}
+    assert stored(es_conn, index_name) == as_dict(film(after, {'Sci-Fi'}))
+
+
+def test_genre_rename_matches_rebuilt_document(es):
+    es_conn, index_name = es
+    persons = {'director': {BOB: 'Bob'}}
+    index_document(es_conn, index_name, film(persons, {'Action', 'Drama', 'comedy'}))
+
+    # Переименование в уже существующее название схлопывает жанры, как при пересборке
+    renames = {ALICE: ('Action', 'Thriller'), BOB: ('Drama', 'comedy')}
+    updater = PartialUpdater(None, es_conn, index_name, None, FakeEnricher())
+    assert updater.apply_renames('genre', renames) == []
+
+    assert stored(es_conn, index_name) == as_dict(film(persons, {'Thriller', 'comedy'}))
@@ -0,0 +1,122 @@
+"""
+Аудит планов: разбор EXPLAIN (FORMAT JSON) с отметкой Seq Scan и сортировок, отчёт до и после
+индексов и создание недостающих индексов. PostgreSQL заменён заглушкой с готовыми ответами.
+"""
+import json
+
+import pytest
+
+from config import settings
+from plan_audit import ETL_INDEXES, PlanAuditor, format_report, shard_index
+
+# Вложенный план: сортировка над соединением, в котором связи читаются последовательным
+# сканированием в цикле из двух проходов
+PLAN = [{
+    'Plan': {
+        'Node Type': 'Sort', 'Total Cost': 120.5, 'Sort Key': ['fw.updated_at', 'fw.id'],
+        'Sort Method': 'external merge', 'Sort Space Used': 2048, 'Sort Space Type': 'Disk',
+        'Shared Hit Blocks': 40, 'Shared Read Blocks': 7,
+        'Plans': [{
+            'Node Type': 'Nested Loop',
+            'Plans': [
+                {'Node Type': 'Index Scan', 'Relation Name': 'film_work'},
+                {'Node Type': 'Seq Scan', 'Relation Name': 'person_film_work', 'Actual Rows': 3,
+                 'Actual Loops': 2, 'Rows Removed by Filter': 500},
+                {'Node Type': 'Incremental Sort', 'Sort Key': ['p.full_name'], 'Sort Method': 'quicksort',
+                 'Sort Space Used': 25, 'Sort Space Type': 'Memory'},
+            ],
+        }],
+    },
+    'Execution Time': 3.25,
+}]
+INDEX_PLAN = [{'Plan': {'Node Type': 'Index Scan', 'Relation Name': 'film_work', 'Total Cost': 8.3}, 'Execution Time': 0.05}]
+
+
+class StubResult:
+    def __init__(self, row):
+        self.row = row
+
+    def fetchone(self):
+        return self.row
+
+
+class StubConnection:
+    """Отдаёт заданный ответ EXPLAIN и состояние индексов {имя: indisvalid}, записывает выполненные команды."""
+
+    def __init__(self, plan=None, indexes=None):
+        self.plan = plan
+        self.indexes = indexes or {}
+        self.executed = []
+
+    def cursor(self):
+        return StubCursor(self.plan)
+
+    def execute(self, query, params=None):
+        if params is not None:
+            _, name = params
+            return StubResult((self.indexes[name],) if name in self.indexes else None)
+        self.executed.append(repr(query))
+        return StubResult(None)
+
+
+class StubCursor:
+    def __init__(self, plan):
+        self.plan = plan
+        self.query = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params):
+        self.query = query
+
+    def fetchone(self):
+        return (self.plan,)
+
+
+@pytest.mark.parametrize('as_text', [False, True])
+def test_explain_flags_seq_scans_and_sorts(as_text):
+    plan = json.dumps(PLAN) if as_text else PLAN
+    auditor = PlanAuditor(StubConnection(plan), settings.producer_configs, 100)
+
+    report = auditor.explain('producer.extract:film_work', 'SELECT 1', ())
+
+    assert (report.total_cost, report.execution_ms, report.shared_hit, report.shared_read) == (120.5, 3.25, 40, 7)
+    assert report.seq_scans == ['person_film_work: строк 6, отброшено фильтром 1000']
+    assert report.sorts == ['Sort по fw.updated_at, fw.id: external merge, 2048 kB Disk',
+                            'Incremental Sort по p.full_name: quicksort, 25 kB Memory']
+
+
+def test_report_compares_plans_before_and_after_indexes():
+    before = PlanAuditor(StubConnection(PLAN), settings.producer_configs, 100).explain('producer.extract:film_work', '', ())
+    after = PlanAuditor(StubConnection(INDEX_PLAN), settings.producer_configs, 100).explain('producer.extract:film_work', '', ())
+
+    header, line, *flagged = format_report([before], [after])
+
+    assert 'cost after' in header
+    assert line.split() == ['producer.extract:film_work', '120.5', '3.25', '40/7', '8.3', '0.05']
+    assert flagged == ['    до: Seq Scan person_film_work: строк 6, отброшено фильтром 1000',
+                       '    до: Sort по fw.updated_at, fw.id: external merge, 2048 kB Disk',
+                       '    до: Incremental Sort по p.full_name: quicksort, 25 kB Memory']
+
+
+def test_missing_indexes_are_created_and_invalid_ones_rebuilt():
+    valid, invalid = ETL_INDEXES[0], ETL_INDEXES[1]
+    conn = StubConnection(indexes={valid.name: True, invalid.name: False})
+    auditor = PlanAuditor(conn, settings.producer_configs, 100, shard_count=4)
+
+    assert [spec.name for spec in auditor.missing_indexes()] == [spec.name for spec in ETL_INDEXES[1:]] + [shard_index(4).name]
+
+    created = auditor.create_indexes()
+
+    assert created == [spec.name for spec in ETL_INDEXES[1:]] + [shard_index(4).name]
+    assert 'DROP INDEX CONCURRENTLY' in conn.executed[0] and invalid.name in conn.executed[0]
+    assert 'CREATE INDEX CONCURRENTLY' in conn.executed[1] and invalid.name in conn.executed[1]
+    # Индекс шарда строится по выражению номера шарда перед курсором
+    assert shard_index(4).expression in conn.executed[-2]
+    assert conn.executed[-1].startswith("Composed([SQL('ANALYZE ')")
+    assert all(table.split('.')[1] in conn.executed[-1]
+               for table in {'content.film_work', 'content.person', 'content.genre', 'content.person_film_work'})
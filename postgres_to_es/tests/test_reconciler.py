@@ -0,0 +1,142 @@
+"""
+Сверка слиянием двух упорядоченных потоков: PostgreSQL и индекс заменены заглушками в памяти,
+загрузка и удаление пишут в тот же индекс.
+"""
+import pytest
+
+import reconciler as reconciler_module
+from loader import LoadResult
+from reconciler import Reconciler, checksum
+from serializers import as_dict
+from transformer import PostgresTransformer, encode_film
+
+VERSION = 42
+
+
+def film_id(n):
+    return f'{n:08d}-0000-0000-0000-000000000000'
+
+
+def film_row(fw_id, title):
+    return fw_id, title, None, None, {}, []
+
+
+def film_doc(fw_id, title):
+    return as_dict(encode_film(fw_id, title, None, None, [], [], [], []))
+
+
+class StubMerger:
+    """
+    PostgreSQL в памяти. Поток сверки видит films, а перечитывание перед исправлением —
+    films вместе с added_later: фильмы, появившиеся после того, как поток прошёл их id.
+    """
+
+    def __init__(self, films, added_later=None):
+        self.films = films
+        self.current = films | (added_later or {})
+        self.pg_conn = self
+
+    def fetch_after(self, after_id, limit):
+        return [film_row(fw_id, self.films[fw_id]) for fw_id in sorted(self.films) if fw_id > after_id][:limit]
+
+    def fetch_aggregated_data(self, film_work_ids):
+        return [film_row(fw_id, self.current[fw_id]) for fw_id in film_work_ids if fw_id in self.current]
+
+    def cursor(self):
+        return StubCursor(self.current)
+
+
+class StubCursor:
+    def __init__(self, films):
+        self.films = films
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params):
+        self.rows = [(fw_id,) for fw_id in params[0] if fw_id in self.films]
+
+    def fetchall(self):
+        return self.rows
+
+
+class StubIndex:
+    """Индекс в памяти: {id: документ}, страницы search_after по id."""
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.versions = {}
+
+    def search(self, index, size, query, sort, search_after, track_total_hits):
+        ids = [doc_id for doc_id in sorted(self.docs) if search_after is None or doc_id > search_after[0]][:size]
+        return {'hits': {'hits': [{'_id': doc_id, '_source': self.docs[doc_id], 'sort': [doc_id]} for doc_id in ids]}}
+
+    def load_to_es(self, records, versions=None):
+        for record in records:
+            self.docs[record.id] = as_dict(record)
+            self.versions[record.id] = versions[record.id] if versions else None
+        return LoadResult(success=len(records))
+
+    def streaming_bulk(self, client, actions, **kwargs):
+        for action in actions:
+            self.docs.pop(action['_id'])
+            yield True, {'delete': {'_id': action['_id'], 'status': 200}}
+
+
+@pytest.fixture
+def index(monkeypatch):
+    index = StubIndex({
+        film_id(2): film_doc(film_id(2), 'Star Wars'),
+        film_id(3): film_doc(film_id(3), 'Star Wars: Old Title'),
+        film_id(4): film_doc(film_id(4), 'Deleted Film'),
+        film_id(5): film_doc(film_id(5), 'Restored Film'),
+    })
+    monkeypatch.setattr(reconciler_module.helpers, 'streaming_bulk', index.streaming_bulk)
+    return index
+
+
+@pytest.fixture
+def merger():
+    films = {film_id(n): title for n, title in [(1, 'New Hope'), (2, 'Star Wars'), (3, 'Star Wars: New Title'), (6, 'Return')]}
+    # Фильм 5 вернулся в PostgreSQL, пока сверка шла дальше: его документ удалять нельзя
+    return StubMerger(films, added_later={film_id(5): 'Restored Film'})
+
+
+def make_reconciler(index, merger, chunk_size, dry_run=False):
+    return Reconciler(index, 'movies', merger, PostgresTransformer(None), index, chunk_size=chunk_size,
+                      dry_run=dry_run, clock=lambda: VERSION)
+
+
+@pytest.mark.parametrize('chunk_size', [2, 100])
+def test_discrepancies_are_found_and_repaired(index, merger, chunk_size):
+    result = make_reconciler(index, merger, chunk_size).run()
+
+    assert (result.compared, result.missing, result.extra, result.mismatched) == (6, 2, 2, 1)
+    assert (result.reindexed, result.deleted) == (3, 1)
+    assert sorted(index.docs) == [film_id(n) for n in (1, 2, 3, 5, 6)]
+    assert index.docs[film_id(3)]['title'] == 'Star Wars: New Title'
+    # Исправления загружены с внешней версией, совпавшие документы не перезаписаны
+    assert index.versions == {film_id(n): VERSION for n in (1, 3, 6)}
+
+
+def test_dry_run_only_counts(index, merger):
+    before = dict(index.docs)
+    result = make_reconciler(index, merger, 100, dry_run=True).run()
+
+    assert (result.missing, result.extra, result.mismatched) == (2, 2, 1)
+    assert (result.reindexed, result.deleted) == (0, 0)
+    assert index.docs == before
+
+
+def test_list_order_drift_is_a_mismatch():
+    actors = [{'id': 'a', 'name': 'Alice'}, {'id': 'b', 'name': 'Bob'}]
+    doc = as_dict(encode_film(film_id(1), 'New Hope', None, None, ['Drama', 'Sci-Fi'], actors, [], []))
+    drifted = doc | {'actors': actors[::-1], 'actors_names': ['Bob', 'Alice']}
+
+    assert checksum(doc) == checksum(encode_film(film_id(1), 'New Hope', None, None, ['Drama', 'Sci-Fi'], actors, [], []))
+    assert checksum(drifted) != checksum(doc)
+    assert checksum(doc | {'genres': ['Sci-Fi', 'Drama']}) != checksum(doc)
@@ -0,0 +1,160 @@
+"""
+Полная переиндексация: весь каталог загружается в одном снимке REPEATABLE READ с внешней
+версией момента снимка, а курсоры источников выставляются на high-water marks снимка.
+PostgreSQL заменён заглушкой, индекс — conftest.FakeIndex, состояния — fakeredis.
+"""
+from datetime import datetime, timezone
+
+import orjson
+import pytest
+from elasticsearch import Elasticsearch
+from psycopg import IsolationLevel
+
+from config import settings
+from loader import ElasticsearchLoader
+from reindex import FullReindexer
+from serializers import RawDocument
+from state import FanoutCheckpoint, RedisStorage, State
+from transformer import PostgresTransformer
+
+SNAPSHOT_VERSION = 1000
+FILM_WORK, PERSON, GENRE = settings.producer_configs
+MARKS = {
+    FILM_WORK.table: (datetime(2024, 1, 2, tzinfo=timezone.utc), 'f0000003-0000-0000-0000-000000000000'),
+    PERSON.table: (datetime(2024, 1, 1, tzinfo=timezone.utc), 'a0000001-0000-0000-0000-000000000000'),
+    # В таблице жанров нет строк
+    GENRE.table: None,
+}
+
+
+def film_id(n):
+    return f'{n:08d}-0000-0000-0000-000000000000'
+
+
+class StubConnection:
+    """Соединение PostgreSQL: записывает, в каком режиме транзакции шли запросы."""
+
+    def __init__(self):
+        self.isolation_level = None
+        self.read_only = None
+        self.in_transaction = False
+        self.seen = []
+
+    def transaction(self):
+        return StubTransaction(self)
+
+    def cursor(self):
+        return StubCursor(self)
+
+    def observe(self, what):
+        self.seen.append((what, self.in_transaction, self.isolation_level, self.read_only))
+
+
+class StubTransaction:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.in_transaction = True
+
+    def __exit__(self, *exc):
+        self.conn.in_transaction = False
+        return False
+
+
+class StubCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.row = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query):
+        self.conn.observe('marks')
+        self.row = next(mark for table, mark in MARKS.items() if f"FROM {table}\n" in query)
+
+    def fetchone(self):
+        return self.row
+
+
+class StubMerger:
+    """Каталог из пяти фильмов, отдаваемый серверным курсором пачками по два."""
+
+    def __init__(self, conn, fail_after=None):
+        self.conn = conn
+        self.fail_after = fail_after
+
+    def iter_all_aggregated(self):
+        for start in range(1, 6, 2):
+            if self.fail_after is not None and start > self.fail_after:
+                raise RuntimeError('соединение с PostgreSQL потеряно')
+            self.conn.observe('films')
+            yield [(film_id(n), f'Film {n}', None, None, {}, []) for n in range(start, min(start + 2, 6))]
+
+
+def make_reindexer(redis_connection, conn, merger):
+    return FullReindexer(
+        conn, merger, PostgresTransformer(None), ElasticsearchLoader(Elasticsearch('http://localhost:9200'), 'movies'),
+        settings.producer_configs, lambda state_key: RedisStorage(redis_connection, state_key),
+        clock=lambda: SNAPSHOT_VERSION,
+    )
+
+
+def test_catalog_is_loaded_from_one_snapshot(index, redis_connection):
+    conn = StubConnection()
+
+    marks = make_reindexer(redis_connection, conn, StubMerger(conn)).run()
+
+    assert sorted(index.docs) == [film_id(n) for n in range(1, 6)]
+    assert {version for version, _ in index.docs.values()} == {SNAPSHOT_VERSION}
+    # Метки и фильмы читаются в одной транзакции REPEATABLE READ только для чтения
+    assert [what for what, *_ in conn.seen] == ['marks'] * 3 + ['films'] * 3
+    assert {tuple(mode) for _, *mode in conn.seen} == {(True, IsolationLevel.REPEATABLE_READ, True)}
+    assert (conn.isolation_level, conn.read_only) == (None, None)
+    assert marks == {config.state_key: MARKS[config.table] for config in settings.producer_configs}
+
+
+def test_queue_message_older_than_snapshot_does_not_overwrite(index, redis_connection):
+    conn = StubConnection()
+    make_reindexer(redis_connection, conn, StubMerger(conn)).run()
+
+    stale = RawDocument(film_id(1), orjson.dumps({'id': film_id(1), 'title': 'Old'}))
+    result = ElasticsearchLoader(Elasticsearch('http://localhost:9200'), 'movies').load_to_es(
+        [stale], {film_id(1): SNAPSHOT_VERSION - 1})
+
+    assert result.outdated == [film_id(1)]
+    assert index.source(film_id(1))['title'] == 'Film 1'
+
+
+def test_failed_reindex_restores_connection_mode(index, redis_connection):
+    conn = StubConnection()
+
+    with pytest.raises(RuntimeError):
+        make_reindexer(redis_connection, conn, StubMerger(conn, fail_after=2)).run()
+
+    assert (conn.isolation_level, conn.read_only, conn.in_transaction) == (None, None, False)
+
+
+def test_states_are_moved_to_high_water_marks(index, redis_connection):
+    conn = StubConnection()
+    reindexer = make_reindexer(redis_connection, conn, StubMerger(conn))
+    person_state = State(RedisStorage(redis_connection, PERSON.state_key))
+    # Незавершённое разворачивание страницы персон до переиндексации
+    FanoutCheckpoint(person_state, ['p']).save(film_id(1))
+    genre_state = State(RedisStorage(redis_connection, GENRE.state_key))
+    genre_state.set_states({'last_id': 'untouched'})
+
+    reindexer.commit_states(reindexer.run())
+
+    film_state = State(RedisStorage(redis_connection, FILM_WORK.state_key))
+    assert film_state.get_state('last_updated_at') == '2024-01-02 00:00:00+00:00'
+    assert film_state.get_state('last_id') == 'f0000003-0000-0000-0000-000000000000'
+    person_state = State(RedisStorage(redis_connection, PERSON.state_key))
+    assert person_state.get_state('last_id') == 'a0000001-0000-0000-0000-000000000000'
+    assert FanoutCheckpoint(person_state, ['p']).resume_after() is None
+    # Для пустой таблицы high-water mark нет, и её курсор не меняется
+    assert State(RedisStorage(redis_connection, GENRE.state_key)).get_state('last_id') == 'untouched'
@@ -0,0 +1,131 @@
+"""
+Переименование и очередь документов: документ предыдущего цикла, загруженный после
+переименования, не возвращает старое имя.
+
+Очередь, множество грязных фильмов и состояние работают на fakeredis, источники —
+заглушки, а индекс в памяти (conftest.FakeIndex) повторяет версии Elasticsearch.
+"""
+import orjson
+from elasticsearch import Elasticsearch
+
+from dirty_set import DirtyFilmSet
+from loader import ElasticsearchLoader
+from main import load_data_to_es, process_sources
+from partial_updates import SourceChanges
+from producer import PostgresProducer
+from serializers import RawDocument
+from state import RedisStorage, State
+
+FILM_ID = '3d825f60-9fff-4dfe-b294-1a45fa1e115d'
+PERSON_ID = '6a3c1a29-5bd0-4d19-8a6f-2a4bd0e9a3c5'
+PERSON_CONFIG = {'source_type': 'person', 'table': 'content.person', 'state_key': 'person_producer', 'enrich': True}
+
+
+class Catalog:
+    """PostgreSQL из одного фильма с одним актёром."""
+
+    def __init__(self):
+        self.name = 'Alice'
+
+    def document(self):
+        return RawDocument(FILM_ID, orjson.dumps({'id': FILM_ID, 'title': 'Star Wars', 'actors_names': [self.name]}))
+
+
+class FakeProducer(PostgresProducer):
+    def __init__(self, state, rows):
+        super().__init__(None, state, PERSON_CONFIG['table'])
+        self.rows = rows
+
+    def extract(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+
+class FakeEnricher:
+    def iter_film_ids(self, source_ids, source_type, after_id=None):
+        if after_id is None:
+            yield [FILM_ID]
+
+
+class FakeMerger:
+    def fetch(self, film_work_ids, mode='aggregated'):
+        return list(film_work_ids)
+
+
+class FakeTransformer:
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def transform(self, rows, mode='aggregated'):
+        return [self.catalog.document() for _ in rows]
+
+
+class FakePartialUpdater:
+    """Переименование актёра: update применяется к индексу в памяти."""
+
+    def __init__(self, index):
+        self.index = index
+        self.applied = []
+
+    def supports(self, source_type):
+        return source_type == 'person'
+
+    def classify(self, source_type, source_ids):
+        return SourceChanges([], {PERSON_ID: ('Alice', 'Zoe')}, {PERSON_ID: '["Zoe", "relations"]'})
+
+    def apply_renames(self, source_type, renames):
+        self.applied.append(renames)
+        self.index.update(FILM_ID, actors_names=['Zoe'])
+        return []
+
+    def commit(self, source_type, snapshots):
+        pass
+
+
+def run_cycle(redis_connection, catalog, doc_queue, partial):
+    """Цикл синхронизации источника person со страницей из одной переименованной персоны."""
+    es_loader = ElasticsearchLoader(Elasticsearch('http://localhost:9200'), 'movies')
+    producer = FakeProducer(State(RedisStorage(redis_connection, PERSON_CONFIG['state_key'])),
+                            [(PERSON_ID, '2024-01-02 00:00:00+00:00')])
+    process_sources([PERSON_CONFIG], {'person': producer}, FakeEnricher(), FakeMerger(), FakeTransformer(catalog),
+                    doc_queue, DirtyFilmSet(redis_connection), on_chunk=lambda: load_data_to_es(es_loader, doc_queue),
+                    partial=partial)
+    return es_loader
+
+
+def test_stale_queued_document_does_not_revert_rename(redis_connection, index, make_queue):
+    catalog = Catalog()
+    loader_queue = make_queue('alive')
+    loader_queue.push([catalog.document()])
+    es_loader = ElasticsearchLoader(Elasticsearch('http://localhost:9200'), 'movies')
+    load_data_to_es(es_loader, loader_queue)
+
+    # Документ предыдущего цикла забрал загрузчик, который упал, не подтвердив его
+    loader_queue.push([catalog.document()])
+    assert len(make_queue('crashed').read(10)) == 1
+
+    catalog.name = 'Zoe'
+    partial = FakePartialUpdater(index)
+    run_cycle(redis_connection, catalog, loader_queue, partial)
+    assert partial.applied == []
+    assert index.source(FILM_ID)['actors_names'] == ['Zoe']
+
+    # Зависшее сообщение доставляется повторно уже после переименования
+    loader_queue.claim_idle_ms = 0
+    load_data_to_es(es_loader, loader_queue)
+    assert index.source(FILM_ID)['actors_names'] == ['Zoe']
+    assert loader_queue.length() == 0
+
+
+def test_rename_is_applied_in_place_when_queue_is_empty(redis_connection, index, make_queue):
+    catalog = Catalog()
+    doc_queue = make_queue('alive')
+    doc_queue.push([catalog.document()])
+    load_data_to_es(ElasticsearchLoader(Elasticsearch('http://localhost:9200'), 'movies'), doc_queue)
+
+    catalog.name = 'Zoe'
+    partial = FakePartialUpdater(index)
+    run_cycle(redis_connection, catalog, doc_queue, partial)
+    assert partial.applied == [{PERSON_ID: ('Alice', 'Zoe')}]
+    assert index.source(FILM_ID)['actors_names'] == ['Zoe']
+    assert doc_queue.length() == 0
@@ -0,0 +1,98 @@
+"""Адаптивное расписание: выкачивание без пауз, рост паузы при простое и отчёты о догоняющей выгрузке."""
+import logging
+
+import pytest
+from pydantic import ValidationError
+
+from config import AppSettings
+from scheduler import AdaptiveScheduler
+
+BATCH_SIZE = 100
+
+
+@pytest.fixture
+def scheduler():
+    return AdaptiveScheduler(['film_work', 'person'], batch_size=BATCH_SIZE, sleep_time=1, max_sleep_time=8,
+                             backoff_factor=2, report_every=3)
+
+
+class FakeProducer:
+    def estimate_lag(self):
+        return 120.0
+
+    def count_remaining(self):
+        return 500
+
+
+def test_full_batch_is_drained_without_pause(scheduler):
+    scheduler.record('film_work', BATCH_SIZE, now=10)
+    scheduler.record('person', 5, now=10)
+
+    assert scheduler.has_backlog()
+    assert scheduler.due(now=10) == ['film_work']
+    assert scheduler.next_sleep(now=10) == 0.0
+
+
+def test_caught_up_source_waits_sleep_time(scheduler):
+    scheduler.record('film_work', BATCH_SIZE, now=10)
+    scheduler.record('film_work', 5, now=11)
+
+    assert not scheduler.has_backlog()
+    assert scheduler.sources['film_work'].catchup_started is None
+    assert 'film_work' not in scheduler.due(now=11.5)
+    assert 'film_work' in scheduler.due(now=12)
+
+
+def test_idle_source_backs_off_up_to_max(scheduler):
+    intervals = []
+    for now in range(5):
+        scheduler.record('person', 0, now=now)
+        intervals.append(scheduler.sources['person'].interval)
+    assert intervals == [2, 4, 8, 8, 8]
+
+    # Новые данные возвращают обычную паузу
+    scheduler.record('person', 1, now=5)
+    assert scheduler.sources['person'].interval == 1
+    assert scheduler.sources['person'].next_run == 6
+
+
+def test_next_sleep_waits_for_nearest_source(scheduler):
+    scheduler.record('film_work', 0, now=0)
+    scheduler.record('person', 0, now=0)
+    scheduler.record('person', 0, now=1)
+
+    # film_work ждёт до 2, person — до 1 + 4
+    assert scheduler.next_sleep(now=1) == 1.0
+    assert scheduler.next_sleep(now=3) == 0.0
+
+
+def test_progress_is_reported_every_n_full_batches(scheduler):
+    reported = []
+    for batch in range(1, 8):
+        scheduler.record('film_work', BATCH_SIZE, now=batch)
+        reported.append(scheduler.should_report('film_work'))
+    assert reported == [True, False, False, True, False, False, True]
+
+    scheduler.record('film_work', 5, now=8)
+    assert not scheduler.should_report('film_work')
+
+
+def test_report_progress_logs_rate_and_remaining(scheduler, caplog):
+    scheduler.record('film_work', BATCH_SIZE, now=0)
+    scheduler.record('film_work', BATCH_SIZE, now=1)
+
+    with caplog.at_level(logging.INFO):
+        scheduler.report_progress('film_work', FakeProducer(), now=2)
+    assert scheduler.sources['film_work'].remaining == 500
+    assert "обработано 200, осталось 500, скорость 100 зап./сек., до окончания 5 сек." in caplog.text
+
+    # Догнанный источник забывает остаток
+    scheduler.record('film_work', 0, now=3)
+    assert scheduler.sources['film_work'].remaining is None
+
+
+@pytest.mark.parametrize('value', ['0', '-1'])
+def test_report_every_must_be_positive(monkeypatch, value):
+    monkeypatch.setenv('CATCHUP_REPORT_EVERY', value)
+    with pytest.raises(ValidationError):
+        AppSettings()
@@ -0,0 +1,125 @@
+"""
+Аренды шардов: несколько координаторов на общем fakeredis, каждый со своим потоком пульса,
+как у отдельных процессов ETL. Упавший процесс перестаёт продлевать аренды, не отдавая их.
+"""
+import time
+
+import fakeredis
+import pytest
+
+from plan_audit import shard_index
+from sharding import Shard, ShardCoordinator
+
+SHARD_COUNT = 6
+LEASE_TTL = 0.6
+
+
+@pytest.fixture
+def workers(server):
+    started = []
+
+    def start(count):
+        for _ in range(count):
+            worker = ShardCoordinator(fakeredis.FakeRedis(server=server), SHARD_COUNT,
+                                      worker_id=f"worker-{len(started)}", lease_ttl=LEASE_TTL)
+            worker.start()
+            started.append(worker)
+        return started[-count:]
+
+    yield start
+    for worker in started:
+        if not worker._stopped.is_set():
+            worker.stop()
+
+
+def crash(worker: ShardCoordinator) -> None:
+    """Останавливает пульс без освобождения аренд, как при падении процесса."""
+    worker._stopped.set()
+    worker._thread.join()
+
+
+def rebalance(workers, rounds=3):
+    assignment = {}
+    for _ in range(rounds):
+        assignment = {worker.worker_id: worker.rebalance() for worker in workers}
+    return assignment
+
+
+def owned_indexes(assignment):
+    return sorted(shard.index for shards in assignment.values() for shard in shards)
+
+
+def test_shards_are_split_between_workers(workers):
+    assignment = rebalance(workers(3))
+
+    assert owned_indexes(assignment) == list(range(SHARD_COUNT))
+    assert all(len(shards) == 2 for shards in assignment.values())
+    assert all(shard.count == SHARD_COUNT for shards in assignment.values() for shard in shards)
+
+
+def test_new_worker_takes_its_share(workers):
+    first, = workers(1)
+    assert len(first.rebalance()) == SHARD_COUNT
+    second, = workers(1)
+
+    # Лишние шарды первый процесс отдаёт, второй подбирает их на следующем шаге
+    assignment = rebalance([first, second])
+    assert owned_indexes(assignment) == list(range(SHARD_COUNT))
+    assert [len(shards) for shards in assignment.values()] == [3, 3]
+
+
+def test_dead_worker_shards_are_reclaimed_within_ttl(workers):
+    alive_a, alive_b, dead = workers(3)
+    rebalance([alive_a, alive_b, dead])
+    dead_shards = {shard.index for shard in dead.rebalance()}
+    assert dead_shards
+
+    crash(dead)
+    crashed_at = time.monotonic()
+    survivors = [alive_a, alive_b]
+    while True:
+        assignment = {worker.worker_id: worker.rebalance() for worker in survivors}
+        if owned_indexes(assignment) == list(range(SHARD_COUNT)):
+            break
+        assert time.monotonic() - crashed_at < 3 * LEASE_TTL, "шарды упавшего процесса не подобраны"
+        time.sleep(LEASE_TTL / 10)
+
+    # Раньше TTL аренды шарды упавшего процесса никто не забирает
+    assert time.monotonic() - crashed_at >= LEASE_TTL * 0.9
+    assert [len(shards) for shards in assignment.values()] == [3, 3]
+
+
+def test_leases_outlive_ttl_while_heartbeat_runs(workers):
+    first, second = workers(2)
+    before = rebalance([first, second])
+
+    time.sleep(2 * LEASE_TTL)
+    assert rebalance([first, second], rounds=1) == before
+
+
+def test_stop_releases_shards_immediately(workers):
+    leaving, staying = workers(2)
+    rebalance([leaving, staying])
+
+    leaving.stop()
+    assert staying.rebalance() == [Shard(index, SHARD_COUNT) for index in range(SHARD_COUNT)]
+
+
+def test_lost_lease_is_dropped_on_heartbeat(server, workers):
+    worker, = workers(1)
+    index = worker.rebalance()[0].index
+
+    # Аренда истекла, пока процесс стоял, и её взял другой процесс
+    fakeredis.FakeRedis(server=server).set(worker._lease_key(index), 'other-worker')
+    worker._beat()
+
+    assert index not in {shard.index for shard in worker.rebalance()}
+
+
+def test_shard_predicate_matches_index_expression():
+    spec = shard_index(SHARD_COUNT)
+    predicate = Shard(2, SHARD_COUNT).predicate('id')
+
+    # После подстановки параметров '%%' становится '%', и выражение совпадает с индексным
+    assert predicate.replace('%%', '%') == f"{spec.expression} = 2"
+    assert spec.describe() == f"content.film_work (({spec.expression}), updated_at, id)"
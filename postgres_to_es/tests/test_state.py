@@ -0,0 +1,121 @@
+"""
+Хранилища состояния: перевод старого формата в hash, запись в транзакции с очередью и JSON-файл.
+Отметка разворачивания страницы источника в фильмы.
+"""
+import json
+import logging
+
+import pytest
+
+from state import FanoutCheckpoint, JsonFileStorage, RedisStorage, State
+
+PERSON_IDS = ['person-1', 'person-2']
+CURSOR = {'last_updated_at': '2024-01-02 00:00:00+00:00', 'last_id': '3d825f60-9fff-4dfe-b294-1a45fa1e115d'}
+
+
+def test_string_state_is_migrated_to_hash(redis_connection):
+    redis_connection.set('film_work_producer', json.dumps(CURSOR))
+
+    assert RedisStorage(redis_connection, 'film_work_producer').retrieve_state() == CURSOR
+    assert redis_connection.type('film_work_producer') == 'hash'
+    assert RedisStorage(redis_connection, 'film_work_producer').retrieve_state() == CURSOR
+
+
+def test_corrupt_string_state_is_reported(redis_connection, caplog):
+    redis_connection.set('film_work_producer', '{"last_id": ')
+
+    with caplog.at_level(logging.WARNING):
+        assert RedisStorage(redis_connection, 'film_work_producer').retrieve_state() == {}
+    assert "повреждено" in caplog.text
+
+
+def test_staged_state_is_written_with_the_transaction(redis_connection):
+    state = State(RedisStorage(redis_connection, 'film_work_producer'))
+
+    with redis_connection.pipeline(transaction=True) as pipe:
+        pipe.sadd('etl:dirty_films', 'film')
+        applied = state.stage(pipe, CURSOR)
+        # До EXEC ни хранилище, ни состояние в памяти не меняются
+        assert redis_connection.hgetall('film_work_producer') == {}
+        assert state.get_state('last_id') is None
+        pipe.execute()
+    applied()
+
+    assert redis_connection.smembers('etl:dirty_films') == {'film'}
+    assert State(RedisStorage(redis_connection, 'film_work_producer')).get_state('last_id') == CURSOR['last_id']
+    assert state.get_state('last_id') == CURSOR['last_id']
+
+
+def test_discarded_transaction_leaves_state_unchanged(redis_connection):
+    state = State(RedisStorage(redis_connection, 'film_work_producer'))
+
+    with redis_connection.pipeline(transaction=True) as pipe:
+        pipe.sadd('etl:dirty_films', 'film')
+        state.stage(pipe, CURSOR)
+        # Процесс упал до EXEC
+
+    assert redis_connection.exists('etl:dirty_films', 'film_work_producer') == 0
+    assert state.get_state('last_id') is None
+
+
+def test_file_storage_is_saved_after_the_transaction(redis_connection, tmp_path):
+    storage = JsonFileStorage(tmp_path / 'film_work_producer.json')
+    state = State(storage)
+
+    with redis_connection.pipeline(transaction=True) as pipe:
+        pipe.sadd('etl:dirty_films', 'film')
+        applied = state.stage(pipe, CURSOR)
+        pipe.execute()
+    assert storage.retrieve_state() == {}
+    applied()
+
+    assert storage.retrieve_state() == CURSOR
+
+
+def test_file_storage_round_trip(tmp_path):
+    storage = JsonFileStorage(tmp_path / 'state' / 'film_work_producer.json')
+    assert storage.retrieve_state() == {}
+
+    storage.save_state(CURSOR | {'fanout': None})
+    storage.save_state(CURSOR)
+
+    assert JsonFileStorage(storage.file_path).retrieve_state() == CURSOR
+    assert [path.name for path in storage.file_path.parent.iterdir()] == ['film_work_producer.json']
+
+
+def test_corrupt_file_is_reported(tmp_path, caplog):
+    path = tmp_path / 'film_work_producer.json'
+    path.write_text('{"last_id": ', encoding='utf-8')
+
+    with caplog.at_level(logging.WARNING):
+        assert JsonFileStorage(path).retrieve_state() == {}
+    assert "повреждён" in caplog.text
+
+
+def test_fanout_resumes_after_last_staged_film(redis_connection):
+    state = State(RedisStorage(redis_connection, 'person_producer'))
+    checkpoint = FanoutCheckpoint(state, PERSON_IDS)
+    assert checkpoint.resume_after() is None
+
+    with redis_connection.pipeline(transaction=True) as pipe:
+        pipe.sadd('etl:dirty_films', 'film-1', 'film-2')
+        applied = checkpoint.stage(pipe, 'film-2')
+        pipe.execute()
+    applied()
+    assert checkpoint.resume_after() == 'film-2'
+
+    # После перезапуска та же страница продолжается с отметки, а другая начинается заново
+    restarted = State(RedisStorage(redis_connection, 'person_producer'))
+    assert FanoutCheckpoint(restarted, PERSON_IDS).resume_after() == 'film-2'
+    assert FanoutCheckpoint(restarted, PERSON_IDS + ['person-3']).resume_after() is None
+
+
+def test_fanout_checkpoint_is_cleared_with_the_cursor(redis_connection):
+    state = State(RedisStorage(redis_connection, 'person_producer'))
+    FanoutCheckpoint(state, PERSON_IDS).save('film-2')
+
+    state.set_states(CURSOR | FanoutCheckpoint.cleared())
+
+    restarted = State(RedisStorage(redis_connection, 'person_producer'))
+    assert FanoutCheckpoint(restarted, PERSON_IDS).resume_after() is None
+    assert restarted.get_state('last_id') == CURSOR['last_id']
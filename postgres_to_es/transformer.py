@@ -1,57 +1,107 @@
+"""
+Преобразование строк PostgresMerger в документы Elasticsearch.
+
+Строки приходят кортежами и распаковываются по позициям колонок, без словаря на строку.
+Плоские строки группируются по фильмам за один проход в компактные записи FilmRecord.
+Готовый документ сразу кодируется в JSON и идёт дальше как RawDocument, поэтому очередь
+и загрузчик его повторно не сериализуют.
+
+Порядок детерминирован: персоны внутри роли идут по (имя, id), жанры — по имени.
+Одни и те же данные всегда дают одни и те же байты, на это опираются отпечатки документов.
+"""
+from operator import itemgetter
+from typing import Dict, List
+
 from enricher import PostgresEnricher
+from serializers import RawDocument, encode_document
+
+# Ключ сортировки пар (id, имя): сначала имя, затем id — как ORDER BY full_name, id в агрегированном запросе
+_by_name = itemgetter(1, 0)
+
+
+class FilmRecord:
+    """Фильм, собираемый из плоских строк: персоны каждой роли — {id: имя}, жанры — множество имён."""
+    __slots__ = ('id', 'title', 'description', 'rating', 'genres', 'persons')
+
+    def __init__(self, fw_id, title, description, rating):
+        self.id = fw_id
+        self.title = title
+        self.description = description
+        self.rating = rating
+        self.genres = set()
+        self.persons = {'actor': {}, 'writer': {}, 'director': {}}
+
+    def document(self) -> RawDocument:
+        persons = self.persons
+        actors = sorted(persons['actor'].items(), key=_by_name)
+        writers = sorted(persons['writer'].items(), key=_by_name)
+        directors = sorted(persons['director'].items(), key=_by_name)
+        return encode_film(
+            self.id, self.title, self.description, self.rating, sorted(self.genres),
+            [{'id': person_id, 'name': name} for person_id, name in actors],
+            [{'id': person_id, 'name': name} for person_id, name in writers],
+            [{'id': person_id, 'name': name} for person_id, name in directors],
+        )
+
+
+def encode_film(fw_id, title, description, rating, genres: list,
+                actors: List[Dict], writers: List[Dict], directors: List[Dict]) -> RawDocument:
+    """Собирает документ фильма и кодирует его в JSON. id персон могут быть UUID — кодировщик пишет их строками."""
+    doc_id = str(fw_id)
+    return RawDocument(doc_id, encode_document({
+        'id': doc_id,
+        'title': title,
+        'description': description,
+        'imdb_rating': rating,
+        'genres': genres,
+        'actors': actors,
+        'writers': writers,
+        'directors': directors,
+        'actors_names': [person['name'] for person in actors],
+        'writers_names': [person['name'] for person in writers],
+        'directors_names': [person['name'] for person in directors],
+    }))
 
 
 class PostgresTransformer:
     def __init__(self, pg_enricher: PostgresEnricher):
         self.pg_enricher = pg_enricher
 
-    def transform_data(self, rows):
-        if not rows:
-            return []
-            
-        movies_data = {}
-        for row in rows:
-            fw_id = str(row['fw_id'])
-            if fw_id not in movies_data:
-                movies_data[fw_id] = {
-                    'id': fw_id,
-                    'title': row['title'],
-                    'description': row['description'],
-                    'imdb_rating': row['rating'],
-                    '_genres': set(),
-                    '_actors': set(),
-                    '_writers': set(),
-                    '_directors': set(),
-                }
-            
-            if row['genre_id']:
-                movies_data[fw_id]['_genres'].add(row['genre_name'])
-
-            if row['person_id']:
-                person_tuple = (str(row['person_id']), row['full_name'])
-                role = row['role']
-                if role == 'actor':
-                    movies_data[fw_id]['_actors'].add(person_tuple)
-                elif role == 'writer':
-                    movies_data[fw_id]['_writers'].add(person_tuple)
-                elif role == 'director':
-                    movies_data[fw_id]['_directors'].add(person_tuple)
-
-        final_list = []
-        for movie in movies_data.values():
-            movie['genres'] = list(movie['_genres'])
-            movie['actors'] = [{'id': pid, 'name': pname} for pid, pname in movie['_actors']]
-            movie['writers'] = [{'id': pid, 'name': pname} for pid, pname in movie['_writers']]
-            movie['directors'] = [{'id': pid, 'name': pname} for pid, pname in movie['_directors']]
-            movie['actors_names'] = [pname for _, pname in movie['_actors']]
-            movie['writers_names'] = [pname for _, pname in movie['_writers']]
-            movie['directors_names'] = [pname for _, pname in movie['_directors']]
-
-            del movie['_genres']
-            del movie['_actors']
-            del movie['_writers']
-            del movie['_directors']
-            
-            final_list.append(movie)
-
-        return final_list
+    def transform_data(self, rows) -> List[RawDocument]:
+        """
+        Группирует плоские строки (фильм x персона x жанр) по фильмам за один проход.
+        Повторы персон и жанров из декартова произведения схлопываются ключами словаря и множества.
+        """
+        films = {}
+        for fw_id, title, description, rating, role, person_id, full_name, genre_id, genre_name in rows:
+            film = films.get(fw_id)
+            if film is None:
+                film = films[fw_id] = FilmRecord(fw_id, title, description, rating)
+            if genre_id is not None:
+                film.genres.add(genre_name)
+            if person_id is not None:
+                people = film.persons.get(role)
+                if people is not None:
+                    people[person_id] = full_name
+
+        return [film.document() for film in films.values()]
+
+    def transform_aggregated_data(self, rows) -> List[RawDocument]:
+        """
+        Преобразует строки агрегированного режима (одна строка на фильм)
+        в документы без повторной дедупликации: персоны уже упорядочены запросом.
+        """
+        documents = []
+        for fw_id, title, description, rating, persons, genres in rows:
+            persons = persons or {}
+            documents.append(encode_film(
+                fw_id, title, description, rating, genres or [],
+                persons.get('actor', []), persons.get('writer', []), persons.get('director', []),
+            ))
+        return documents
+
+    def transform(self, rows, mode='aggregated') -> List[RawDocument]:
+        """Преобразует строки в закодированные документы в соответствии с режимом слияния."""
+        if mode == 'flat':
+            return self.transform_data(rows)
+        return self.transform_aggregated_data(rows)
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import random
 import time
@@ -6,9 +7,12 @@ import psycopg
 from contextlib import contextmanager
 from functools import wraps
 from elasticsearch import Elasticsearch, ConnectionError
-from psycopg import OperationalError, ClientCursor
+from psycopg import OperationalError
+from psycopg_pool import ConnectionPool
 from redis import Redis
 
+from metrics import BACKOFF_RETRIES
+
 def backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10, exceptions=(Exception,), service_name="unknown_service"):
     """
     Функция для повторного выполнения функции через некоторое время, если возникла ошибка.
@@ -26,6 +30,7 @@ def backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10, exceptions=(Ex
                     jitter = random.uniform(0, t)
                     sleep_time = t + jitter
                     logging.warning(f'Ошибка от сервиса {service_name}: {e}. Повтор через {sleep_time:.2f} сек...')
+                    BACKOFF_RETRIES.labels(service_name).inc()
                     time.sleep(sleep_time)
                     n += 1
                     t = min(start_sleep_time * (factor ** n), border_sleep_time)
@@ -33,12 +38,58 @@ def backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10, exceptions=(Ex
     return func_wrapper
 
 
+def async_backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10, exceptions=(Exception,), service_name="unknown_service"):
+    """
+    Асинхронный вариант backoff для корутин: ждёт через asyncio.sleep, не блокируя цикл событий.
+    """
+    def func_wrapper(func):
+        @wraps(func)
+        async def inner(*args, **kwargs):
+            n = 0
+            t = start_sleep_time
+            while True:
+                try:
+                    return await func(*args, **kwargs)
+                except exceptions as e:
+                    jitter = random.uniform(0, t)
+                    sleep_time = t + jitter
+                    logging.warning(f'Ошибка от сервиса {service_name}: {e}. Повтор через {sleep_time:.2f} сек...')
+                    BACKOFF_RETRIES.labels(service_name).inc()
+                    await asyncio.sleep(sleep_time)
+                    n += 1
+                    t = min(start_sleep_time * (factor ** n), border_sleep_time)
+        return inner
+    return func_wrapper
+
+
 @backoff(start_sleep_time=1, factor=2, border_sleep_time=8, exceptions=(OperationalError,), service_name="PostgreSQL")
 def connect_pg(**kwargs):
-    kwargs.setdefault('cursor_factory', ClientCursor)
     return psycopg.connect(**kwargs)
 
 
+@backoff(start_sleep_time=1, factor=2, border_sleep_time=8, exceptions=(OperationalError,), service_name="PostgreSQL")
+def open_pg_pool(min_size=1, max_size=4, prepare_threshold=1, **kwargs):
+    """
+    Открывает долгоживущий пул соединений с PostgreSQL.
+    Соединение проверяется при каждой выдаче из пула, запросы выполняются в autocommit
+    с серверной привязкой параметров и готовятся после prepare_threshold выполнений.
+    """
+    pool = ConnectionPool(
+        kwargs={**kwargs, 'autocommit': True, 'prepare_threshold': prepare_threshold},
+        min_size=min_size,
+        max_size=max_size,
+        check=ConnectionPool.check_connection,
+        open=False,
+        name='etl',
+    )
+    try:
+        pool.open(wait=True)
+    except OperationalError:
+        pool.close()
+        raise
+    return pool
+
+
 @backoff(start_sleep_time=1, factor=2, border_sleep_time=8, exceptions=(Exception,), service_name="Redis")
 def connect_redis(**kwargs):
     r = Redis(**kwargs)
@@ -59,6 +110,14 @@ def pg_conn_context(**kwargs):
     finally:
         conn.close()
 
+@contextmanager
+def pg_pool_context(**kwargs):
+    pool = open_pg_pool(**kwargs)
+    try:
+        yield pool
+    finally:
+        pool.close()
+
 @contextmanager
 def redis_conn_context(**kwargs):
     conn = connect_redis(**kwargs)